@@ -3,6 +3,7 @@ import json
 import time
 import random
 import logging
+import uuid
 from pathlib import Path
 from typing import List, Dict, Optional
 from dataclasses import dataclass
@@ -13,6 +14,8 @@ from prometheus_client import Counter, Gauge, Histogram, Summary, start_http_ser
 from confluent_kafka import Producer
 from confluent_kafka import KafkaException
 
+from codec import CONTENT_TYPE_HEADER, get_codec
+
 
 # Configuration
 class LoadPattern(Enum):
@@ -50,6 +53,15 @@ class ProducerConfig:
 
     metrics_port: int = 5000
 
+    # Per-request generation parameters, omitted (service defaults) when None
+    max_new_tokens: Optional[int] = None
+    temperature: Optional[float] = None
+    # Per-message deadline after the send timestamp, the service's topic/default SLO applies when None
+    slo_seconds: Optional[float] = None
+
+    # Wire format of the prompt messages, json or msgpack
+    codec: str = 'json'
+
 # Prometheus metrics
 PROMPTS_SENT_TOTAL = Counter(
     'prompts_sent_total',
@@ -246,6 +258,7 @@ class PromptProducer:
         self.load_generator = LoadGenerator(config)
         
         self.producer = self._create_kafka_producer()
+        self.codec = get_codec(config.codec)
         
         # Statistics
         self.sent_count = 0
@@ -321,6 +334,15 @@ class PromptProducer:
               'request_number': self.sent_count
           }
       }
+      parameters = {
+          'max_new_tokens': self.config.max_new_tokens,
+          'temperature': self.config.temperature
+      }
+      parameters = {k: v for k, v in parameters.items() if v is not None}
+      if parameters:
+          message['parameters'] = parameters
+      if self.config.slo_seconds is not None:
+          message['slo_seconds'] = self.config.slo_seconds
       
       # Increment in-flight counter
       PROMPTS_IN_FLIGHT.labels(load_pattern=self.config.load_pattern.value).inc()
@@ -329,9 +351,16 @@ class PromptProducer:
       self._last_send_time = send_start
       
       try:
+          # Trace context for the service's per-stage latency breakdown
+          headers = [
+              (CONTENT_TYPE_HEADER, self.codec.content_type.encode('utf-8')),
+              ('trace_id', uuid.uuid4().hex.encode('utf-8')),
+              ('sent_at', repr(send_start).encode('utf-8'))
+          ]
           self.producer.produce(
               self.config.kafka_topic,
-              value=json.dumps(message).encode('utf-8'),
+              value=self.codec.encode(message),
+              headers=headers,
               callback=self._on_send_success
           )
           self.producer.poll(0)
@@ -429,6 +458,10 @@ def main():
       burst_size=int(os.getenv('BURST_SIZE', '100')),
       burst_interval=int(os.getenv('BURST_INTERVAL', '60')),
       ramp_up_end_rps=float(os.getenv('RAMP_UP_END_RPS', '50.0')),
+      max_new_tokens=int(os.environ['MAX_NEW_TOKENS']) if os.getenv('MAX_NEW_TOKENS') else None,
+      temperature=float(os.environ['TEMPERATURE']) if os.getenv('TEMPERATURE') else None,
+      slo_seconds=float(os.environ['SLO_SECONDS']) if os.getenv('SLO_SECONDS') else None,
+      codec=os.getenv('MESSAGE_CODEC', 'json'),
     )
     
     producer = PromptProducer(config)
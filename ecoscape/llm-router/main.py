@@ -0,0 +1,467 @@
+'''
+LLM Request Router
+------------------
+Sits between the prompt producer and the SUTs: consumes the shared input topic
+and forwards every prompt, value and headers unchanged, to the input topic of one
+node. Nodes are learned from the load status every LLMService publishes to the
+status topic (STATUS_TOPIC) and can be listed up front as 'node:topic' pairs in
+ROUTES, so prompts are routed before the first status arrives.
+
+Routing policies (ROUTING_POLICY):
+  round_robin        cycles through the available nodes
+  join_shortest_queue  fewest outstanding prompts (queued, inferring, routed since the
+                     last status) per inference slot
+  predicted_latency  lowest predicted completion time: wait for a slot behind the
+                     outstanding prompts, plus prefill and decode of this prompt by
+                     its token count and the node's measured per-token costs
+'''
+
+import itertools
+import logging
+import os
+import signal
+import threading
+import time
+import uuid
+from collections import deque
+from dataclasses import dataclass, field
+from enum import Enum
+from typing import Dict, Optional
+
+from confluent_kafka import Consumer, KafkaException, Producer, TopicPartition
+from prometheus_client import Counter, Gauge, Histogram, start_http_server
+
+from codec import codec_for
+
+
+class RoutingPolicy(Enum):
+    ROUND_ROBIN = "round_robin"
+    JOIN_SHORTEST_QUEUE = "join_shortest_queue"
+    PREDICTED_LATENCY = "predicted_latency"
+
+
+@dataclass
+class RouterConfig:
+    kafka_bootstrap_servers: str
+    input_topic: str
+    status_topic: str
+
+    policy: RoutingPolicy = RoutingPolicy.PREDICTED_LATENCY
+    routes: Dict[str, str] = field(default_factory=dict)  # node id -> input topic, more are learned from status
+    consumer_group: str = 'llm-router'
+    router_id: str = 'router'
+    status_timeout: float = 5.0     # seconds without status after which a node is left out
+    default_new_tokens: int = 256   # expected output tokens of prompts without max_new_tokens
+    consume_batch_size: int = 64
+    max_forward_attempts: int = 3   # forwards of a prompt before it is dropped
+    metrics_port: int = 5000
+
+
+# Prometheus metrics
+PROMPTS_ROUTED_TOTAL = Counter(
+    'router_prompts_routed_total',
+    'Prompts forwarded to a node',
+    ['policy', 'node_id']
+)
+
+ROUTING_ERRORS_TOTAL = Counter(
+    'router_errors_total',
+    'Prompts that could not be routed or forwarded',
+    ['policy', 'reason']
+)
+
+PREDICTED_LATENCY = Histogram(
+    'router_predicted_latency_seconds',
+    'Predicted completion time of a prompt on the node it was routed to',
+    ['policy', 'node_id'],
+    buckets=[0.1, 0.25, 0.5, 1.0, 2.0, 5.0, 10.0, 20.0, 30.0, 60.0, 120.0, 300.0]
+)
+
+ROUTING_DECISION_DURATION = Histogram(
+    'router_decision_duration_seconds',
+    'Time taken to pick a node for a prompt',
+    ['policy'],
+    buckets=[0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01]
+)
+
+FORWARD_DURATION = Histogram(
+    'router_forward_duration_seconds',
+    'Time from forwarding a prompt until the broker acknowledged it',
+    ['policy'],
+    buckets=[0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5]
+)
+
+NODES_AVAILABLE = Gauge(
+    'router_nodes_available',
+    'Nodes prompts are currently routed to'
+)
+
+NODE_OUTSTANDING = Gauge(
+    'router_node_outstanding',
+    'Outstanding prompts of a node as the router estimates them',
+    ['node_id']
+)
+
+
+@dataclass
+class NodeState:
+    """What the router knows about one node"""
+    node_id: str
+    topic: str
+    status: Optional[dict] = None
+    status_at: float = 0.0  # router's clock
+    routed: int = 0         # prompts routed since the last status
+
+    def available(self, now: float, timeout: float) -> bool:
+        if self.status is None:
+            # Static route without status yet, routed to blindly
+            return True
+        return self.status.get('state') == 'ready' and now - self.status_at <= timeout
+
+    def slots(self) -> int:
+        return max(1, (self.status or {}).get('slots') or 1)
+
+    def outstanding(self) -> int:
+        """Prompts queued or inferring at the last status, plus those routed since"""
+        status = self.status or {}
+        return (status.get('queue_depth') or 0) + (status.get('inferring') or 0) + self.routed
+
+    def predicted_latency(self, prompt_tokens: int, new_tokens: int) -> float:
+        """Predicted seconds until this prompt would be completed, 0 for what is not measured yet"""
+        status = self.status or {}
+        queued = (status.get('queue_depth') or 0) + self.routed
+        # Routed prompts fill free slots first
+        free_slots = max(0, self.slots() - (status.get('inferring') or 0))
+        waiting = max(0, queued - free_slots)
+        wait = waiting / self.slots() * (status.get('service_time') or 0.0)
+
+        if status.get('prefill_per_token') is not None:
+            prefill = prompt_tokens * status['prefill_per_token']
+        else:
+            prefill = status.get('ttft_p95') or 0.0
+        decode = new_tokens * (status.get('decode_per_token') or 0.0)
+        return wait + prefill + decode
+
+
+class NodeTable:
+    """Nodes by id, updated from the status topic while the routing loop reads it"""
+
+    def __init__(self, routes: Dict[str, str], status_timeout: float):
+        self.status_timeout = status_timeout
+        self.nodes: Dict[str, NodeState] = {
+            node_id: NodeState(node_id, topic) for node_id, topic in routes.items()
+        }
+        self.lock = threading.Lock()
+        self.logger = logging.getLogger(__name__)
+
+    def update(self, status: dict):
+        node_id = status.get('node_id')
+        topic = status.get('input_topic')
+        if not node_id or not topic:
+            return
+        with self.lock:
+            node = self.nodes.get(node_id)
+            if node is None:
+                self.logger.info(f"Discovered node {node_id} consuming {topic}")
+                node = self.nodes[node_id] = NodeState(node_id, topic)
+            node.status = status
+            node.status_at = time.time()
+            node.routed = 0
+
+    def available(self) -> list:
+        now = time.time()
+        with self.lock:
+            nodes = [node for node in self.nodes.values() if node.available(now, self.status_timeout)]
+        NODES_AVAILABLE.set(len(nodes))
+        return sorted(nodes, key=lambda node: node.node_id)
+
+
+class Router:
+    """Consumes prompts and forwards each to the node picked by the routing policy"""
+
+    def __init__(self, config: RouterConfig):
+        self.config = config
+        self.logger = self._setup_logging()
+        self.nodes = NodeTable(config.routes, config.status_timeout)
+        self.policy = config.policy.value
+        self._round_robin = itertools.count()
+        # Forwarded but unacknowledged offsets per input partition, only offsets below all of them are stored
+        self._unacked: Dict[tuple, set] = {}
+        self._acked: Dict[tuple, int] = {}
+        # Consumed prompts not routed yet, while no node is available
+        self._pending = []
+        # (prompt, attempts so far, node that failed) of failed forwards, routed again by the main loop
+        self._retries = deque()
+        self.running = False
+
+        self.consumer = Consumer({
+            'bootstrap.servers': config.kafka_bootstrap_servers,
+            'group.id': config.consumer_group,
+            'auto.offset.reset': 'latest',
+            # Offsets are stored once the forwarded prompt is acknowledged
+            'enable.auto.offset.store': False,
+        })
+        # Every router instance reads all status records, so it uses a group of its own
+        self.status_consumer = Consumer({
+            'bootstrap.servers': config.kafka_bootstrap_servers,
+            'group.id': f"{config.consumer_group}-status-{uuid.uuid4().hex[:8]}",
+            'auto.offset.reset': 'latest',
+            'enable.auto.commit': False,
+        })
+        self.producer = Producer({
+            'bootstrap.servers': config.kafka_bootstrap_servers,
+            'linger.ms': 5,
+            'enable.idempotence': True,
+            'acks': 'all',
+        })
+
+    def _setup_logging(self) -> logging.Logger:
+        """Configure logging"""
+        logging.basicConfig(
+            level=logging.INFO,
+            format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+        )
+        return logging.getLogger(__name__)
+
+    def _read_status(self):
+        """Status thread: keeps the node table up to date"""
+        self.status_consumer.subscribe([self.config.status_topic])
+        while self.running:
+            for msg in self.status_consumer.consume(num_messages=100, timeout=0.5):
+                if msg.error():
+                    continue
+                try:
+                    self.nodes.update(codec_for(msg.headers()).decode(msg.value()))
+                except Exception as e:
+                    self.logger.warning(f"Invalid status record: {e}")
+        self.status_consumer.close()
+
+    def _prompt_size(self, msg) -> tuple:
+        """(prompt tokens, expected new tokens) of a prompt message, estimated like the producer does"""
+        try:
+            data = codec_for(msg.headers()).decode(msg.value())
+        except Exception:
+            data = None
+        if not isinstance(data, dict):
+            return 0, self.config.default_new_tokens
+        prompt_tokens = data.get('token_count')
+        if not isinstance(prompt_tokens, int):
+            prompt_tokens = len(data.get('prompt') or '') // 4
+        parameters = data.get('parameters')
+        new_tokens = parameters.get('max_new_tokens') if isinstance(parameters, dict) else None
+        if not isinstance(new_tokens, int):
+            new_tokens = self.config.default_new_tokens
+        return prompt_tokens, new_tokens
+
+    def choose(self, msg, avoid: Optional[NodeState] = None):
+        """
+        The node for a prompt and its predicted latency (None unless predicted), None if no node is available.
+        `avoid` is only picked if it is the only node available.
+        """
+        nodes = self.nodes.available()
+        if not nodes:
+            return None, None
+        nodes = [node for node in nodes if node is not avoid] or nodes
+
+        if self.config.policy == RoutingPolicy.ROUND_ROBIN:
+            return nodes[next(self._round_robin) % len(nodes)], None
+
+        if self.config.policy == RoutingPolicy.JOIN_SHORTEST_QUEUE:
+            return min(nodes, key=lambda node: (node.outstanding() / node.slots(), node.routed)), None
+
+        prompt_tokens, new_tokens = self._prompt_size(msg)
+        predictions = [(node.predicted_latency(prompt_tokens, new_tokens), node.routed, node) for node in nodes]
+        predicted, _, node = min(predictions, key=lambda prediction: prediction[:2])
+        return node, predicted
+
+    def route(self, msg, attempt: int = 1, avoid: Optional[NodeState] = None) -> bool:
+        """Forwards a prompt, False if there is no node to send it to"""
+        start = time.perf_counter()
+        node, predicted = self.choose(msg, avoid)
+        ROUTING_DECISION_DURATION.labels(policy=self.policy).observe(time.perf_counter() - start)
+        if node is None:
+            return False
+
+        headers = list(msg.headers() or [])
+        headers += [('routed_by', self.config.router_id.encode('utf-8')),
+                    ('route_policy', self.policy.encode('utf-8'))]
+        if predicted is not None:
+            headers.append(('predicted_latency', repr(predicted).encode('utf-8')))
+        partition = (msg.topic(), msg.partition())
+        self._unacked.setdefault(partition, set()).add(msg.offset())
+        self._forward(node, msg, headers, attempt)
+
+        with self.nodes.lock:
+            node.routed += 1
+        NODE_OUTSTANDING.labels(node_id=node.node_id).set(node.outstanding())
+        PROMPTS_ROUTED_TOTAL.labels(policy=self.policy, node_id=node.node_id).inc()
+        if predicted is not None:
+            PREDICTED_LATENCY.labels(policy=self.policy, node_id=node.node_id).observe(predicted)
+        return True
+
+    def _forward(self, node: NodeState, msg, headers: list, attempt: int):
+        """
+        Produces a prompt to a node. The producer retries transient errors itself until
+        its delivery timeout; a prompt that still failed is queued to be routed again by
+        the main loop, up to max_forward_attempts, so another node can take it. After that
+        it is dropped and its offset acknowledged, so one lost prompt does not hold back
+        the offsets of its partition forever
+        """
+        partition = (msg.topic(), msg.partition())
+        produced_at = time.perf_counter()
+
+        def delivered(err, _):
+            if err is not None:
+                ROUTING_ERRORS_TOTAL.labels(policy=self.policy, reason=err.name()).inc()
+                if not self.running:
+                    # Stays unacknowledged and is consumed again after a restart
+                    return
+                if partition not in self._unacked:
+                    # Revoked since it was forwarded, the new owner consumes it again
+                    return
+                if attempt < self.config.max_forward_attempts:
+                    self.logger.warning(f"Forwarding to {node.node_id} failed, routing again: {err}")
+                    self._retries.append((msg, attempt, node))
+                    return
+                ROUTING_ERRORS_TOTAL.labels(policy=self.policy, reason='dropped').inc()
+                self.logger.error(f"Forwarding failed {attempt} times, dropping the prompt at {partition}:{msg.offset()}: {err}")
+            else:
+                FORWARD_DURATION.labels(policy=self.policy).observe(time.perf_counter() - produced_at)
+            self._acknowledge(partition, msg.offset())
+
+        # Only called from the main loop, never from a delivery callback, so polling here does not nest
+        while True:
+            try:
+                self.producer.produce(node.topic, value=msg.value(), key=msg.key(), headers=headers, on_delivery=delivered)
+                return
+            except BufferError:
+                self.producer.poll(0.05)
+
+    def _on_assign(self, consumer, partitions):
+        # Offsets of a partition owned before start over from its committed offset
+        for partition in partitions:
+            self._unacked.pop((partition.topic, partition.partition), None)
+            self._acked.pop((partition.topic, partition.partition), None)
+        consumer.assign(partitions)
+
+    def _on_revoke(self, consumer, partitions):
+        """Finishes the forwards of revoked partitions, so their offsets are stored before the commit"""
+        revoked = {(partition.topic, partition.partition) for partition in partitions}
+        remaining = self.producer.flush(10)
+        if remaining:
+            self.logger.warning(f"{remaining} forwarded prompts not acknowledged before a rebalance")
+        for partition in revoked:
+            self._unacked.pop(partition, None)
+            self._acked.pop(partition, None)
+        # The new owner consumes them again
+        self._pending = [msg for msg in self._pending if (msg.topic(), msg.partition()) not in revoked]
+        self._retries = deque(retry for retry in self._retries if (retry[0].topic(), retry[0].partition()) not in revoked)
+
+    def _acknowledge(self, partition: tuple, offset: int):
+        """
+        Stores the offset after the lowest forwarded prompt not yet acknowledged.
+        Prompts routed to different nodes are acknowledged out of order.
+        """
+        unacked = self._unacked.get(partition)
+        if unacked is None:
+            # Revoked since it was forwarded
+            return
+        unacked.discard(offset)
+        self._acked[partition] = max(self._acked.get(partition, -1), offset)
+        committable = min(unacked) if unacked else self._acked[partition] + 1
+        try:
+            self.consumer.store_offsets(offsets=[TopicPartition(*partition, committable)])
+        except KafkaException as e:
+            self.logger.debug(f"Could not store offset: {e}")
+
+    def stop(self, *_):
+        self.logger.info("Received shutdown signal, stopping...")
+        self.running = False
+
+    def run(self):
+        """Main execution loop"""
+        try:
+            start_http_server(self.config.metrics_port)
+            self.logger.info(f"Prometheus metrics server started on port {self.config.metrics_port}")
+        except Exception as e:
+            self.logger.warning(f"Failed to start metrics server: {e}")
+
+        self.logger.info(f"Routing {self.config.input_topic} with policy {self.policy}")
+        self.running = True
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        status_thread = threading.Thread(target=self._read_status, name='status', daemon=True)
+        status_thread.start()
+        self.consumer.subscribe([self.config.input_topic], on_assign=self._on_assign, on_revoke=self._on_revoke)
+
+        stalled = False
+        try:
+            while self.running:
+                if not self._pending:
+                    self._pending = [
+                        msg for msg in self.consumer.consume(num_messages=self.config.consume_batch_size, timeout=0.1)
+                        if not msg.error()
+                    ]
+                # Failed forwards go first, through the routing policy again to a node other than the failed one
+                while self._retries:
+                    msg, attempts, failed = self._retries[0]
+                    if not self.route(msg, attempts + 1, avoid=failed):
+                        break
+                    self._retries.popleft()
+                while not self._retries and self._pending and self.route(self._pending[0]):
+                    self._pending.pop(0)
+                if self._pending or self._retries:
+                    # No node available, wait for the next status instead of dropping prompts
+                    if not stalled:
+                        self.logger.warning("No node available, waiting for status")
+                    stalled = True
+                    time.sleep(0.1)
+                else:
+                    stalled = False
+                self.producer.poll(0)
+        finally:
+            self._shutdown(status_thread)
+
+    def _shutdown(self, status_thread: threading.Thread):
+        """Clean shutdown, forwarded prompts are acknowledged before their offsets are committed"""
+        self.running = False
+        remaining = self.producer.flush(30)
+        if remaining:
+            self.logger.warning(f"{remaining} prompts were not forwarded before shutdown")
+        self.consumer.close()
+        status_thread.join(timeout=2)
+        self.logger.info("Router stopped")
+
+
+def parse_routes(value: str) -> Dict[str, str]:
+    """'node:topic,...' to {node: topic}"""
+    routes = {}
+    for item in value.split(','):
+        if item.strip():
+            node_id, topic = item.split(':', 1)
+            routes[node_id.strip()] = topic.strip()
+    return routes
+
+
+def main():
+    config = RouterConfig(
+        kafka_bootstrap_servers=os.getenv('KAFKA_BOOTSTRAP_SERVERS'),
+        input_topic=os.getenv('INPUT_TOPIC'),
+        status_topic=os.getenv('STATUS_TOPIC', 'llm-status'),
+        policy=RoutingPolicy(os.getenv('ROUTING_POLICY', 'predicted_latency')),
+        routes=parse_routes(os.getenv('ROUTES', '')),
+        consumer_group=os.getenv('CONSUMER_GROUP', 'llm-router'),
+        router_id=os.getenv('ROUTER_ID', os.getenv('HOSTNAME', 'router')),
+        status_timeout=float(os.getenv('STATUS_TIMEOUT', '5')),
+        default_new_tokens=int(os.getenv('DEFAULT_NEW_TOKENS', '256')),
+        consume_batch_size=int(os.getenv('CONSUME_BATCH_SIZE', '64')),
+        max_forward_attempts=int(os.getenv('MAX_FORWARD_ATTEMPTS', '3')),
+        metrics_port=int(os.getenv('METRICS_PORT', '5000')),
+    )
+
+    router = Router(config)
+    router.run()
+
+
+if __name__ == "__main__":
+    main()
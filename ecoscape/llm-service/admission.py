@@ -0,0 +1,69 @@
+import threading
+import time
+
+from collections import deque
+from contextlib import contextmanager
+
+from metrics import (
+    TOKEN_BUDGET_IN_FLIGHT,
+    TOKEN_BUDGET_WAITING,
+    TOKEN_BUDGET_WAIT_TIME,
+    bound,
+    samples
+)
+
+class TokenBudget:
+  """
+  Global budget of in-flight tokens, counting prompt tokens plus max_new_tokens
+  of every admitted request.
+
+  Requests are admitted in arrival order once they fit, so a long prompt is not
+  overtaken forever by short ones. A request larger than the whole budget is
+  admitted alone once nothing else is in flight.
+  """
+
+  def __init__(self, max_tokens: int):
+    self.max_tokens = max_tokens
+    self.in_flight = 0
+    self._waiting = deque()
+    self._condition = threading.Condition()
+
+  def _fits(self, tokens: int) -> bool:
+    return self.in_flight == 0 or self.in_flight + tokens <= self.max_tokens
+
+  def acquire(self, tokens: int) -> float:
+    """Blocks until `tokens` fit into the budget, returns the time waited"""
+    start = time.perf_counter()
+    ticket = object()
+    with self._condition:
+      self._waiting.append(ticket)
+      bound(TOKEN_BUDGET_WAITING).set(len(self._waiting))
+      try:
+        while self._waiting[0] is not ticket or not self._fits(tokens):
+          self._condition.wait()
+        self.in_flight += tokens
+      finally:
+        self._waiting.remove(ticket)
+        bound(TOKEN_BUDGET_WAITING).set(len(self._waiting))
+        # The next request in line may fit as well
+        self._condition.notify_all()
+      bound(TOKEN_BUDGET_IN_FLIGHT).set(self.in_flight)
+
+    waited = time.perf_counter() - start
+    samples(TOKEN_BUDGET_WAIT_TIME).observe(waited)
+    return waited
+
+  def release(self, tokens: int):
+    with self._condition:
+      self.in_flight -= tokens
+      bound(TOKEN_BUDGET_IN_FLIGHT).set(self.in_flight)
+      self._condition.notify_all()
+
+  @contextmanager
+  def reserve(self, tokens: int):
+    """Holds `tokens` of the budget for the duration of the block"""
+    self.acquire(tokens)
+    try:
+      yield
+    finally:
+      self.release(tokens)
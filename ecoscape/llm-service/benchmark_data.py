@@ -0,0 +1,28 @@
+'''
+Benchmark data
+--------------
+Synthetic prompts and latencies shared by the benchmarks (codec_benchmark.py,
+metrics_benchmark.py, transport_benchmark.py), so they all measure the same
+kind of input.
+'''
+
+import random
+import string
+
+# Representative prompt lengths of the producer's short, medium and long categories
+PROMPT_TOKENS = {'short': 30, 'medium': 120, 'long': 350}
+CHARS_PER_TOKEN = 4
+
+def random_text(tokens: int) -> str:
+  """Random words of about `tokens` tokens, at the producer's estimate of 4 characters per token"""
+  words = []
+  length = 0
+  while length < tokens * CHARS_PER_TOKEN:
+    word = ''.join(random.choices(string.ascii_lowercase, k=random.randint(2, 9)))
+    words.append(word)
+    length += len(word) + 1
+  return ' '.join(words)
+
+def token_latencies(tokens: int) -> list:
+  """Inter-token latencies in seconds, as a CPU or GPU node decodes them"""
+  return [random.uniform(0.01, 0.2) for _ in range(tokens)]
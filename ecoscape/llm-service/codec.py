@@ -0,0 +1,60 @@
+'''
+Message codecs
+--------------
+Prompt and result records are dicts on the wire. The producer, the router and
+the service share this module (each image ships a copy) and label every record
+with a 'content-type' Kafka header, so readers pick the codec per record and
+records without the header are read as JSON.
+'''
+
+import json
+
+CONTENT_TYPE_HEADER = 'content-type'
+
+class JsonCodec:
+  name = 'json'
+  content_type = 'application/json'
+
+  def encode(self, record: dict) -> bytes:
+    return json.dumps(record, separators=(',', ':')).encode('utf-8')
+
+  def decode(self, value: bytes) -> dict:
+    return json.loads(value)
+
+class MsgpackCodec:
+  name = 'msgpack'
+  content_type = 'application/msgpack'
+
+  def __init__(self):
+    try:
+      import msgpack
+    except ImportError as e:
+      raise RuntimeError(f"Codec msgpack requires the msgpack package: {e}")
+    self._msgpack = msgpack
+
+  def encode(self, record: dict) -> bytes:
+    # packb instead of a shared Packer, whose buffer must not be used by several threads
+    return self._msgpack.packb(record, use_bin_type=True)
+
+  def decode(self, value: bytes) -> dict:
+    return self._msgpack.unpackb(value, raw=False)
+
+CODECS = {codec.name: codec for codec in (JsonCodec, MsgpackCodec)}
+_CONTENT_TYPES = {codec.content_type: codec.name for codec in (JsonCodec, MsgpackCodec)}
+_instances = {}
+
+def get_codec(name: str):
+  """Codec by name ('json', 'msgpack') or content type"""
+  name = _CONTENT_TYPES.get(name, name)
+  if name not in CODECS:
+    raise ValueError(f"Unknown codec '{name}', expected one of {sorted(CODECS)}")
+  if name not in _instances:
+    _instances[name] = CODECS[name]()
+  return _instances[name]
+
+def codec_for(headers):
+  """Codec named by a record's content-type header, JSON if there is none"""
+  for key, value in headers or []:
+    if key == CONTENT_TYPE_HEADER and value is not None:
+      return get_codec(value.decode('utf-8') if isinstance(value, bytes) else value)
+  return get_codec(JsonCodec.name)
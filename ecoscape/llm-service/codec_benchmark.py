@@ -0,0 +1,92 @@
+'''
+Codec micro-benchmark
+---------------------
+Encode/decode cost and bytes per message of every codec, for prompt messages
+as the prompt producer sends them and result records as the service publishes
+them, at the producer's typical prompt lengths.
+
+  python codec_benchmark.py [iterations]
+'''
+
+import random
+import sys
+import time
+
+from benchmark_data import PROMPT_TOKENS, random_text
+from codec import CODECS, get_codec
+
+RESPONSE_TOKENS = 100
+
+def prompt_message(tokens: int) -> dict:
+  return {
+    'message_id': f"1234_{int(time.time() * 1000)}",
+    'prompt': random_text(tokens),
+    'token_count': tokens,
+    'timestamp': time.time(),
+    'metadata': {'original_id': 'alpaca-1234', 'load_pattern': 'poisson', 'request_number': 1234},
+    'parameters': {'max_new_tokens': RESPONSE_TOKENS, 'temperature': 0.7}
+  }
+
+def result_record(tokens: int, echo_prompt: bool) -> dict:
+  record = {
+    'message_id': f"1234_{int(time.time() * 1000)}",
+    'trace_id': '9f0c4b7d2e6a4f1c8b3d5e7f9a1c3e5b',
+    'prompt': random_text(tokens),
+    'response': random_text(RESPONSE_TOKENS),
+    'processing_time': 1.2345,
+    'inference_time': 1.2001,
+    'tokens_generated': RESPONSE_TOKENS,
+    'input_tokens': tokens,
+    'parameters': {'max_new_tokens': RESPONSE_TOKENS, 'do_sample': True, 'temperature': 0.7, 'top_k': 50, 'top_p': 0.9},
+    'model_type': 'causal',
+    'node_id': 'edge-1',
+    'timestamp': '2025-01-01T12:00:00.000000+00:00',
+    'cache_hit': False,
+    'cache_result': None,
+    'deadline': None,
+    'within_slo': True,
+    'stages': {'transit': 0.004, 'queue': 0.05, 'tokenize': 0.001, 'admission': 0.002,
+               'prefill': 0.05, 'decode': 1.1, 'detokenize': 0.0005},
+    'status': 'success'
+  }
+  if not echo_prompt:
+    del record['prompt']
+  return record
+
+def measure(codec, record: dict, iterations: int):
+  """Mean encode and decode time in microseconds, and the encoded size in bytes"""
+  encoded = codec.encode(record)
+  start = time.perf_counter()
+  for _ in range(iterations):
+    codec.encode(record)
+  encode_us = (time.perf_counter() - start) / iterations * 1e6
+  start = time.perf_counter()
+  for _ in range(iterations):
+    codec.decode(encoded)
+  decode_us = (time.perf_counter() - start) / iterations * 1e6
+  return encode_us, decode_us, len(encoded)
+
+def main():
+  iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+  random.seed(0)
+  codecs = []
+  for name in CODECS:
+    try:
+      codecs.append(get_codec(name))
+    except RuntimeError as e:
+      print(f"Skipping {name}: {e}")
+
+  print(f"{'record':<28}{'codec':<10}{'encode us':>11}{'decode us':>11}{'bytes':>8}")
+  for category, tokens in PROMPT_TOKENS.items():
+    records = {
+      f"prompt/{category}": prompt_message(tokens),
+      f"result/{category}": result_record(tokens, echo_prompt=True),
+      f"result/{category}/no-prompt": result_record(tokens, echo_prompt=False)
+    }
+    for label, record in records.items():
+      for codec in codecs:
+        encode_us, decode_us, size = measure(codec, record, iterations)
+        print(f"{label:<28}{codec.name:<10}{encode_us:>11.2f}{decode_us:>11.2f}{size:>8}")
+
+if __name__ == '__main__':
+  main()
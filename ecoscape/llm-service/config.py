@@ -1,6 +1,7 @@
 import os
 
-from dataclasses import dataclass
+from dataclasses import dataclass, field
+from typing import Dict, List
 
 @dataclass
 class Config:
@@ -11,12 +12,69 @@ class Config:
   model_path: str
   node_id: str
 
-  max_new_tokens: int = 256
-  temperature: float = 0.7
+  model_name: str = None  # name requests use for the model at model_path, defaults to its directory name
+  models: Dict[str, str] = field(default_factory=dict)  # further hosted models by name, loaded on first request
+  model_memory_budget: int = 0  # bytes all resident models may take, least recently used ones are evicted, 0 = no limit
+  model_snapshot_dir: str = None  # memory-mapped snapshots of the hosted models, one directory per name
+
+  max_new_tokens: int = 256  # default and upper bound for per-request max_new_tokens
+  temperature: float = 0.7  # default, per-request values are clamped to max_temperature
   do_sample: bool = True
+  max_temperature: float = 2.0
+  token_budget: int = 0  # in-flight prompt plus max_new_tokens across requests, 0 disables
   metrics_port: int = 8000
   consumer_group : str = None
   device_type: str = "auto"  # can be "cpu", "cuda", or "auto"
+  max_batch_size: int = 8  # sequences sharing one decode step
+  consume_batch_size: int = 16  # messages fetched per consume() call
+  max_in_flight: int = 0  # consumed but unfinished messages before pausing, 0 = 2x total batch capacity
+  direct_max_in_flight: int = 0  # open POST /generate requests before answering 503, 0 = the in-flight window
+  direct_timeout: float = 300.0  # seconds a /generate request without a deadline waits for its result
+  drain_on_stop: bool = False  # on SIGTERM also finish the messages waiting in the scheduler, like POST /drain
+  stage_queue_size: int = 0  # capacity of the queues between pipeline stages, 0 = the in-flight window
+  scheduler_policy: str = "fifo"  # fifo, sjf or aging
+  scheduler_aging_rate: float = 100.0  # aging: tokens of priority gained per second waited
+  slo_seconds: float = 0.0  # default deadline after the producer's send time, 0 disables
+  topic_slos: Dict[str, float] = field(default_factory=dict)  # per input topic, overrides slo_seconds
+  offload_topic: str = None  # upstream input topic that new prompts are forwarded to under load
+  offload_queue_depth: int = 0  # offload above this many waiting messages, 0 disables the signal
+  offload_max_wait: float = 0.0  # offload above this predicted queue wait in seconds, 0 disables
+  offload_ttft_p95: float = 0.0  # offload above this p95 time to first token in seconds, 0 disables
+  offload_resume_ratio: float = 0.7  # serve locally again once all signals are below this share of their threshold
+  offload_min_seconds: float = 5.0  # offload at least this long once started
+  status_topic: str = None  # topic the load status for the router is published to
+  status_interval: float = 1.0  # seconds between status records
+  prefix_cache_bytes: int = 256 * 1024 * 1024  # 0 disables the prefix cache
+  prefix_cache_block_size: int = 16  # tokens per cached prefix block
+  response_cache_size: int = 1024  # 0 disables the response cache
+  response_cache_ttl: float = 300.0  # seconds
+  response_cache_sampled: bool = False  # also cache responses when sampling
+  stream_responses: bool = False  # publish partial responses while decoding
+  result_codec: str = "json"  # json or msgpack, prompts are decoded by their content-type header
+  echo_prompt: bool = True  # repeat the prompt in result records
+  producer_linger_ms: int = 5  # how long the result producer waits to fill a batch
+  producer_batch_size: int = 131072  # max bytes per batch of result records
+  producer_compression: str = "lz4"  # none, gzip, snappy, lz4 or zstd
+  producer_idempotence: bool = True  # no duplicates or reordering on retries, implies acks=all
+  producer_delivery_timeout_ms: int = 120000  # the producer retries a record this long before it fails
+  stream_chunk_tokens: int = 16  # max tokens per streamed chunk
+  stream_chunk_interval: float = 0.25  # max seconds between streamed chunks
+  draft_model_path: str = None  # enables speculative decoding
+  speculative_tokens: int = 4  # draft tokens proposed per round
+  speculative_min_acceptance: float = 0.3  # fall back to plain decoding below this rate
+  speculative_cooldown: float = 30.0  # seconds of plain decoding after a fallback
+  precision: str = "auto"  # auto, fp32, bf16, int8-dynamic or int8-weight-only
+  precision_check: bool = False  # compare against fp32 on a fixed prompt set after loading
+  snapshot_path: str = None  # memory-mapped weight snapshot, written on first load
+  warmup_lengths: List[int] = field(default_factory=lambda: [16, 128, 512])  # empty disables warmup
+  warmup_new_tokens: int = 8
+  torch_compile: bool = False
+  processes: int = 1  # forked inference worker processes sharing the weights, CPU only
+  workers: int = 1  # compute workers (batching engines / generate threads) per process
+  intra_op_threads: int = 0  # torch threads per worker, 0 divides the available CPUs between workers
+  inter_op_threads: int = 0  # 0 keeps the torch default
+  cpu_affinity: str = None  # cpu list per worker separated by ';', e.g. "0-3;4-7"
+  numa_node: int = None  # pin workers to this node's CPUs and prefer its memory
 
   @classmethod
   def from_env(cls) -> 'Config':
@@ -28,10 +86,72 @@ class Config:
       output_topic = os.getenv('OUTPUT_TOPIC'),
       model_path = os.getenv('MODEL_PATH'),
       node_id = node_id,
+      model_name = os.getenv('MODEL_NAME'),
+      models = {
+        name.strip(): path.strip()
+        for name, path in (item.split(':', 1) for item in os.getenv('MODELS', '').split(',') if item.strip())
+      },
+      model_memory_budget = int(os.getenv('MODEL_MEMORY_BUDGET', '0')),
+      model_snapshot_dir = os.getenv('MODEL_SNAPSHOT_DIR'),
       max_new_tokens = int(os.getenv('MAX_NEW_TOKENS', '256')),
       temperature = float(os.getenv('TEMPERATURE', '0.7')),
       do_sample = os.getenv('DO_SAMPLE', 'true').lower() == 'true',
+      max_temperature = float(os.getenv('MAX_TEMPERATURE', '2.0')),
+      token_budget = int(os.getenv('TOKEN_BUDGET', '0')),
       metrics_port = int(os.getenv('METRICS_PORT', '8000')),
       consumer_group = os.getenv('CONSUMER_GROUP', node_id),
-      device_type=device_type
+      device_type=device_type,
+      max_batch_size = int(os.getenv('MAX_BATCH_SIZE', '8')),
+      consume_batch_size = int(os.getenv('CONSUME_BATCH_SIZE', '16')),
+      max_in_flight = int(os.getenv('MAX_IN_FLIGHT', '0')),
+      direct_max_in_flight = int(os.getenv('DIRECT_MAX_IN_FLIGHT', '0')),
+      direct_timeout = float(os.getenv('DIRECT_TIMEOUT', '300')),
+      drain_on_stop = os.getenv('DRAIN_ON_STOP', 'false').lower() == 'true',
+      stage_queue_size = int(os.getenv('STAGE_QUEUE_SIZE', '0')),
+      scheduler_policy = os.getenv('SCHEDULER_POLICY', 'fifo'),
+      scheduler_aging_rate = float(os.getenv('SCHEDULER_AGING_RATE', '100')),
+      slo_seconds = float(os.getenv('SLO_SECONDS', '0')),
+      topic_slos = {
+        topic.strip(): float(seconds)
+        for topic, seconds in (item.split(':') for item in os.getenv('TOPIC_SLOS', '').split(',') if item.strip())
+      },
+      offload_topic = os.getenv('OFFLOAD_TOPIC'),
+      offload_queue_depth = int(os.getenv('OFFLOAD_QUEUE_DEPTH', '0')),
+      offload_max_wait = float(os.getenv('OFFLOAD_MAX_WAIT', '0')),
+      offload_ttft_p95 = float(os.getenv('OFFLOAD_TTFT_P95', '0')),
+      offload_resume_ratio = float(os.getenv('OFFLOAD_RESUME_RATIO', '0.7')),
+      offload_min_seconds = float(os.getenv('OFFLOAD_MIN_SECONDS', '5')),
+      status_topic = os.getenv('STATUS_TOPIC'),
+      status_interval = float(os.getenv('STATUS_INTERVAL', '1')),
+      prefix_cache_bytes = int(os.getenv('PREFIX_CACHE_BYTES', str(256 * 1024 * 1024))),
+      prefix_cache_block_size = int(os.getenv('PREFIX_CACHE_BLOCK_SIZE', '16')),
+      response_cache_size = int(os.getenv('RESPONSE_CACHE_SIZE', '1024')),
+      response_cache_ttl = float(os.getenv('RESPONSE_CACHE_TTL', '300')),
+      response_cache_sampled = os.getenv('RESPONSE_CACHE_SAMPLED', 'false').lower() == 'true',
+      stream_responses = os.getenv('STREAM_RESPONSES', 'false').lower() == 'true',
+      result_codec = os.getenv('RESULT_CODEC', 'json'),
+      echo_prompt = os.getenv('ECHO_PROMPT', 'true').lower() == 'true',
+      producer_linger_ms = int(os.getenv('PRODUCER_LINGER_MS', '5')),
+      producer_batch_size = int(os.getenv('PRODUCER_BATCH_SIZE', '131072')),
+      producer_compression = os.getenv('PRODUCER_COMPRESSION', 'lz4'),
+      producer_idempotence = os.getenv('PRODUCER_IDEMPOTENCE', 'true').lower() == 'true',
+      producer_delivery_timeout_ms = int(os.getenv('PRODUCER_DELIVERY_TIMEOUT_MS', '120000')),
+      stream_chunk_tokens = int(os.getenv('STREAM_CHUNK_TOKENS', '16')),
+      stream_chunk_interval = float(os.getenv('STREAM_CHUNK_INTERVAL', '0.25')),
+      draft_model_path = os.getenv('DRAFT_MODEL_PATH'),
+      speculative_tokens = int(os.getenv('SPECULATIVE_TOKENS', '4')),
+      speculative_min_acceptance = float(os.getenv('SPECULATIVE_MIN_ACCEPTANCE', '0.3')),
+      speculative_cooldown = float(os.getenv('SPECULATIVE_COOLDOWN', '30')),
+      precision = os.getenv('PRECISION', 'auto'),
+      precision_check = os.getenv('PRECISION_CHECK', 'false').lower() == 'true',
+      snapshot_path = os.getenv('SNAPSHOT_PATH'),
+      warmup_lengths = [int(x) for x in os.getenv('WARMUP_LENGTHS', '16,128,512').split(',') if x.strip()],
+      warmup_new_tokens = int(os.getenv('WARMUP_NEW_TOKENS', '8')),
+      torch_compile = os.getenv('TORCH_COMPILE', 'false').lower() == 'true',
+      processes = int(os.getenv('PROCESSES', '1')),
+      workers = int(os.getenv('WORKERS', '1')),
+      intra_op_threads = int(os.getenv('INTRA_OP_THREADS', '0')),
+      inter_op_threads = int(os.getenv('INTER_OP_THREADS', '0')),
+      cpu_affinity = os.getenv('CPU_AFFINITY'),
+      numa_node = int(os.environ['NUMA_NODE']) if os.getenv('NUMA_NODE') else None
       )
\ No newline at end of file
@@ -0,0 +1,83 @@
+'''
+Direct requests
+---------------
+Prompts posted to POST /generate instead of the input topic. They go through the
+same scheduler, inference slots, model and metrics as consumed messages, so both
+transports compete for the same capacity under one scheduling policy; only where
+the result ends up differs.
+
+A direct request is tracked as a message of the reserved DIRECT_TOPIC, which no
+consumed message has, and the chunks of a streamed one are keyed by that message.
+The produce stage hands their records to the HTTP handler waiting for them instead
+of the result publisher, and there is no offset to commit.
+'''
+
+import itertools
+import queue
+import threading
+
+DIRECT_TOPIC = '__direct__'
+
+# Handed to waiting handlers when the service stops before their request finished
+STOPPED = object()
+
+class DirectExchange:
+  """Encoded records of one direct request, put by the produce stage and taken by its HTTP handler"""
+
+  def __init__(self, stream: bool):
+    self.stream = stream
+    self._records = queue.SimpleQueue()
+
+  def put(self, value):
+    """An encoded record, None if the request ended without a result"""
+    self._records.put(value)
+
+  def get(self, timeout: float):
+    """The next record, raises queue.Empty after `timeout` seconds"""
+    return self._records.get(timeout=max(0.0, timeout))
+
+class DirectRequests:
+  """Open direct requests, at most `limit` at a time"""
+
+  def __init__(self, limit: int):
+    self.limit = limit
+    self.closed = False
+    self._exchanges = {}
+    self._ids = itertools.count()
+    self._lock = threading.Lock()
+
+  def __len__(self):
+    return len(self._exchanges)
+
+  @staticmethod
+  def owns(message) -> bool:
+    """Whether a message, or the key of a chunk, belongs to a direct request"""
+    return isinstance(message, tuple) and message[0] == DIRECT_TOPIC
+
+  def open(self, stream: bool):
+    """(message, exchange) of a new request, None if the limit is reached or the service stops"""
+    with self._lock:
+      if self.closed or len(self._exchanges) >= self.limit:
+        return None
+      message = (DIRECT_TOPIC, 0, next(self._ids))
+      exchange = self._exchanges[message] = DirectExchange(stream)
+      return message, exchange
+
+  def deliver(self, message: tuple, value):
+    """Hands a record to the request's handler, dropped if the client is gone"""
+    exchange = self._exchanges.get(message)
+    if exchange is not None:
+      exchange.put(value)
+
+  def close(self, message: tuple):
+    with self._lock:
+      self._exchanges.pop(message, None)
+
+  def close_all(self):
+    """Releases every waiting handler and refuses new requests"""
+    with self._lock:
+      self.closed = True
+      exchanges = list(self._exchanges.values())
+      self._exchanges.clear()
+    for exchange in exchanges:
+      exchange.put(STOPPED)
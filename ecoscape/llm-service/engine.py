@@ -0,0 +1,356 @@
+import logging
+import queue
+import threading
+import time
+import torch
+
+from dataclasses import dataclass, field
+from typing import List, Optional
+from transformers import DynamicCache
+
+from metrics import BATCH_SIZE, bound
+from streaming import TokenRecorder
+
+logger = logging.getLogger(__name__)
+
+@dataclass
+class GenerationRequest:
+  """A single prompt travelling through the batching engine"""
+  input_ids: torch.Tensor
+  max_new_tokens: int
+  do_sample: bool = False
+  temperature: float = 1.0
+  top_k: int = 0
+  top_p: float = 1.0
+  use_prefix_cache: bool = True
+
+  submitted_at: float = field(default_factory=time.perf_counter)
+  started_at: Optional[float] = None  # prefill started, after waiting for admission
+  finished_at: Optional[float] = None
+  tokens: TokenRecorder = None
+  error: Optional[BaseException] = None
+  done: threading.Event = field(default_factory=threading.Event)
+  progress: Optional[threading.Event] = None  # set on every token for streaming consumers
+
+  speculate: bool = True
+  draft_proposed: int = 0
+  draft_accepted: int = 0
+  draft_rounds: int = 0
+
+  def __post_init__(self):
+    if self.tokens is None:
+      self.tokens = TokenRecorder(self.max_new_tokens)
+
+  @property
+  def output_ids(self) -> List[int]:
+    return self.tokens.ids()
+
+  def wait(self):
+    """Blocks until the engine retired this request"""
+    self.done.wait()
+    if self.error is not None:
+      raise self.error
+    return self
+
+def cache_layers(cache) -> list:
+  """Returns the (key, value) tensors of a cache object as a list per layer"""
+  if hasattr(cache, 'layers'):
+    return [(layer.keys, layer.values) for layer in cache.layers]
+  return [(k, v) for k, v in cache]
+
+def token_probs(logits: torch.Tensor, request: GenerationRequest) -> torch.Tensor:
+  """Sampling distribution of one logits row after temperature, top-k and top-p"""
+  row = logits.float() / request.temperature
+  if request.top_k and request.top_k > 0:
+    threshold = torch.topk(row, min(request.top_k, row.shape[-1])).values[-1]
+    row = row.masked_fill(row < threshold, float('-inf'))
+  if request.top_p < 1.0:
+    sorted_logits, sorted_idx = torch.sort(row, descending=True)
+    cumulative = torch.softmax(sorted_logits, dim=-1).cumsum(dim=-1)
+    remove = cumulative > request.top_p
+    remove[1:] = remove[:-1].clone()
+    remove[0] = False
+    row = row.masked_fill(torch.zeros_like(remove).scatter(0, sorted_idx, remove), float('-inf'))
+  return torch.softmax(row, dim=-1)
+
+def _left_pad(tensor: torch.Tensor, pad: int, dim: int) -> torch.Tensor:
+  if pad == 0:
+    return tensor
+  shape = list(tensor.shape)
+  shape[dim] = pad
+  return torch.cat([tensor.new_zeros(shape), tensor], dim=dim)
+
+class BatchEngine:
+  """
+  Iteration-level (continuous) batching for causal LMs.
+
+  A single engine thread owns the model. Before every decode step it admits
+  waiting requests into the running batch (prefilling them one by one) and
+  after every step it retires the sequences that hit EOS or their token limit.
+  The KV cache of the batch is kept left-padded, so sequences of different
+  length share one forward pass per generated token.
+
+  With a SpeculativeDecoder attached, a sequence that runs alone (and thus
+  leaves the decode memory-bound) is advanced by draft/verify rounds instead.
+
+  Several engines may share one model, `thread_init` runs first on the engine
+  thread (e.g. to pin it to its CPUs).
+  """
+
+  def __init__(self, model, eos_token_ids, max_batch_size: int = 8, prefix_cache=None, speculative=None,
+               worker: int = 0, thread_init=None):
+    self.model = model
+    self.eos_token_ids = set(eos_token_ids)
+    self.max_batch_size = max_batch_size
+    self.prefix_cache = prefix_cache
+    self.speculative = speculative
+    self.worker = worker
+    self.thread_init = thread_init
+    self.device = model.device
+
+    self._pending = queue.Queue()
+    self._thread = None
+    self._running = False
+    self._reset_batch()
+
+  def _reset_batch(self):
+    self._active: List[GenerationRequest] = []
+    self._layers = None       # per layer (keys, values) of shape [B, H, L, D]
+    self._mask = None         # [B, L] attention mask, 0 marks left padding
+    self._positions = None    # [B] position id of the next input token
+    self._next_tokens = None  # [B] token fed into the next decode step
+
+  def start(self):
+    self._running = True
+    self._thread = threading.Thread(target=self._loop, name=f'batch-engine-{self.worker}', daemon=True)
+    self._thread.start()
+    logger.info(f"Batch engine {self.worker} started (max batch size {self.max_batch_size})")
+
+  def stop(self):
+    """
+    Stops the engine thread, which fails the running batch on its way out: only that thread
+    touches the batch. A step still running after the timeout finishes first
+    """
+    self._running = False
+    if self._thread:
+      self._thread.join(timeout=5)
+      if self._thread.is_alive():
+        logger.warning(f"Batch engine {self.worker} is still finishing a step, its requests fail once it is done")
+        return
+    # Submitted while the thread was exiting, or the engine never ran
+    self._fail_pending()
+
+  def _fail_pending(self):
+    while True:
+      try:
+        self._fail(self._pending.get_nowait(), RuntimeError('Batch engine stopped'))
+      except queue.Empty:
+        return
+
+  def submit(self, request: GenerationRequest) -> GenerationRequest:
+    """Queues a request for admission into the running batch"""
+    if not self._running:
+      raise RuntimeError('Batch engine is not running')
+    self._pending.put(request)
+    return request
+
+  def pending(self) -> int:
+    return self._pending.qsize()
+
+  def load(self) -> int:
+    """Running plus waiting sequences, used to pick the least loaded engine"""
+    return len(self._active) + self._pending.qsize()
+
+  def _loop(self):
+    batch_size = bound(BATCH_SIZE, worker=str(self.worker))
+    if self.thread_init is not None:
+      try:
+        self.thread_init()
+      except Exception as e:
+        logger.error(f"Batch engine {self.worker} thread setup failed: {e}", exc_info=True)
+    while self._running:
+      try:
+        self._admit()
+        batch_size.set(len(self._active))
+        if not self._active:
+          # Idle: block until the next request arrives
+          try:
+            self._admit_one(self._pending.get(timeout=0.1))
+          except queue.Empty:
+            pass
+          continue
+        if self._can_speculate():
+          self._speculative_step()
+        else:
+          self._step()
+      except Exception as e:
+        logger.error(f"Batch engine step failed: {e}", exc_info=True)
+        for request in self._active:
+          self._fail(request, e)
+        self._reset_batch()
+
+    for request in self._active:
+      self._fail(request, RuntimeError('Batch engine stopped'))
+    self._reset_batch()
+    self._fail_pending()
+
+  def _admit(self):
+    while len(self._active) < self.max_batch_size:
+      try:
+        request = self._pending.get_nowait()
+      except queue.Empty:
+        return
+      self._admit_one(request)
+
+  def _admit_one(self, request: GenerationRequest):
+    request.started_at = time.perf_counter()
+    try:
+      self._prefill(request)
+    except Exception as e:
+      logger.error(f"Prefill failed: {e}", exc_info=True)
+      self._fail(request, e)
+
+  @torch.inference_mode()
+  def _prefill(self, request: GenerationRequest):
+    input_ids = request.input_ids.to(self.device)
+    length = input_ids.shape[1]
+
+    # Skip the part of the prefill that is covered by a cached prefix
+    cached_tokens, cached_layers = 0, None
+    use_prefix_cache = self.prefix_cache is not None and request.use_prefix_cache
+    if use_prefix_cache:
+      token_ids = input_ids[0].tolist()
+      cached_tokens, cached_layers = self.prefix_cache.lookup(token_ids)
+    out = self.model(
+      input_ids=input_ids[:, cached_tokens:],
+      attention_mask=torch.ones_like(input_ids),
+      past_key_values=DynamicCache(cached_layers) if cached_layers else None,
+      use_cache=True
+    )
+    layers = cache_layers(out.past_key_values)
+    if use_prefix_cache:
+      self.prefix_cache.insert(token_ids, layers)
+
+    token = self._sample(out.logits[:, -1, :], [request])[0]
+    if self._record(request, int(token)):
+      return
+
+    mask = torch.ones((1, length), dtype=torch.long, device=self.device)
+    position = torch.tensor([length], dtype=torch.long, device=self.device)
+
+    if not self._active:
+      self._layers, self._mask, self._positions = layers, mask, position
+      self._next_tokens = token.view(1)
+    else:
+      # Align the new sequence and the running batch on a common (left padded) length
+      batch_len, new_len = self._mask.shape[1], length
+      target = max(batch_len, new_len)
+      self._layers = [
+        (torch.cat([_left_pad(bk, target - batch_len, 2), _left_pad(nk, target - new_len, 2)]),
+         torch.cat([_left_pad(bv, target - batch_len, 2), _left_pad(nv, target - new_len, 2)]))
+        for (bk, bv), (nk, nv) in zip(self._layers, layers)
+      ]
+      self._mask = torch.cat([_left_pad(self._mask, target - batch_len, 1), _left_pad(mask, target - new_len, 1)])
+      self._positions = torch.cat([self._positions, position])
+      self._next_tokens = torch.cat([self._next_tokens, token.view(1)])
+    self._active.append(request)
+
+  def _can_speculate(self) -> bool:
+    return (
+      self.speculative is not None
+      and len(self._active) == 1
+      and self._pending.empty()
+      and self.speculative.active_for(self._active[0])
+    )
+
+  def _speculative_step(self):
+    request = self._active[0]
+    # The cache covers the prompt and all output tokens except the next input token
+    sequence = request.input_ids[0].tolist() + request.output_ids
+    if self._mask.shape[1] != len(sequence) - 1:
+      return self._step()
+    result = self.speculative.step(self.model, self._layers, sequence, request)
+    if result is None:
+      return self._step()
+
+    tokens, layers = result
+    for token in tokens:
+      if self._record(request, token):
+        self.speculative.release()
+        self._reset_batch()
+        return
+    length = len(sequence) + len(tokens) - 1
+    self._layers = layers
+    self._mask = torch.ones((1, length), dtype=torch.long, device=self.device)
+    self._positions = torch.tensor([length], dtype=torch.long, device=self.device)
+    self._next_tokens = torch.tensor([tokens[-1]], dtype=torch.long, device=self.device)
+
+  @torch.inference_mode()
+  def _step(self):
+    if self.speculative is not None:
+      self.speculative.release()
+    batch = len(self._active)
+    mask = torch.cat([self._mask, self._mask.new_ones((batch, 1))], dim=1)
+    out = self.model(
+      input_ids=self._next_tokens.unsqueeze(1),
+      attention_mask=mask,
+      position_ids=self._positions.unsqueeze(1),
+      past_key_values=DynamicCache(self._layers),
+      use_cache=True
+    )
+    self._layers = cache_layers(out.past_key_values)
+    self._mask = mask
+    self._positions = self._positions + 1
+    self._next_tokens = self._sample(out.logits[:, -1, :], self._active)
+
+    keep = [
+      i for i, (request, token) in enumerate(zip(self._active, self._next_tokens.tolist()))
+      if not self._record(request, token)
+    ]
+    if len(keep) < batch:
+      self._retire(keep)
+
+  def _retire(self, keep: List[int]):
+    if not keep:
+      self._reset_batch()
+      return
+    index = torch.tensor(keep, dtype=torch.long, device=self.device)
+    mask = self._mask.index_select(0, index)
+    # Drop leading columns that are padding for every remaining sequence
+    trim = int((mask.sum(dim=0) == 0).long().cumprod(dim=0).sum())
+    self._mask = mask[:, trim:]
+    self._layers = [
+      (k.index_select(0, index)[:, :, trim:], v.index_select(0, index)[:, :, trim:])
+      for k, v in self._layers
+    ]
+    self._positions = self._positions.index_select(0, index)
+    self._next_tokens = self._next_tokens.index_select(0, index)
+    self._active = [self._active[i] for i in keep]
+
+  def _sample(self, logits: torch.Tensor, requests: List[GenerationRequest]) -> torch.Tensor:
+    tokens = logits.argmax(dim=-1)
+    for i, request in enumerate(requests):
+      if request.do_sample and request.temperature > 0:
+        tokens[i] = torch.multinomial(token_probs(logits[i], request), num_samples=1)[0]
+    return tokens
+
+  def _record(self, request: GenerationRequest, token: int) -> bool:
+    """Appends a generated token and returns True if the request is finished"""
+    now = time.perf_counter()
+    finished = token in self.eos_token_ids
+    if not finished:
+      request.tokens.record(token, now)
+      finished = len(request.tokens) >= request.max_new_tokens
+    if finished:
+      request.finished_at = now
+      request.done.set()
+    if request.progress is not None:
+      request.progress.set()
+    return finished
+
+  def _fail(self, request: GenerationRequest, error: BaseException):
+    request.error = error
+    request.finished_at = time.perf_counter()
+    request.done.set()
+    if request.progress is not None:
+      request.progress.set()
@@ -0,0 +1,103 @@
+import json
+import logging
+import threading
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
+
+from metrics import flush_samples, metrics_registry
+
+logger = logging.getLogger(__name__)
+
+class ServiceHTTPServer:
+  """
+  Small HTTP server for the SUT: Prometheus metrics plus routes registered by the service.
+
+  Handlers receive the request handler and either return a tuple
+  (status, content_type, body) or write the response themselves and return None,
+  e.g. as server-sent events with `start_events` and `send_event`.
+  """
+
+  def __init__(self, port: int):
+    self.port = port
+    self.routes = {}
+    self.server = None
+    self.thread = None
+    self.route('GET', '/metrics', self.metrics)
+
+  def metrics(self, request):
+    # Buffered samples of this process are observed before every scrape
+    flush_samples()
+    return 200, CONTENT_TYPE_LATEST, generate_latest(metrics_registry())
+
+  def route(self, method: str, path: str, handler):
+    self.routes[(method, path)] = handler
+
+  def start(self):
+    routes = self.routes
+
+    class Handler(BaseHTTPRequestHandler):
+      def _dispatch(self, method):
+        handler = routes.get((method, urlparse(self.path).path))
+        if handler is None:
+          return self.respond(404, 'application/json', {'error': 'not found'})
+        try:
+          result = handler(self)
+        except Exception as e:
+          logger.error(f"HTTP handler for {self.path} failed: {e}", exc_info=True)
+          return self.respond(500, 'application/json', {'error': str(e)})
+        if result is not None:
+          self.respond(*result)
+
+      def json_body(self):
+        """The request body parsed as JSON, None without a body"""
+        length = int(self.headers.get('Content-Length') or 0)
+        return json.loads(self.rfile.read(length)) if length else None
+
+      def start_events(self):
+        """Starts a server-sent events response, the connection closes after the last event"""
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+        self.close_connection = True
+
+      def send_event(self, event: str, data):
+        if isinstance(data, (dict, list)):
+          data = json.dumps(data)
+        if isinstance(data, bytes):
+          data = data.decode('utf-8')
+        self.wfile.write(f"event: {event}\ndata: {data}\n\n".encode('utf-8'))
+        self.wfile.flush()
+
+      def respond(self, status, content_type, body):
+        if isinstance(body, (dict, list)):
+          body = json.dumps(body)
+        if isinstance(body, str):
+          body = body.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+      def do_GET(self):
+        self._dispatch('GET')
+
+      def do_POST(self):
+        self._dispatch('POST')
+
+      def log_message(self, format, *args):
+        logger.debug(format % args)
+
+    self.server = ThreadingHTTPServer(('', self.port), Handler)
+    self.server.daemon_threads = True
+    self.thread = threading.Thread(target=self.server.serve_forever, name='http-server', daemon=True)
+    self.thread.start()
+    logger.info(f"HTTP server listening on port {self.port}")
+
+  def stop(self):
+    if self.server:
+      self.server.shutdown()
+      self.server.server_close()
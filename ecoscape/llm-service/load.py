@@ -0,0 +1,88 @@
+'''
+Load tracking
+-------------
+Recent load of the service as seen by the process that schedules messages:
+service time per inference slot, time to first token, prefill and decode cost
+per token and token throughput. Worker processes report what they measured with
+each finished message (see `request_load`). The offload controller decides on
+these numbers, and the status published for the router is built from them.
+'''
+
+import threading
+import time
+
+from collections import deque
+
+from metrics import RateWindow
+
+def first_token_latency(stages: dict):
+  """Time to first token since the message was received, None if no inference ran"""
+  if 'prefill' not in stages:
+    return None
+  return sum(stages.get(stage, 0.0) for stage in ('queue', 'tokenize', 'admission', 'prefill'))
+
+def request_load(record: dict):
+  """What a finished result record tells about the load, None if it ran no inference"""
+  stages = record.get('stages') or {}
+  ttft = first_token_latency(stages)
+  if ttft is None:
+    return None
+  return {
+    'ttft': ttft,
+    'prefill': stages['prefill'],
+    'decode': stages.get('decode', 0.0),
+    'input_tokens': record.get('input_tokens') or 0,
+    'tokens': record.get('tokens_generated') or 0
+  }
+
+class LoadTracker:
+  """Averages are exponential, TTFTs are kept for `ttft_window` seconds. Thread-safe."""
+
+  def __init__(self, ttft_window: float = 30.0, smoothing: float = 0.1):
+    self.ttft_window = ttft_window
+    self.smoothing = smoothing
+    self.service_time = None
+    self.prefill_per_token = None
+    self.decode_per_token = None
+    self._ttfts = deque()
+    self._tokens = RateWindow(seconds=10)
+    self._lock = threading.Lock()
+
+  def _average(self, current, value: float) -> float:
+    return value if current is None else current + self.smoothing * (value - current)
+
+  def record_service_time(self, seconds: float):
+    """Time a message spent in an inference slot"""
+    with self._lock:
+      self.service_time = self._average(self.service_time, seconds)
+
+  def record_request(self, load: dict):
+    """Records the `request_load` of a finished message"""
+    with self._lock:
+      self._ttfts.append((time.monotonic(), load['ttft']))
+      if load['input_tokens'] > 0:
+        self.prefill_per_token = self._average(self.prefill_per_token, load['prefill'] / load['input_tokens'])
+      if load['tokens'] > 1:
+        self.decode_per_token = self._average(self.decode_per_token, load['decode'] / (load['tokens'] - 1))
+    self._tokens.record(load['tokens'], load['tokens'])
+
+  def ttft_p95(self):
+    """p95 over the window, None without recent samples so an idle node does not look loaded"""
+    now = time.monotonic()
+    with self._lock:
+      while self._ttfts and now - self._ttfts[0][0] > self.ttft_window:
+        self._ttfts.popleft()
+      values = sorted(ttft for _, ttft in self._ttfts)
+    if not values:
+      return None
+    return values[min(len(values) - 1, int(0.95 * len(values)))]
+
+  def tokens_per_second(self) -> float:
+    rates = self._tokens.rates()
+    return rates[0] if rates is not None else 0.0
+
+  def predicted_wait(self, queue_depth: int, slots: int):
+    """Expected wait for a slot behind `queue_depth` messages, None before the first measurement"""
+    if self.service_time is None:
+      return None
+    return queue_depth / max(slots, 1) * self.service_time
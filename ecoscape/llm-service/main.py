@@ -1,6 +1,8 @@
+import glob
 import logging
+import os
+import tempfile
 from config import Config
-from service import LLMService
 
 logging.basicConfig(
     level=logging.INFO,
@@ -10,5 +12,14 @@ logging.basicConfig(
 
 if __name__ == '__main__':
   config = Config.from_env()
+  if config.processes > 1:
+    # Prometheus multiprocess mode must be configured before prometheus_client is imported
+    if 'PROMETHEUS_MULTIPROC_DIR' not in os.environ:
+      os.environ['PROMETHEUS_MULTIPROC_DIR'] = tempfile.mkdtemp(prefix='prometheus-')
+    metrics_dir = os.environ['PROMETHEUS_MULTIPROC_DIR']
+    for stale in glob.glob(os.path.join(metrics_dir, '*.db')):
+      os.remove(stale)
+
+  from service import LLMService
   service = LLMService(config)
   service.run()
\ No newline at end of file
@@ -1,127 +1,636 @@
 import os
-from prometheus_client import Counter, Histogram, Gauge
+import threading
+import time
+from bisect import bisect_left
+from collections import deque
+from prometheus_client import CollectorRegistry, Counter, Histogram, Gauge, REGISTRY, multiprocess
 
 NODE_ID = os.getenv('NODE_ID', 'default')
 NODE_TYPE = os.getenv('NODE_TYPE', 'edge')  # edge, cloud, fog
 DEVICE_TYPE = os.getenv('DEVICE_TYPE', 'cpu')  # cpu, gpu
+PRECISION = os.getenv('PRECISION', 'auto')  # auto, fp32, bf16, int8-dynamic, int8-weight-only
+
+# Set (before prometheus_client is imported) when several worker processes share the metrics
+MULTIPROCESS = 'PROMETHEUS_MULTIPROC_DIR' in os.environ
 
 MESSAGES_PROCESSED = Counter(
     'llm_messages_processed_total',
     'Total processed messages',
-    ['node_id', 'node_type', 'device_type', 'status']
+    ['node_id', 'node_type', 'device_type', 'precision', 'status']
 )
 
 INPUT_TOKENS = Counter(
     'llm_input_tokens_total',
     'Total input tokens processed',
-    ['node_id', 'node_type', 'device_type']
+    ['node_id', 'node_type', 'device_type', 'precision']
 )
 
 INTER_TOKEN_LATENCY = Histogram(
     'llm_inter_token_latency_seconds',
     'Time between consecutive tokens',
-    ['node_id', 'node_type', 'device_type'],
+    ['node_id', 'node_type', 'device_type', 'precision'],
     buckets=[0.001, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0]
 )
 
 TOKENS_GENERATED = Counter(
     'llm_tokens_generated_total',
     'Total output tokens generated',
-    ['node_id', 'node_type', 'device_type']
+    ['node_id', 'node_type', 'device_type', 'precision']
 )
 
 TTFT = Histogram(
     'llm_time_to_first_token_seconds',
     'Time from request start to first token generated',
-    ['node_id', 'node_type', 'device_type'],
+    ['node_id', 'node_type', 'device_type', 'precision'],
     buckets=[0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.0, 5.0, 10.0, 30.0]
 )
 
 PROCESSING_TIME = Histogram(
     'llm_processing_seconds',
     'Complete time spent processing messages',
-    ['node_id', 'node_type', 'device_type'],
+    ['node_id', 'node_type', 'device_type', 'precision'],
     buckets=[0.1, 0.5, 1.0, 2.0, 5.0, 10.0, 20.0, 30.0, 60.0, 120.0]
 )
 
+CACHED_PROCESSING_TIME = Histogram(
+    'llm_cached_processing_seconds',
+    'Time spent processing messages answered by the response cache',
+    ['node_id', 'node_type', 'device_type', 'precision', 'result'],
+    buckets=[0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0]
+)
+
+RESPONSE_CACHE_REQUESTS = Counter(
+    'llm_response_cache_requests_total',
+    'Response cache lookups by result (hit, miss, coalesced)',
+    ['node_id', 'node_type', 'device_type', 'precision', 'result']
+)
+
+STREAM_CHUNKS = Counter(
+    'llm_stream_chunks_total',
+    'Partial response chunks published to the output topic',
+    ['node_id', 'node_type', 'device_type', 'precision']
+)
+
 REQUESTS_SUCCESS = Counter(
     'llm_requests_success_total',
     'Successfully completed requests',
-    ['node_id', 'node_type', 'device_type']
+    ['node_id', 'node_type', 'device_type', 'precision']
 )
 
 REQUESTS_FAILED = Counter(
     'llm_requests_failed_total',
     'Failed requests',
-    ['node_id', 'node_type', 'device_type', 'reason']
+    ['node_id', 'node_type', 'device_type', 'precision', 'reason']
 )
 
 INFERENCE_TIME = Histogram(
     'llm_inference_seconds',
     'Time for LLM inference only',
-    ['node_id', 'node_type', 'device_type'],
+    ['node_id', 'node_type', 'device_type', 'precision'],
     buckets=[0.1, 0.5, 1.0, 2.0, 5.0, 10.0, 20.0, 30.0, 60.0]
 )
 
+STAGE_LATENCY = Histogram(
+    'llm_stage_seconds',
+    'Time a request spent in each stage between producer send and result publish',
+    ['node_id', 'node_type', 'device_type', 'precision', 'stage'],
+    buckets=[0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0]
+)
+
+SPEC_ACCEPTANCE_RATE = Histogram(
+    'llm_speculative_acceptance_rate',
+    'Share of draft tokens accepted by the target model per request',
+    ['node_id', 'node_type', 'device_type', 'precision'],
+    buckets=[0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1.0]
+)
+
+SPEC_DRAFT_TOKENS = Counter(
+    'llm_speculative_draft_tokens_total',
+    'Draft tokens proposed for speculative decoding, by verification result',
+    ['node_id', 'node_type', 'device_type', 'precision', 'result']
+)
+
+SPEC_FALLBACKS = Counter(
+    'llm_speculative_fallbacks_total',
+    'Fallbacks to plain decoding due to a low draft acceptance rate',
+    ['node_id', 'node_type', 'device_type', 'precision', 'scope']
+)
+
+SPEC_ENABLED = Gauge(
+    'llm_speculative_enabled',
+    'Whether speculative decoding is currently enabled (0 during fallback cooldown)',
+    ['node_id', 'node_type', 'device_type', 'precision'],
+    multiprocess_mode='livemin'
+)
+
+PRECISION_TOP1_AGREEMENT = Gauge(
+    'llm_precision_top1_agreement',
+    'Share of next-token predictions matching the fp32 reference in the precision spot-check',
+    ['node_id', 'node_type', 'device_type', 'precision'],
+    multiprocess_mode='max'
+)
+
+PRECISION_KL_DIVERGENCE = Gauge(
+    'llm_precision_kl_divergence',
+    'Mean KL divergence from the fp32 reference in the precision spot-check',
+    ['node_id', 'node_type', 'device_type', 'precision'],
+    multiprocess_mode='max'
+)
+
 MODEL_LOAD_TIME = Histogram(
     'llm_model_load_seconds',
     'Time to load the model',
-    ['node_id', 'node_type', 'device_type'],
+    ['node_id', 'node_type', 'device_type', 'precision'],
     buckets=[1.0, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0]
 )
 
+WARMUP_TIME = Gauge(
+    'llm_warmup_seconds',
+    'Time spent on warmup generations before serving',
+    ['node_id', 'node_type', 'device_type', 'precision'],
+    multiprocess_mode='max'
+)
+
+MODEL_SWAPS = Counter(
+    'llm_model_swaps_total',
+    'Model hot swaps, by result (success, failed)',
+    ['node_id', 'node_type', 'device_type', 'precision', 'result']
+)
+
+MODEL_LOADS = Counter(
+    'llm_model_pool_loads_total',
+    'Loads of a hosted model, by where the weights came from (snapshot, pretrained)',
+    ['node_id', 'node_type', 'device_type', 'precision', 'model', 'source']
+)
+
+MODEL_POOL_LOAD_TIME = Histogram(
+    'llm_model_pool_load_seconds',
+    'Time to load and warm up a hosted model on its first request or after an eviction',
+    ['node_id', 'node_type', 'device_type', 'precision', 'model', 'source'],
+    buckets=[0.1, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0]
+)
+
+MODEL_EVICTIONS = Counter(
+    'llm_model_pool_evictions_total',
+    'Hosted models evicted to stay within the memory budget',
+    ['node_id', 'node_type', 'device_type', 'precision', 'model']
+)
+
+MODEL_RESIDENT = Gauge(
+    'llm_model_pool_resident',
+    'Whether a hosted model is loaded, summed over processes',
+    ['node_id', 'node_type', 'device_type', 'precision', 'model'],
+    multiprocess_mode='livesum'
+)
+
+MODEL_RESIDENT_BYTES = Gauge(
+    'llm_model_pool_resident_bytes',
+    'Weight and buffer bytes of a loaded hosted model, summed over processes',
+    ['node_id', 'node_type', 'device_type', 'precision', 'model'],
+    multiprocess_mode='livesum'
+)
+
+SERVICE_READY = Gauge(
+    'llm_service_ready',
+    'Whether the service finished warmup and consumes prompts',
+    ['node_id', 'node_type', 'device_type', 'precision'],
+    multiprocess_mode='livemax'
+)
+
 ACTIVE_PROCESSING = Gauge(
     'llm_active_processing',
     'Number of messages currently being processed',
-    ['node_id', 'node_type', 'device_type']
+    ['node_id', 'node_type', 'device_type', 'precision'],
+    multiprocess_mode='livesum'
 )
 
 QUEUE_DEPTH = Gauge(
     'llm_request_queue_depth',
-    'Number of requests waiting in queue',
-    ['node_id', 'node_type', 'device_type']
+    'Messages consumed from Kafka and not finished yet (local backlog)',
+    ['node_id', 'node_type', 'device_type', 'precision'],
+    multiprocess_mode='livesum'
+)
+
+SCHEDULER_QUEUE_WAIT = Histogram(
+    'llm_scheduler_queue_wait_seconds',
+    'Time messages waited in the local scheduler queue, by policy and prompt length category',
+    ['node_id', 'node_type', 'device_type', 'precision', 'policy', 'length_category'],
+    buckets=[0.001, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.0, 5.0, 10.0, 30.0, 60.0]
+)
+
+SHED_REQUESTS = Counter(
+    'llm_shed_requests_total',
+    'Requests dropped without inference because their deadline had passed',
+    ['node_id', 'node_type', 'device_type', 'precision', 'reason']
+)
+
+QUEUE_AGE = Histogram(
+    'llm_queue_age_seconds',
+    'Age of a request since the producer sent it, when inference starts (served) or it is shed',
+    ['node_id', 'node_type', 'device_type', 'precision', 'result'],
+    buckets=[0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.0, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0]
+)
+
+REQUESTS_LATE = Counter(
+    'llm_requests_late_total',
+    'Requests completed after their deadline',
+    ['node_id', 'node_type', 'device_type', 'precision']
+)
+
+GOODPUT_TOKENS = Counter(
+    'llm_goodput_tokens_total',
+    'Output tokens of requests completed within their deadline',
+    ['node_id', 'node_type', 'device_type', 'precision']
+)
+
+REQUESTS_OFFLOADED = Counter(
+    'llm_requests_offloaded_total',
+    'Requests forwarded to the upstream topic instead of being queued, by the signal over its threshold',
+    ['node_id', 'node_type', 'device_type', 'precision', 'reason']
+)
+
+OFFLOADED_SERVED = Counter(
+    'llm_offloaded_requests_served_total',
+    'Requests served here after another node offloaded them, by that node',
+    ['node_id', 'node_type', 'device_type', 'precision', 'origin']
+)
+
+OFFLOAD_ACTIVE = Gauge(
+    'llm_offload_active',
+    'Whether new requests are currently offloaded',
+    ['node_id', 'node_type', 'device_type', 'precision'],
+    multiprocess_mode='livemax'
+)
+
+OFFLOAD_SIGNAL = Gauge(
+    'llm_offload_signal',
+    'Last value of a signal the offload decision is based on (queue_depth, predicted_wait, ttft_p95)',
+    ['node_id', 'node_type', 'device_type', 'precision', 'signal'],
+    multiprocess_mode='livemax'
+)
+
+OFFLOAD_TRANSITIONS = Counter(
+    'llm_offload_transitions_total',
+    'Switches between serving locally and offloading, by the state switched to',
+    ['node_id', 'node_type', 'device_type', 'precision', 'state']
+)
+
+DIRECT_REQUESTS = Counter(
+    'llm_direct_requests_total',
+    'Requests posted to /generate instead of the input topic, by response mode (unary, stream) and result',
+    ['node_id', 'node_type', 'device_type', 'precision', 'mode', 'result']
+)
+
+DIRECT_REQUEST_TIME = Histogram(
+    'llm_direct_request_seconds',
+    'Time from receiving a /generate request until its response is complete, by response mode',
+    ['node_id', 'node_type', 'device_type', 'precision', 'mode'],
+    buckets=[0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0]
+)
+
+PIPELINE_QUEUE_DEPTH = Gauge(
+    'llm_pipeline_queue_depth',
+    'Items waiting in front of a pipeline stage, or being inferred for the infer stage',
+    ['node_id', 'node_type', 'device_type', 'precision', 'stage'],
+    multiprocess_mode='livesum'
+)
+
+PIPELINE_QUEUE_CAPACITY = Gauge(
+    'llm_pipeline_queue_capacity',
+    'Capacity of the queue in front of a pipeline stage, or of the infer stage',
+    ['node_id', 'node_type', 'device_type', 'precision', 'stage'],
+    multiprocess_mode='livesum'
+)
+
+RESULT_DELIVERY_LATENCY = Histogram(
+    'llm_result_delivery_seconds',
+    'Time from producing a result record until the broker acknowledged it',
+    ['node_id', 'node_type', 'device_type', 'precision'],
+    buckets=[0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0]
+)
+
+RESULT_DELIVERY_FAILURES = Counter(
+    'llm_result_delivery_failures_total',
+    'Records the producer could not deliver within its delivery timeout, after its own retries',
+    ['node_id', 'node_type', 'device_type', 'precision', 'reason']
+)
+
+PRODUCER_QUEUE = Gauge(
+    'llm_producer_queue_messages',
+    'Result records waiting in the producer for delivery',
+    ['node_id', 'node_type', 'device_type', 'precision'],
+    multiprocess_mode='livesum'
+)
+
+CONSUMER_PAUSED = Gauge(
+    'llm_consumer_paused',
+    'Whether consumption is paused because the in-flight window is full',
+    ['node_id', 'node_type', 'device_type', 'precision'],
+    multiprocess_mode='livemax'
+)
+
+CONSUMER_PAUSES = Counter(
+    'llm_consumer_pauses_total',
+    'Times consumption was paused because the in-flight window was full',
+    ['node_id', 'node_type', 'device_type', 'precision']
+)
+
+TOKEN_BUDGET_IN_FLIGHT = Gauge(
+    'llm_token_budget_in_flight',
+    'Tokens (prompt plus max_new_tokens) reserved by admitted requests',
+    ['node_id', 'node_type', 'device_type', 'precision'],
+    multiprocess_mode='livesum'
+)
+
+TOKEN_BUDGET_WAITING = Gauge(
+    'llm_token_budget_waiting',
+    'Number of requests waiting for room in the token budget',
+    ['node_id', 'node_type', 'device_type', 'precision'],
+    multiprocess_mode='livesum'
+)
+
+TOKEN_BUDGET_WAIT_TIME = Histogram(
+    'llm_token_budget_wait_seconds',
+    'Time requests waited for room in the token budget',
+    ['node_id', 'node_type', 'device_type', 'precision'],
+    buckets=[0.001, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.0, 5.0, 10.0, 30.0, 60.0]
+)
+
+BATCH_SIZE = Gauge(
+    'llm_batch_size',
+    'Number of sequences in the running decode batch',
+    ['node_id', 'node_type', 'device_type', 'precision', 'worker'],
+    multiprocess_mode='livesum'
+)
+
+TOPOLOGY_WORKERS = Gauge(
+    'llm_topology_workers',
+    'Number of compute workers',
+    ['node_id', 'node_type', 'device_type', 'precision'],
+    multiprocess_mode='max'
+)
+
+TOPOLOGY_THREADS = Gauge(
+    'llm_topology_threads',
+    'Torch threads per compute worker by pool (intra_op, inter_op)',
+    ['node_id', 'node_type', 'device_type', 'precision', 'worker', 'pool'],
+    multiprocess_mode='max'
+)
+
+TOPOLOGY_CPUS = Gauge(
+    'llm_topology_cpus',
+    'Number of CPUs a compute worker is pinned to, 0 if not pinned',
+    ['node_id', 'node_type', 'device_type', 'precision', 'worker'],
+    multiprocess_mode='max'
+)
+
+TOPOLOGY_NUMA_NODE = Gauge(
+    'llm_topology_numa_node',
+    'NUMA node memory is preferably allocated on, -1 if not bound',
+    ['node_id', 'node_type', 'device_type', 'precision'],
+    multiprocess_mode='max'
+)
+
+PREFIX_CACHE_HITS = Counter(
+    'llm_prefix_cache_hits_total',
+    'Prefills that reused a cached prompt prefix',
+    ['node_id', 'node_type', 'device_type', 'precision']
+)
+
+PREFIX_CACHE_MISSES = Counter(
+    'llm_prefix_cache_misses_total',
+    'Prefills without a cached prompt prefix',
+    ['node_id', 'node_type', 'device_type', 'precision']
+)
+
+PREFIX_CACHE_HIT_TOKENS = Counter(
+    'llm_prefix_cache_hit_tokens_total',
+    'Prompt tokens served from the prefix cache instead of the prefill',
+    ['node_id', 'node_type', 'device_type', 'precision']
+)
+
+PREFIX_CACHE_EVICTED_BYTES = Counter(
+    'llm_prefix_cache_evicted_bytes_total',
+    'Bytes of KV state evicted from the prefix cache',
+    ['node_id', 'node_type', 'device_type', 'precision']
+)
+
+PREFIX_CACHE_BYTES = Gauge(
+    'llm_prefix_cache_bytes',
+    'Bytes of KV state held by the prefix cache',
+    ['node_id', 'node_type', 'device_type', 'precision'],
+    multiprocess_mode='livesum'
 )
 
 TOKENS_PER_SECOND = Gauge(
     'llm_tokens_per_second',
     'Current token generation rate',
-    ['node_id', 'node_type', 'device_type']
+    ['node_id', 'node_type', 'device_type', 'precision'],
+    multiprocess_mode='livesum'
+)
+
+GOODPUT_PER_SECOND = Gauge(
+    'llm_goodput_tokens_per_second',
+    'Current rate of output tokens of requests completed within their deadline',
+    ['node_id', 'node_type', 'device_type', 'precision'],
+    multiprocess_mode='livesum'
 )
 
 MEMORY_USAGE = Gauge(
     'llm_memory_usage_bytes',
     'System memory usage',
-    ['node_id', 'node_type', 'device_type']
+    ['node_id', 'node_type', 'device_type', 'precision'],
+    multiprocess_mode='livemax'
 )
 
 CPU_USAGE = Gauge(
     'llm_cpu_usage_percent',
     'CPU usage percentage',
-    ['node_id', 'node_type', 'device_type']
+    ['node_id', 'node_type', 'device_type', 'precision'],
+    multiprocess_mode='livemax'
+)
+
+PROCESS_PSS = Gauge(
+    'llm_process_pss_bytes',
+    'Proportional set size of the service and its worker processes, shared pages counted once',
+    ['node_id', 'node_type', 'device_type', 'precision'],
+    multiprocess_mode='livemax'
 )
 
 DEVICE_MEMORY = Gauge(
     'llm_device_memory_bytes',
     'Process memory usage',
-    ['node_id', 'node_type', 'device_type']
+    ['node_id', 'node_type', 'device_type', 'precision'],
+    multiprocess_mode='livemax'
 )
 
 GPU_UTILIZATION = Gauge(
     'llm_gpu_utilization_percent',
     'GPU utilization percentage',
-    ['node_id', 'node_type', 'device_type']
+    ['node_id', 'node_type', 'device_type', 'precision'],
+    multiprocess_mode='livemax'
 )
 
 GPU_MEMORY_USAGE = Gauge(
     'llm_gpu_memory_bytes',
     'GPU memory usage',
-    ['node_id', 'node_type', 'device_type']
+    ['node_id', 'node_type', 'device_type', 'precision'],
+    multiprocess_mode='livemax'
 )
 
+LABELS = {
+    'node_id': NODE_ID,
+    'node_type': NODE_TYPE,
+    'device_type': DEVICE_TYPE,
+    'precision': PRECISION
+}
+
 def get_labels():
     """Get standard metric labels from environment variables"""
-    return {
-        'node_id': NODE_ID,
-        'node_type': NODE_TYPE,
-        'device_type': DEVICE_TYPE
-    }
\ No newline at end of file
+    return dict(LABELS)
+
+_bound = {}
+
+def bound(metric, **extra):
+    """
+    Child of a metric with the standard labels and `extra`, resolved on first use
+    and cached, so hot paths skip building label dicts and the metric's lock
+    """
+    key = (metric, tuple(extra.items()))
+    child = _bound.get(key)
+    if child is None:
+        child = _bound[key] = metric.labels(**LABELS, **extra)
+    return child
+
+def metrics_registry():
+    """Registry to expose, aggregating all worker processes in multiprocess mode"""
+    if not MULTIPROCESS:
+        return REGISTRY
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    return registry
+
+def mark_process_dead(pid: int):
+    """Drops the live gauges of an exited worker process"""
+    if MULTIPROCESS:
+        multiprocess.mark_process_dead(pid)
+
+class Samples:
+    """
+    Observations of one labeled histogram, collected without locking (deque
+    appends are atomic) and observed in bulk by the flusher thread
+    """
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+        self._values = deque()
+
+    def observe(self, value: float):
+        self._values.append(value)
+
+    def extend(self, values):
+        self._values.extend(values)
+
+    def flush(self):
+        values = []
+        try:
+            while True:
+                values.append(self._values.popleft())
+        except IndexError:
+            pass
+        observe_many(self.histogram, values)
+
+_samples = {}
+_flusher = None
+_flusher_lock = threading.Lock()
+FLUSH_INTERVAL = 1.0
+
+def samples(histogram, **extra) -> Samples:
+    """Sample buffer of a histogram child with the standard labels and `extra`, flushed every second"""
+    key = (histogram, tuple(extra.items()))
+    buffer = _samples.get(key)
+    if buffer is None:
+        with _flusher_lock:
+            buffer = _samples.get(key)
+            if buffer is None:
+                buffer = _samples[key] = Samples(bound(histogram, **extra))
+            _start_flusher()
+    return buffer
+
+def flush_samples():
+    """Observes all buffered samples now"""
+    for buffer in list(_samples.values()):
+        buffer.flush()
+
+def _flush_loop():
+    while True:
+        time.sleep(FLUSH_INTERVAL)
+        flush_samples()
+
+def _start_flusher():
+    global _flusher
+    if _flusher is None:
+        _flusher = threading.Thread(target=_flush_loop, name='metrics-flusher', daemon=True)
+        _flusher.start()
+
+def _after_fork():
+    # The flusher thread does not survive a fork, samples buffered by the parent stay with it
+    global _flusher
+    _flusher = None
+    for buffer in _samples.values():
+        buffer._values = deque()
+    if _samples:
+        _start_flusher()
+
+os.register_at_fork(after_in_child=_after_fork)
+
+class RateWindow:
+    """
+    Token rates over the last `seconds`, from a ring buffer of (time, tokens, good
+    tokens) per request. Recording is a lock-free deque append, and readers take
+    an atomic copy, so inference threads never wait for the metrics loop.
+    """
+
+    def __init__(self, seconds: float = 10.0, capacity: int = 65536):
+        self.seconds = seconds
+        self._events = deque(maxlen=capacity)
+
+    def record(self, tokens: int, good_tokens: int):
+        self._events.append((time.time(), tokens, good_tokens))
+
+    def rates(self):
+        """(tokens per second, good tokens per second), None if there is nothing to rate"""
+        now = time.time()
+        events = [event for event in self._events.copy() if now - event[0] < self.seconds]
+        if not events:
+            return None
+        time_span = now - events[0][0]
+        if time_span <= 0:
+            return None
+        return (
+            sum(tokens for _, tokens, _ in events) / time_span,
+            sum(good for _, _, good in events) / time_span
+        )
+
+def observe_many(histogram, values):
+    """
+    Observe many values on a labeled histogram with one bucket pass,
+    instead of one locked observe() per value. The bucket pass uses attributes private
+    to prometheus_client; a version without them gets observe() per value.
+    """
+    if not values:
+        return
+    bounds = getattr(histogram, '_upper_bounds', None)
+    buckets = getattr(histogram, '_buckets', None)
+    total = getattr(histogram, '_sum', None)
+    if bounds is None or buckets is None or total is None:
+        for value in values:
+            histogram.observe(value)
+        return
+    counts = [0] * len(bounds)
+    for value in values:
+        counts[bisect_left(bounds, value)] += 1
+    for bucket, count in zip(buckets, counts):
+        if count:
+            bucket.inc(count)
+    total.inc(sum(values))
@@ -0,0 +1,70 @@
+'''
+Metrics micro-benchmark
+-----------------------
+Instrumentation cost per generated token of the ways the inference path has
+recorded inter-token latencies, from one labeled observe() per token to the
+buffered samples that the flusher observes in bulk.
+
+  python metrics_benchmark.py [requests] [tokens per request] [threads]
+'''
+
+import random
+import sys
+import threading
+import time
+
+from benchmark_data import token_latencies
+from metrics import (
+    INTER_TOKEN_LATENCY,
+    bound,
+    flush_samples,
+    get_labels,
+    observe_many,
+    samples
+)
+
+def per_token(latencies):
+  """Labels resolved and a locked observe for every token"""
+  for latency in latencies:
+    INTER_TOKEN_LATENCY.labels(**get_labels()).observe(latency)
+
+def per_request(latencies):
+  """Labels resolved once per request, one bucket pass per request"""
+  observe_many(INTER_TOKEN_LATENCY.labels(**get_labels()), latencies)
+
+def buffered(latencies):
+  """Pre-bound sample buffer, observed in bulk by the flusher"""
+  samples(INTER_TOKEN_LATENCY).extend(latencies)
+
+def run(variant, requests: int, tokens: int, threads: int) -> float:
+  """Nanoseconds of instrumentation per token, including the final flush"""
+  latencies = token_latencies(tokens)
+
+  def worker():
+    for _ in range(requests // threads):
+      variant(latencies)
+
+  workers = [threading.Thread(target=worker) for _ in range(threads)]
+  start = time.perf_counter()
+  for thread in workers:
+    thread.start()
+  for thread in workers:
+    thread.join()
+  flush_samples()
+  elapsed = time.perf_counter() - start
+  return elapsed / ((requests // threads) * threads * tokens) * 1e9
+
+def main():
+  requests = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+  tokens = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+  threads = int(sys.argv[3]) if len(sys.argv) > 3 else 4
+  random.seed(0)
+  bound(INTER_TOKEN_LATENCY)
+
+  print(f"{requests} requests of {tokens} tokens on {threads} threads")
+  print(f"{'variant':<14}{'ns/token':>10}")
+  for name, variant in (('per-token', per_token), ('per-request', per_request), ('buffered', buffered)):
+    print(f"{name:<14}{run(variant, requests, tokens, threads):>10.1f}")
+
+if __name__ == '__main__':
+  main()
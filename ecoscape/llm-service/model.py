@@ -1,15 +1,23 @@
 import logging
 import time
 import torch
-from threading import Thread
+from concurrent.futures import ThreadPoolExecutor
+from threading import Event, Lock
 
 from enum import Enum
+from admission import TokenBudget
+from engine import BatchEngine, GenerationRequest
+from prefix_cache import PrefixCache
+from speculative import SpeculativeDecoder
+from precision import Precision, load_dtype, quantize, run_spot_check
+from snapshot import read_manifest, load_snapshot, snapshot_mismatch, write_snapshot
+from streaming import IncrementalDecoder, TokenIdStreamer
+from topology import ThreadTopology
 from transformers import (
   AutoModelForCausalLM,
   AutoModelForSeq2SeqLM,
   AutoTokenizer,
-  AutoConfig,
-  TextIteratorStreamer
+  AutoConfig
 )
 
 from metrics import (
@@ -20,21 +28,52 @@ from metrics import (
     INPUT_TOKENS,
     GPU_UTILIZATION,
     GPU_MEMORY_USAGE,
-    get_labels
+    SPEC_ACCEPTANCE_RATE,
+    SPEC_ENABLED,
+    STAGE_LATENCY,
+    WARMUP_TIME,
+    bound,
+    get_labels,
+    samples
 )
 
 logger = logging.getLogger(__name__)
 
+DEFAULT_MAX_NEW_TOKENS = 100
+
+_load_lock = Lock()
+
 class ModelType(Enum):
   CAUSAL_LM = "causal"
   SEQ2SEQ = "seq2seq"
 
 class Model:
-  def __init__(self, model_path: str):
+  def __init__(self, model_path: str, max_batch_size: int = 8,
+               prefix_cache_bytes: int = 0, prefix_cache_block_size: int = 16,
+               draft_model_path: str = None, speculative_tokens: int = 4,
+               speculative_min_acceptance: float = 0.3, speculative_cooldown: float = 30.0,
+               precision: str = "auto", precision_check: bool = False,
+               snapshot_path: str = None, token_budget: int = 0, topology: ThreadTopology = None):
     self.model_path = model_path
+    self.snapshot_path = snapshot_path
+    self.precision = Precision(precision)
+    self.precision_check = precision_check
+    self.max_batch_size = max_batch_size
+    self.draft_model_path = draft_model_path
+    self.speculative_tokens = speculative_tokens
+    self.speculative_min_acceptance = speculative_min_acceptance
+    self.speculative_cooldown = speculative_cooldown
+    self.prefix_cache = PrefixCache(prefix_cache_bytes, prefix_cache_block_size) if prefix_cache_bytes > 0 else None
+    self.token_budget = TokenBudget(token_budget) if token_budget > 0 else None
+    self.topology = topology or ThreadTopology()
     self.model = None
     self.tokenizer = None
     self.model_type = None
+    self.engines = []
+    self.generate_pool = None
+    self.draft_model = None
+    self._draft_vocab_size = None
+    self._eager_forward = None
 
   def detect_model_type(self, model_path: str) -> ModelType:
     """Detect if model is Causal LM or Seq2Seq"""
@@ -85,33 +124,74 @@ class Model:
       except Exception as e:
         logger.debug(f"Could not update GPU metrics: {e}")
     
-  def load(self):
-    """Loads model via huggingface and sets modeltype"""
+  def load(self, start_workers: bool = True):
+    """
+    Loads model from its snapshot if there is one, otherwise via huggingface (writing the snapshot).
+    Without `start_workers` no engine threads are started, so the process can fork workers safely.
+    """
+    # Building a model skeleton on the meta device patches torch for all threads, so loads
+    # (hot swaps, hosted models) must not overlap
+    with _load_lock:
+      self._load(start_workers)
+
+  def _load(self, start_workers: bool):
     logger.info(f"Loading model from {self.model_path}")
     start_time = time.time()
 
     try:
-      self.model_type = self.detect_model_type(self.model_path)
+      dtype = load_dtype(self.precision)
+      manifest = read_manifest(self.snapshot_path) if self.snapshot_path else None
+      if manifest and manifest['dtype'] != str(dtype).replace('torch.', ''):
+        logger.warning(f"Snapshot at {self.snapshot_path} holds {manifest['dtype']} weights, "
+                       f"precision {self.precision.value} needs {dtype}. Ignoring snapshot")
+        manifest = None
+      mismatch = snapshot_mismatch(manifest, self.model_path) if manifest else None
+      if mismatch:
+        # Rebuilt from the model below
+        logger.warning(f"Snapshot at {self.snapshot_path} does not match the model, {mismatch}. Ignoring snapshot")
+        manifest = None
+
+      if manifest:
+        # Model type and tokenizer come from the snapshot, no config sniffing needed
+        self.model_type = ModelType(manifest['model_type'])
+        self.tokenizer = AutoTokenizer.from_pretrained(self.snapshot_path)
+      else:
+        self.model_type = self.detect_model_type(self.model_path)
+        self.tokenizer = AutoTokenizer.from_pretrained(self.model_path)
       logger.info(f"Model type: {self.model_type.value}")
-      self.tokenizer = AutoTokenizer.from_pretrained(self.model_path)
-      
-      if self.model_type == ModelType.SEQ2SEQ:
-        self.model = AutoModelForSeq2SeqLM.from_pretrained(
-          self.model_path,
-          torch_dtype=torch.float16 if torch.cuda.is_available() else torch.float32,
-          device_map="auto" if torch.cuda.is_available() else None,
-          low_cpu_mem_usage=True
-        )
+      logger.info(f"Precision: {self.precision.value}")
+      model_cls = AutoModelForSeq2SeqLM if self.model_type == ModelType.SEQ2SEQ else AutoModelForCausalLM
+
+      if manifest:
+        logger.info(f"Mapping weights from snapshot {self.snapshot_path}")
+        model = load_snapshot(self.snapshot_path, model_cls, manifest)
+        if torch.cuda.is_available():
+          model = model.to('cuda')
       else:
-        if self.tokenizer.pad_token is None:
-            self.tokenizer.pad_token = self.tokenizer.eos_token
-        
-        self.model = AutoModelForCausalLM.from_pretrained(
+        model = model_cls.from_pretrained(
           self.model_path,
-          torch_dtype=torch.float16 if torch.cuda.is_available() else torch.float32,
+          torch_dtype=dtype,
           device_map="auto" if torch.cuda.is_available() else None,
           low_cpu_mem_usage=True
         )
+        if self.snapshot_path:
+          try:
+            write_snapshot(
+              model, self.tokenizer, self.model_type.value, self.precision.value, self.snapshot_path, self.model_path
+            )
+          except Exception as e:
+            logger.warning(f"Could not write model snapshot: {e}")
+
+      if self.model_type == ModelType.CAUSAL_LM and self.tokenizer.pad_token is None:
+        self.tokenizer.pad_token = self.tokenizer.eos_token
+      self.model = quantize(model, self.precision)
+      if self.precision_check and self.precision not in (Precision.AUTO, Precision.FP32):
+        run_spot_check(model_cls, self.model_path, self.model, self.tokenizer)
+
+      if self.draft_model_path and self.model_type == ModelType.CAUSAL_LM:
+        self.load_draft()
+      if start_workers:
+        self.start_workers()
 
       load_time = time.time() - start_time
       labels = get_labels()
@@ -122,86 +202,274 @@ class Model:
       logger.error(f"Failed to load model: {e}")
       raise
   
-  def generate(self, prompt: str, max_new_tokens: int = 100):
+  def start_workers(self):
+    """Starts the batching engines, or the generate worker threads for seq2seq models"""
+    if self.model_type == ModelType.CAUSAL_LM:
+      # One engine per worker, all sharing the weights and the prefix cache
+      self.engines = [
+        BatchEngine(
+          self.model,
+          self._eos_token_ids(),
+          self.max_batch_size,
+          prefix_cache=self.prefix_cache,
+          speculative=self._speculative_decoder() if self.draft_model is not None else None,
+          worker=worker,
+          thread_init=lambda worker=worker: self.topology.bind_worker(worker)
+        )
+        for worker in range(self.topology.workers)
+      ]
+      for engine in self.engines:
+        engine.start()
+    else:
+      # model.generate runs on a fixed set of pinned worker threads
+      self.generate_pool = ThreadPoolExecutor(
+        max_workers=self.topology.workers,
+        thread_name_prefix='generate',
+        initializer=self.topology.bind_next
+      )
+
+  def load_draft(self) -> bool:
+    """Loads the draft model for speculative decoding, False if it can't draft for the target"""
+    logger.info(f"Loading draft model from {self.draft_model_path}")
+    draft_tokenizer = AutoTokenizer.from_pretrained(self.draft_model_path)
+    if draft_tokenizer.get_vocab() != self.tokenizer.get_vocab():
+      logger.warning("Draft model uses a different vocabulary, speculative decoding disabled")
+      return False
+
+    self.draft_model = quantize(
+      AutoModelForCausalLM.from_pretrained(
+        self.draft_model_path,
+        torch_dtype=load_dtype(self.precision),
+        low_cpu_mem_usage=True
+      ).to(self.model.device),
+      self.precision
+    )
+    SPEC_ENABLED.labels(**get_labels()).set(1)
+
+    # Embedding matrices may be padded differently, only compare real token ids
+    self._draft_vocab_size = min(self.model.config.vocab_size, self.draft_model.config.vocab_size, len(self.tokenizer))
+    return True
+
+  def _speculative_decoder(self) -> SpeculativeDecoder:
+    """Draft/verify state for one engine, the draft weights are shared"""
+    return SpeculativeDecoder(
+      self.draft_model,
+      self._draft_vocab_size,
+      num_tokens=self.speculative_tokens,
+      min_acceptance=self.speculative_min_acceptance,
+      cooldown=self.speculative_cooldown
+    )
+
+  def compile(self):
+    """Wraps the model forward in torch.compile, compilation happens lazily on first use"""
+    logger.info("Compiling model forward with torch.compile")
+    self._eager_forward = self.model.forward
+    self.model.forward = torch.compile(self.model.forward, dynamic=True)
+
+  def warmup(self, lengths, max_new_tokens: int = 8):
     """
-    Generate response with ACCURATE TTFT and ITL using streaming.
-    
-    This implementation uses TextIteratorStreamer to capture precise timing
-    for each token as it's generated, providing accurate TTFT and ITL measurements.
+    Runs throwaway generations for several input lengths, one at a time and as one batch,
+    so lazy kernel init, allocator growth and torch.compile happen before serving.
+    Falls back to eager mode if the compiled model fails.
     """
-    device = "cuda" if torch.cuda.is_available() else "cpu"
-    labels = get_labels()
-    
-    # Tokenize input
+    start = time.time()
+    try:
+      self._run_warmup(lengths, max_new_tokens)
+    except Exception as e:
+      if self._eager_forward is None:
+        raise
+      logger.warning(f"Compiled model failed during warmup ({e}), falling back to eager mode")
+      self.model.forward, self._eager_forward = self._eager_forward, None
+      self._run_warmup(lengths, max_new_tokens)
+
+    warmup_time = time.time() - start
+    WARMUP_TIME.labels(**get_labels()).set(warmup_time)
+    logger.info(f"Warmup over input lengths {list(lengths)} done in {warmup_time:.2f} seconds")
+
+  def _run_warmup(self, lengths, max_new_tokens: int):
+    filler = self.tokenizer("The quick brown fox jumps over the lazy dog. ", add_special_tokens=False)['input_ids']
+    prompts = []
+    for length in lengths:
+      ids = (filler * (length // len(filler) + 1))[:length]
+      # Exercise the tokenizer on the same text the warmup prompt decodes to
+      self.tokenizer(self.tokenizer.decode(ids), truncation=True, max_length=512)
+      prompts.append(torch.tensor([ids], dtype=torch.long))
+
+    if not self.engines:
+      def generate(input_ids):
+        with torch.inference_mode():
+          self.model.generate(
+            input_ids=input_ids.to(self.model.device),
+            max_new_tokens=max_new_tokens,
+            pad_token_id=self.tokenizer.eos_token_id
+          )
+
+      # Enough rounds for every pool thread to initialize its own intra-op pool
+      list(self.generate_pool.map(generate, prompts * self.topology.workers))
+      return
+
+    # Every engine warms up on its own thread and CPUs
+    for engine in self.engines:
+      def request(input_ids):
+        return engine.submit(GenerationRequest(
+          input_ids=input_ids,
+          max_new_tokens=max_new_tokens,
+          use_prefix_cache=False
+        ))
+
+      for input_ids in prompts:
+        request(input_ids).wait()
+      for pending in [request(input_ids) for input_ids in prompts]:
+        pending.wait()
+
+  def close(self):
+    """Stops the batching engines and the generate workers, requests still queued for a worker fail"""
+    for engine in self.engines:
+      engine.stop()
+    self.engines = []
+    if self.generate_pool is not None:
+      self.generate_pool.shutdown(wait=False, cancel_futures=True)
+      self.generate_pool = None
+
+  def _eos_token_ids(self) -> list:
+    eos = self.model.generation_config.eos_token_id
+    if eos is None:
+      eos = self.tokenizer.eos_token_id
+    return list(eos) if isinstance(eos, (list, tuple)) else [eos]
+
+  def sampling_params(self) -> dict:
+    """Sampling parameters from the model's generation config, like model.generate would use"""
+    gen_config = self.model.generation_config
+    return {
+      'do_sample': bool(gen_config.do_sample),
+      'temperature': gen_config.temperature if gen_config.temperature is not None else 1.0,
+      'top_k': gen_config.top_k or 0,
+      'top_p': gen_config.top_p if gen_config.top_p is not None else 1.0
+    }
+
+  def generate(self, prompt: str, max_new_tokens: int = DEFAULT_MAX_NEW_TOKENS, stream=None,
+               sampling: dict = None, stages: dict = None):
+    """
+    Generate a response, via the batching engine for causal LMs and model.generate otherwise.
+    If a ChunkCoalescer is given as `stream`, partial text is fed to it while decoding.
+    `sampling` overrides the sampling parameters of the model's generation config.
+    If a dict is given as `stages`, the duration of every stage is stored in it.
+    """
+    tokenize_start = time.perf_counter()
     inputs = self.tokenizer(
             prompt,
             return_tensors='pt',
             truncation=True,
             max_length=512
-        ).to(device)
+        )
 
+    tokenize_end = time.perf_counter()
     input_length = inputs['input_ids'].shape[1]
-    INPUT_TOKENS.labels(**labels).inc(input_length)
+    bound(INPUT_TOKENS).inc(input_length)
 
-    # Setup streaming
-    streamer = TextIteratorStreamer(
-        self.tokenizer,
-        skip_prompt=True,  # Don't return the prompt in output
-        skip_special_tokens=True
+    request = GenerationRequest(
+      input_ids=inputs['input_ids'],
+      max_new_tokens=max_new_tokens,
+      progress=Event() if stream is not None else None,
+      **(sampling or self.sampling_params())
     )
-    
-    generation_config = {
-        "max_new_tokens": max_new_tokens,
-        "pad_token_id": self.tokenizer.eos_token_id,
-        "streamer": streamer
-    }
-    
-    # Merge inputs and generation config
-    generation_kwargs = {**inputs, **generation_config}
-    
-    # Start generation in separate thread
-    inference_start = time.time()
-    thread = Thread(target=self.model.generate, kwargs=generation_kwargs)
-    thread.start()
-    
-    # Track token generation timing
-    first_token_time = None
-    last_token_time = inference_start
-    response_parts = []
-    token_count = 0
-    
-    try:
-        for text_chunk in streamer:
-            current_time = time.time()
-            
-            if first_token_time is None:
-                # First token received - record TTFT
-                first_token_time = current_time
-                ttft = first_token_time - inference_start
-                TTFT.labels(**labels).observe(ttft)
-                logger.debug(f"TTFT: {ttft:.3f}s")
-            else:
-                # Subsequent tokens - record ITL
-                itl = current_time - last_token_time
-                INTER_TOKEN_LATENCY.labels(**labels).observe(itl)
-            
-            last_token_time = current_time
-            response_parts.append(text_chunk)
-            token_count += 1
-    
-    except Exception as e:
-        logger.error(f"Error during streaming generation: {e}")
-        raise
-    finally:
-        thread.join()
-    
-    inference_time = time.time() - inference_start
-    INFERENCE_TIME.labels(**labels).observe(inference_time)
-    
-    # Combine response
-    response = ''.join(response_parts)
-    
-    # Update GPU metrics
+    # Time spent waiting for the token budget counts towards TTFT and inference time
+    if self.token_budget is None:
+      self._run_request(request, inputs, stream)
+    else:
+      with self.token_budget.reserve(input_length + max_new_tokens):
+        self._run_request(request, inputs, stream)
+
+    # TTFT and ITL from the exact per-token timestamps, buffered and observed in bulk
+    token_times = request.tokens.times()
+    if token_times:
+      samples(TTFT).observe(token_times[0] - request.submitted_at)
+      samples(INTER_TOKEN_LATENCY).extend(
+        [current - previous for previous, current in zip(token_times, token_times[1:])]
+      )
+
+    inference_time = request.finished_at - request.submitted_at
+    samples(INFERENCE_TIME).observe(inference_time)
+    if request.draft_proposed:
+      samples(SPEC_ACCEPTANCE_RATE).observe(request.draft_accepted / request.draft_proposed)
+
+    # Detokenize once, at the end
+    response = self.tokenizer.decode(request.output_ids, skip_special_tokens=True)
+    detokenize_end = time.perf_counter()
     self.update_gpu_metrics()
-    
-    return response.strip(), inference_time, token_count, input_length
\ No newline at end of file
+
+    # Prefill lasts until the first token, decode from there until the request finished
+    first_token_at = token_times[0] if token_times else request.finished_at
+    started_at = request.started_at or request.submitted_at
+    durations = {
+      'tokenize': tokenize_end - tokenize_start,
+      'admission': started_at - request.submitted_at,
+      'prefill': first_token_at - started_at,
+      'decode': request.finished_at - first_token_at,
+      'detokenize': detokenize_end - request.finished_at
+    }
+    for stage, duration in durations.items():
+      samples(STAGE_LATENCY, stage=stage).observe(duration)
+    if stages is not None:
+      stages.update(durations)
+
+    return response.strip(), inference_time, len(request.tokens), input_length
+
+  def _run_request(self, request: GenerationRequest, inputs, stream):
+    """Runs a request to completion"""
+    if self.engines:
+      min(self.engines, key=lambda engine: engine.load()).submit(request)
+    else:
+      self._start_generate_thread(request, inputs)
+
+    if stream is not None:
+      self._stream_tokens(request, stream)
+    request.wait()
+
+  def _start_generate_thread(self, request: GenerationRequest, inputs):
+    """Runs model.generate for models without batching engine (seq2seq), recording token ids"""
+    streamer = TokenIdStreamer(request, skip_ids=self.tokenizer.all_special_ids)
+    generation_kwargs = {
+      **inputs.to(self.model.device),
+      "max_new_tokens": request.max_new_tokens,
+      "pad_token_id": self.tokenizer.eos_token_id,
+      "do_sample": request.do_sample and request.temperature > 0,
+      "streamer": streamer
+    }
+    if generation_kwargs["do_sample"]:
+      generation_kwargs.update(temperature=request.temperature, top_k=request.top_k, top_p=request.top_p)
+
+    def run():
+      request.started_at = time.perf_counter()
+      try:
+        self.model.generate(**generation_kwargs)
+      except Exception as e:
+        logger.error(f"Error during generation: {e}")
+        request.error = e
+        streamer.end()
+
+    def cancelled(future):
+      # Dropped from the queue by close() before a worker picked it up
+      if future.cancelled():
+        request.error = RuntimeError('Generate workers stopped')
+        streamer.end()
+
+    self.generate_pool.submit(run).add_done_callback(cancelled)
+
+  def _stream_tokens(self, request: GenerationRequest, stream):
+    """Feeds the tokens of a running request into a chunk coalescer"""
+    decoder = IncrementalDecoder(self.tokenizer)
+    emitted = 0
+    while True:
+      request.progress.clear()
+      finished = request.done.is_set()
+      count = len(request.tokens)
+      if count > emitted:
+        stream.add(decoder.delta(request.tokens.ids(count)), count - emitted)
+        emitted = count
+      else:
+        stream.tick()
+      if finished:
+        break
+      request.progress.wait(timeout=stream.max_interval)
+    stream.flush()
@@ -0,0 +1,192 @@
+'''
+Model pool
+----------
+Models hosted next to the serving model (MODEL_PATH), requested by name with a
+message's 'model' field or header. They are loaded on first use and stay resident
+while they fit into the memory budget together with the serving model; to make
+room, the least recently used models that no request is using are evicted.
+
+With a snapshot directory, every model gets a memory-mapped snapshot there on
+its first load, so reloading an evicted model maps its weights instead of
+converting them again (see snapshot.py). With worker processes, every process
+keeps its own residency, the mapped weight pages are shared between them.
+'''
+
+import gc
+import logging
+import os
+import threading
+import time
+
+from collections import OrderedDict
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import Callable, Dict, Optional
+
+from model import Model
+from snapshot import WEIGHT_SUFFIXES, read_manifest, snapshot_mismatch
+from metrics import MODEL_EVICTIONS, MODEL_LOADS, MODEL_POOL_LOAD_TIME, MODEL_RESIDENT, MODEL_RESIDENT_BYTES, bound
+
+logger = logging.getLogger(__name__)
+
+def tensor_bytes(tensor) -> int:
+  """Bytes of a tensor, of the inner tensors for tensor subclasses such as torchao's quantized weights"""
+  if hasattr(tensor, '__tensor_flatten__'):
+    names, _ = tensor.__tensor_flatten__()
+    return sum(tensor_bytes(getattr(tensor, name)) for name in names)
+  return tensor.numel() * tensor.element_size()
+
+def model_bytes(model: Model) -> int:
+  """
+  Bytes of the weights and buffers of a loaded model, including its draft model.
+  Dynamically quantized layers keep their int8 weights packed outside of parameters()
+  """
+  total = 0
+  for module in (model.model, model.draft_model):
+    if module is None:
+      continue
+    for tensor in list(module.parameters()) + list(module.buffers()):
+      total += tensor_bytes(tensor)
+    for layer in module.modules():
+      packed = getattr(layer, '_packed_params', None)
+      if packed is not None and hasattr(packed, '_weight_bias'):
+        total += sum(tensor_bytes(tensor) for tensor in packed._weight_bias() if tensor is not None)
+  return total
+
+def weight_file_bytes(path: str) -> int:
+  """Size of the weight files in a model directory, what loading it is expected to need"""
+  if not path or not os.path.isdir(path):
+    return 0
+  return sum(
+    os.path.getsize(os.path.join(path, name)) for name in os.listdir(path) if name.endswith(WEIGHT_SUFFIXES)
+  )
+
+@dataclass
+class PooledModel:
+  name: str
+  path: str
+  snapshot_path: Optional[str] = None
+  model: Optional[Model] = None
+  bytes: int = 0
+  users: int = 0
+  loading: threading.Lock = field(default_factory=threading.Lock)
+
+class ModelPool:
+  """
+  `create(path, snapshot_path)` builds an unloaded Model, `prepare(model)` compiles and
+  warms up a loaded one like the serving model, `pinned_bytes()` is the memory of the
+  serving model, which is never evicted. A budget of 0 is unlimited.
+  """
+
+  def __init__(self, create: Callable[[str, str], Model], models: Dict[str, str], budget: int = 0,
+               snapshot_dir: str = None, pinned_bytes: Callable[[], int] = lambda: 0,
+               prepare: Callable[[Model], None] = None):
+    self.create = create
+    self.prepare = prepare
+    self.budget = budget
+    self.pinned_bytes = pinned_bytes
+    self._entries = {
+      name: PooledModel(name, path, os.path.join(snapshot_dir, name) if snapshot_dir else None)
+      for name, path in models.items()
+    }
+    # Resident models, least recently used first
+    self._lru = OrderedDict()
+    self._lock = threading.Lock()
+
+  def __contains__(self, name: str) -> bool:
+    return name in self._entries
+
+  @contextmanager
+  def acquire(self, name: str):
+    """The model hosted as `name`, loaded if it is not resident. It is not evicted while in use"""
+    entry = self._entries.get(name)
+    if entry is None:
+      raise ValueError(f"Model '{name}' is not hosted here")
+    with self._lock:
+      entry.users += 1
+    try:
+      with entry.loading:
+        if entry.model is None:
+          self._load(entry)
+      with self._lock:
+        self._lru.move_to_end(name)
+      yield entry.model
+    finally:
+      with self._lock:
+        entry.users -= 1
+
+  def _load(self, entry: PooledModel):
+    # Make room before loading, by what the model took last time or the size of its weight files
+    self._evict(entry.bytes or weight_file_bytes(entry.snapshot_path) or weight_file_bytes(entry.path), entry.name)
+    manifest = read_manifest(entry.snapshot_path) if entry.snapshot_path else None
+    source = 'snapshot' if manifest and not snapshot_mismatch(manifest, entry.path) else 'pretrained'
+    start = time.time()
+    model = self.create(entry.path, entry.snapshot_path)
+    model.load()
+    # Requests on a freshly loaded model must not pay for compiling and warming it up
+    if self.prepare is not None:
+      self.prepare(model)
+    entry.bytes = model_bytes(model)
+    with self._lock:
+      entry.model = model
+      self._lru[entry.name] = entry
+
+    bound(MODEL_POOL_LOAD_TIME, model=entry.name, source=source).observe(time.time() - start)
+    bound(MODEL_LOADS, model=entry.name, source=source).inc()
+    bound(MODEL_RESIDENT, model=entry.name).set(1)
+    bound(MODEL_RESIDENT_BYTES, model=entry.name).set(entry.bytes)
+    logger.info(f"Model {entry.name} resident ({entry.bytes / 2**20:.0f} MiB, from {source})")
+    # The estimate may have been short
+    self._evict(0, entry.name)
+
+  def _resident_bytes(self) -> int:
+    return self.pinned_bytes() + sum(entry.bytes for entry in self._lru.values())
+
+  def _evict(self, needed: int, keep: str):
+    """Evicts idle models, least recently used first, until `needed` more bytes fit into the budget"""
+    if self.budget <= 0:
+      return
+    victims = []
+    with self._lock:
+      for name, entry in list(self._lru.items()):
+        if self._resident_bytes() + needed <= self.budget:
+          break
+        if name == keep or entry.users:
+          continue
+        del self._lru[name]
+        victims.append((entry, entry.model))
+        entry.model = None
+      over = self._resident_bytes() + needed - self.budget
+
+    for entry, model in victims:
+      model.close()
+      bound(MODEL_EVICTIONS, model=entry.name).inc()
+      bound(MODEL_RESIDENT, model=entry.name).set(0)
+      bound(MODEL_RESIDENT_BYTES, model=entry.name).set(0)
+      logger.info(f"Evicted model {entry.name} ({entry.bytes / 2**20:.0f} MiB)")
+    if victims:
+      # Drop the last references to the evicted weights before collecting
+      del entry, model
+      victims.clear()
+      gc.collect()
+    if over > 0:
+      logger.warning(f"Models in use exceed the memory budget by {over / 2**20:.0f} MiB")
+
+  def status(self) -> dict:
+    with self._lock:
+      return {
+        name: {'path': entry.path, 'resident': entry.model is not None, 'bytes': entry.bytes, 'users': entry.users}
+        for name, entry in self._entries.items()
+      }
+
+  def resident(self) -> list:
+    with self._lock:
+      return list(self._lru)
+
+  def close(self):
+    with self._lock:
+      entries = list(self._lru.values())
+      self._lru.clear()
+    for entry in entries:
+      entry.model.close()
+      entry.model = None
@@ -0,0 +1,87 @@
+'''
+Offloading
+----------
+An edge node under load forwards new prompts to an upstream topic (usually the
+cloud's input topic) instead of queueing them. Offloading starts as soon as one
+signal passes its threshold and stops once every signal is back below
+`resume_ratio` of its threshold and offloading lasted at least `min_seconds`,
+so the node does not flap around a threshold:
+
+  queue_depth     messages waiting in the scheduler
+  predicted_wait  queue_depth / inference slots * mean service time
+  ttft_p95        95th percentile of the recent times to first token, from receipt
+
+Forwarded messages keep their value and headers and gain 'offloaded_by' and
+'offloaded_at' headers. The serving node never offloads them again and reports
+the origin and the extra hop with their results.
+'''
+
+import time
+
+from load import LoadTracker
+from metrics import OFFLOAD_ACTIVE, OFFLOAD_SIGNAL, OFFLOAD_TRANSITIONS, bound
+
+OFFLOADED_BY_HEADER = 'offloaded_by'
+OFFLOADED_AT_HEADER = 'offloaded_at'
+
+class OffloadController:
+  """
+  Decides whether new prompts are offloaded, from the service's load tracker.
+  Thresholds of 0 disable a signal. `update` runs on the thread that schedules messages.
+  """
+
+  def __init__(self, load: LoadTracker, max_queue_depth: int = 0, max_wait: float = 0.0, max_ttft_p95: float = 0.0,
+               resume_ratio: float = 0.7, min_seconds: float = 5.0):
+    self.load = load
+    self.thresholds = {
+      'queue_depth': max_queue_depth,
+      'predicted_wait': max_wait,
+      'ttft_p95': max_ttft_p95
+    }
+    self.resume_ratio = resume_ratio
+    self.min_seconds = min_seconds
+    self.active = False
+    self.reason = None
+    self._since = 0.0
+    self._active = bound(OFFLOAD_ACTIVE)
+    self._signals = {name: bound(OFFLOAD_SIGNAL, signal=name) for name in self.thresholds}
+
+  @property
+  def enabled(self) -> bool:
+    return any(threshold > 0 for threshold in self.thresholds.values())
+
+  def signals(self, queue_depth: int, slots: int) -> dict:
+    return {
+      'queue_depth': queue_depth,
+      'predicted_wait': self.load.predicted_wait(queue_depth, slots),
+      'ttft_p95': self.load.ttft_p95() if self.thresholds['ttft_p95'] > 0 else None
+    }
+
+  def update(self, queue_depth: int, slots: int) -> bool:
+    """Re-evaluates the signals for the local queue, returns whether to offload"""
+    values = self.signals(queue_depth, slots)
+    for name, value in values.items():
+      if value is not None:
+        self._signals[name].set(value)
+
+    over = [
+      name for name, threshold in self.thresholds.items()
+      if threshold > 0 and values[name] is not None and values[name] > threshold
+    ]
+    now = time.monotonic()
+    if not self.active and over:
+      self.active, self.reason, self._since = True, over[0], now
+      bound(OFFLOAD_TRANSITIONS, state='offloading').inc()
+      self._active.set(1)
+    elif self.active and not over and now - self._since >= self.min_seconds:
+      recovered = all(
+        threshold <= 0 or values[name] is None or values[name] <= self.resume_ratio * threshold
+        for name, threshold in self.thresholds.items()
+      )
+      if recovered:
+        self.active, self.reason = False, None
+        bound(OFFLOAD_TRANSITIONS, state='local').inc()
+        self._active.set(0)
+    elif self.active and over:
+      self.reason = over[0]
+    return self.active
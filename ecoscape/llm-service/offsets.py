@@ -0,0 +1,79 @@
+import threading
+
+from collections import deque
+from confluent_kafka import TopicPartition
+
+class OffsetTracker:
+  """
+  Tracks consumed messages until they are processed, so only offsets of
+  finished messages are stored for commit.
+
+  Messages of a partition may finish out of order; the committable offset of
+  a partition only advances over a contiguous run of finished messages, so a
+  crash never skips a message that was still in flight.
+  """
+
+  def __init__(self):
+    self._pending = {}    # (topic, partition) -> deque of offsets in consume order
+    self._finished = {}   # (topic, partition) -> set of finished offsets not yet contiguous
+    self._changed = set()
+    self._count = 0
+    self._lock = threading.Lock()
+
+  def add(self, topic: str, partition: int, offset: int):
+    with self._lock:
+      key = (topic, partition)
+      self._pending.setdefault(key, deque()).append(offset)
+      self._finished.setdefault(key, set())
+      self._count += 1
+
+  def done(self, topic: str, partition: int, offset: int):
+    with self._lock:
+      self._count -= 1
+      key = (topic, partition)
+      pending = self._pending.get(key)
+      # Skip messages of partitions revoked since they were consumed
+      if pending and offset >= pending[0]:
+        self._finished[key].add(offset)
+        self._changed.add(key)
+
+  def failed(self, topic: str, partition: int, offset: int):
+    """
+    A message that could not be finished (its result was not delivered): no longer in flight,
+    but its offset is never committed, so neither are later ones of its partition. The
+    message and those after it are consumed again after a restart or rebalance
+    """
+    with self._lock:
+      self._count -= 1
+
+  def in_flight(self) -> int:
+    """Messages consumed and not finished yet"""
+    return self._count
+
+  def committable(self) -> list:
+    """Offsets to store for every partition whose low watermark advanced since the last call"""
+    offsets = []
+    with self._lock:
+      for key in self._changed:
+        pending, finished = self._pending[key], self._finished[key]
+        last = None
+        while pending and pending[0] in finished:
+          last = pending.popleft()
+          finished.discard(last)
+        if last is not None:
+          # A committed offset names the next message to consume
+          offsets.append(TopicPartition(key[0], key[1], last + 1))
+      self._changed.clear()
+    return offsets
+
+  def revoke(self, partitions):
+    """
+    Stops tracking offsets of revoked partitions, their unfinished messages will be
+    redelivered elsewhere. They still count as in flight until they finish here.
+    """
+    with self._lock:
+      for partition in partitions:
+        key = (partition.topic, partition.partition)
+        self._pending.pop(key, None)
+        self._finished.pop(key, None)
+        self._changed.discard(key)
@@ -0,0 +1,43 @@
+'''
+Staged pipeline
+---------------
+The service's I/O path runs as stages on one asyncio event loop:
+
+  ingest -> decode -> schedule -> infer -> serialize -> produce
+
+Kafka calls that block run on their own single-thread executors and inference
+on the inference executor (or the worker processes), so decoding, serializing
+and producing never run on an inference thread. Stages are connected by
+bounded queues; a full queue stalls the stage in front of it, and the in-flight
+window pauses the consumer before the backlog reaches Kafka's side again.
+'''
+
+import asyncio
+
+from metrics import PIPELINE_QUEUE_CAPACITY, PIPELINE_QUEUE_DEPTH, get_labels
+
+class StageQueue(asyncio.Queue):
+  """Bounded queue in front of a pipeline stage that exports its occupancy"""
+
+  def __init__(self, stage: str, maxsize: int):
+    super().__init__(maxsize)
+    self.stage = stage
+    labels = get_labels()
+    self._depth = PIPELINE_QUEUE_DEPTH.labels(**labels, stage=stage)
+    PIPELINE_QUEUE_CAPACITY.labels(**labels, stage=stage).set(maxsize)
+
+  def _put(self, item):
+    super()._put(item)
+    self._depth.set(self.qsize())
+
+  def _get(self):
+    item = super()._get()
+    self._depth.set(self.qsize())
+    return item
+
+def put_threadsafe(queue: asyncio.Queue, item, loop: asyncio.AbstractEventLoop):
+  """
+  Puts an item from a thread outside the event loop, blocking while the queue is
+  full. Items put by one thread keep their order.
+  """
+  asyncio.run_coroutine_threadsafe(queue.put(item), loop).result()
@@ -0,0 +1,142 @@
+'''
+CPU precision modes
+-------------------
+Resolves the PRECISION setting into a load dtype plus an optional post-load
+quantization step, and provides a quality spot-check of a reduced precision
+model against its fp32 reference on a fixed prompt set.
+
+Offline usage: python precision.py <model_path> <precision>
+'''
+
+import gc
+import logging
+import sys
+import torch
+
+from enum import Enum
+
+from metrics import PRECISION_TOP1_AGREEMENT, PRECISION_KL_DIVERGENCE, get_labels
+
+logger = logging.getLogger(__name__)
+
+class Precision(Enum):
+  AUTO = "auto"  # fp16 on CUDA, fp32 on CPU
+  FP32 = "fp32"
+  BF16 = "bf16"
+  INT8_DYNAMIC = "int8-dynamic"
+  INT8_WEIGHT_ONLY = "int8-weight-only"
+
+SPOT_CHECK_PROMPTS = [
+  "Instruction: Give three tips for staying healthy.",
+  "Instruction: Translate the following sentence into French.\nInput: The weather is nice today.",
+  "Instruction: Explain why the sky is blue.",
+  "Instruction: Write a short poem about the sea.",
+  "Instruction: Summarize the following text.\nInput: Edge computing moves computation closer to the data source to reduce latency and bandwidth usage.",
+]
+SPOT_CHECK_TOKENS = 32
+
+def load_dtype(precision: Precision) -> torch.dtype:
+  """Dtype to pass to from_pretrained, quantized modes start from fp32 weights"""
+  if precision == Precision.AUTO:
+    return torch.float16 if torch.cuda.is_available() else torch.float32
+  if precision == Precision.BF16:
+    return torch.bfloat16
+  return torch.float32
+
+def quantize(model, precision: Precision):
+  """Applies post-load int8 quantization to all linear layers, if requested"""
+  if precision not in (Precision.INT8_DYNAMIC, Precision.INT8_WEIGHT_ONLY):
+    return model
+  if torch.cuda.is_available():
+    raise ValueError(f"Precision {precision.value} is only supported on CPU")
+
+  if precision == Precision.INT8_DYNAMIC:
+    # int8 weights, activations quantized on the fly per batch
+    return torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+
+  try:
+    from torchao.quantization import quantize_, int8_weight_only
+  except ImportError as e:
+    raise RuntimeError(f"Precision {precision.value} requires torchao: {e}")
+  quantize_(model, int8_weight_only())
+  return model
+
+def _teacher_forced_logits(model, inputs, target_ids: torch.Tensor) -> torch.Tensor:
+  """Logits predicting each of target_ids, given the prompt and all previous targets"""
+  inputs = {k: v.to(model.device) for k, v in inputs.items()}
+  target_ids = target_ids.to(model.device)
+  if model.config.is_encoder_decoder:
+    start = torch.full((1, 1), model.config.decoder_start_token_id, dtype=torch.long, device=model.device)
+    decoder_input_ids = torch.cat([start, target_ids[:, :-1]], dim=1)
+    return model(**inputs, decoder_input_ids=decoder_input_ids).logits[0].float().cpu()
+
+  prompt_length = inputs['input_ids'].shape[1]
+  input_ids = torch.cat([inputs['input_ids'], target_ids], dim=1)
+  logits = model(input_ids=input_ids, attention_mask=torch.ones_like(input_ids)).logits[0]
+  return logits[prompt_length - 1:-1].float().cpu()
+
+@torch.inference_mode()
+def spot_check(reference, candidate, tokenizer, prompts=SPOT_CHECK_PROMPTS, max_new_tokens=SPOT_CHECK_TOKENS) -> dict:
+  """
+  Compares a candidate model against its fp32 reference. The reference's greedy
+  continuation of every prompt is fed to both models; reported are the share of
+  positions where both predict the same next token and the mean KL divergence
+  of the candidate's next-token distribution from the reference's.
+  """
+  agreements, divergences = [], []
+  for prompt in prompts:
+    inputs = tokenizer(prompt, return_tensors='pt')
+    output = reference.generate(
+      **inputs,
+      max_new_tokens=max_new_tokens,
+      do_sample=False,
+      pad_token_id=tokenizer.pad_token_id or tokenizer.eos_token_id
+    )
+    target_ids = output[:, 1:] if reference.config.is_encoder_decoder else output[:, inputs['input_ids'].shape[1]:]
+    if target_ids.shape[1] == 0:
+      continue
+
+    ref_logits = _teacher_forced_logits(reference, inputs, target_ids)
+    cand_logits = _teacher_forced_logits(candidate, inputs, target_ids)
+    vocab = min(ref_logits.shape[-1], cand_logits.shape[-1])
+    ref_log_probs = torch.log_softmax(ref_logits[:, :vocab], dim=-1)
+    cand_log_probs = torch.log_softmax(cand_logits[:, :vocab], dim=-1)
+
+    agreements.append((ref_log_probs.argmax(-1) == cand_log_probs.argmax(-1)).float().mean().item())
+    divergences.append(torch.sum(ref_log_probs.exp() * (ref_log_probs - cand_log_probs), dim=-1).mean().item())
+
+  result = {
+    'prompts': len(agreements),
+    'top1_agreement': sum(agreements) / len(agreements) if agreements else 0.0,
+    'kl_divergence': sum(divergences) / len(divergences) if divergences else 0.0
+  }
+  labels = get_labels()
+  PRECISION_TOP1_AGREEMENT.labels(**labels).set(result['top1_agreement'])
+  PRECISION_KL_DIVERGENCE.labels(**labels).set(result['kl_divergence'])
+  return result
+
+def run_spot_check(model_cls, model_path: str, candidate, tokenizer) -> dict:
+  """Loads the fp32 reference next to the candidate, runs the spot-check and frees the reference"""
+  logger.info("Running precision spot-check against fp32")
+  reference = model_cls.from_pretrained(model_path, torch_dtype=torch.float32, low_cpu_mem_usage=True)
+  try:
+    result = spot_check(reference, candidate, tokenizer)
+  finally:
+    del reference
+    gc.collect()
+  logger.info(f"Precision spot-check: top-1 agreement {result['top1_agreement']:.3f}, "
+              f"KL divergence {result['kl_divergence']:.4f} over {result['prompts']} prompts")
+  return result
+
+if __name__ == '__main__':
+  from transformers import AutoModelForCausalLM, AutoModelForSeq2SeqLM, AutoConfig, AutoTokenizer
+
+  logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+  path, precision = sys.argv[1], Precision(sys.argv[2])
+  model_cls = AutoModelForSeq2SeqLM if AutoConfig.from_pretrained(path).is_encoder_decoder else AutoModelForCausalLM
+  tokenizer = AutoTokenizer.from_pretrained(path)
+  candidate = quantize(
+    model_cls.from_pretrained(path, torch_dtype=load_dtype(precision), low_cpu_mem_usage=True),
+    precision
+  )
+  print(run_spot_check(model_cls, path, candidate, tokenizer))
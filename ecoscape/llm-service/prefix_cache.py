@@ -0,0 +1,117 @@
+import hashlib
+import logging
+import threading
+import torch
+
+from array import array
+from collections import OrderedDict
+from typing import List, Optional, Tuple
+
+from metrics import (
+    PREFIX_CACHE_HITS,
+    PREFIX_CACHE_MISSES,
+    PREFIX_CACHE_HIT_TOKENS,
+    PREFIX_CACHE_EVICTED_BYTES,
+    PREFIX_CACHE_BYTES,
+    bound
+)
+
+logger = logging.getLogger(__name__)
+
+class PrefixCache:
+  """
+  LRU cache of prefill KV states for shared token prefixes.
+
+  Prompts are split into fixed-size token blocks. Each full block is keyed by a
+  BLAKE2b digest chained over all blocks before it, so a key identifies the
+  complete prefix up to and including that block. The 128-bit digests make
+  a collision, which would hand a prompt the KV state of another, negligible
+  without storing and comparing the tokens themselves. Entries hold the per-layer key/value
+  slices of just their block; a lookup walks the chain and concatenates the
+  matched blocks. Eviction drops least recently used blocks until the cache
+  fits its byte budget. Lookups refresh deeper blocks before their parents, so
+  leaves are evicted before the prefixes they extend.
+  """
+
+  def __init__(self, max_bytes: int, block_size: int = 16):
+    self.max_bytes = max_bytes
+    self.block_size = block_size
+    self._blocks = OrderedDict()  # chain digest -> (layers, size in bytes)
+    self._bytes = 0
+    self._lock = threading.Lock()
+
+  def _chain(self, token_ids: List[int], limit: int) -> List[bytes]:
+    """Chained digests for every full block within the first `limit` tokens"""
+    hashes = []
+    parent = b''
+    for start in range(0, limit - self.block_size + 1, self.block_size):
+      block = array('q', token_ids[start:start + self.block_size]).tobytes()
+      parent = hashlib.blake2b(parent + block, digest_size=16).digest()
+      hashes.append(parent)
+    return hashes
+
+  def _touch(self, hashes: List[bytes]):
+    for key in reversed(hashes):
+      self._blocks.move_to_end(key)
+
+  def lookup(self, token_ids: List[int]) -> Tuple[int, Optional[list]]:
+    """
+    Returns the number of cached prefix tokens and their per-layer (key, value) tensors.
+    At least one token is always left uncached so the prefill yields logits.
+    """
+    matched = []
+    with self._lock:
+      for key in self._chain(token_ids, len(token_ids) - 1):
+        entry = self._blocks.get(key)
+        if entry is None:
+          break
+        matched.append((key, entry[0]))
+      self._touch([key for key, _ in matched])
+
+    if not matched:
+      bound(PREFIX_CACHE_MISSES).inc()
+      return 0, None
+
+    num_tokens = len(matched) * self.block_size
+    bound(PREFIX_CACHE_HITS).inc()
+    bound(PREFIX_CACHE_HIT_TOKENS).inc(num_tokens)
+    num_layers = len(matched[0][1])
+    layers = [
+      (torch.cat([blocks[i][0] for _, blocks in matched], dim=2),
+       torch.cat([blocks[i][1] for _, blocks in matched], dim=2))
+      for i in range(num_layers)
+    ]
+    return num_tokens, layers
+
+  def insert(self, token_ids: List[int], layers: list):
+    """Stores the blocks of a prefilled prompt that are not cached yet"""
+    hashes = self._chain(token_ids, len(token_ids))
+    if not hashes:
+      return
+
+    with self._lock:
+      for index, key in enumerate(hashes):
+        if key in self._blocks:
+          continue
+        start, end = index * self.block_size, (index + 1) * self.block_size
+        block = [(k[:, :, start:end].clone(), v[:, :, start:end].clone()) for k, v in layers]
+        size = sum(k.nbytes + v.nbytes for k, v in block)
+        if size > self.max_bytes:
+          break
+        self._blocks[key] = (block, size)
+        self._bytes += size
+      self._touch(hashes)
+      evicted = self._evict()
+      current = self._bytes
+
+    if evicted:
+      bound(PREFIX_CACHE_EVICTED_BYTES).inc(evicted)
+    bound(PREFIX_CACHE_BYTES).set(current)
+
+  def _evict(self) -> int:
+    evicted = 0
+    while self._bytes > self.max_bytes and self._blocks:
+      _, (_, size) = self._blocks.popitem(last=False)
+      self._bytes -= size
+      evicted += size
+    return evicted
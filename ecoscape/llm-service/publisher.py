@@ -0,0 +1,88 @@
+import logging
+import threading
+import time
+
+from confluent_kafka import Producer
+
+from metrics import (
+    PRODUCER_QUEUE,
+    RESULT_DELIVERY_FAILURES,
+    RESULT_DELIVERY_LATENCY,
+    bound,
+    samples
+)
+
+logger = logging.getLogger(__name__)
+
+class ResultPublisher:
+  """
+  Kafka producer for result records. Records are batched and compressed by the
+  producer, and a background thread serves the delivery reports: a callback
+  passed to `publish` runs once its record is acknowledged, or failed for good.
+  The producer retries failed sends itself until `delivery_timeout_ms`; a record
+  is never produced again from here, which would bypass idempotence.
+  """
+
+  def __init__(self, bootstrap_servers: str, topic: str, linger_ms: int = 5, batch_size: int = 131072,
+               compression: str = 'lz4', idempotence: bool = True, delivery_timeout_ms: int = 120000):
+    self.topic = topic
+    self.producer = Producer({
+      'bootstrap.servers': bootstrap_servers,
+      'linger.ms': linger_ms,
+      'batch.size': batch_size,
+      'compression.type': compression,
+      # Idempotence keeps the producer's own retries in order and without duplicates, it requires
+      # acks from all replicas. A record produced again after a failed delivery is a new record
+      'enable.idempotence': idempotence,
+      'acks': 'all' if idempotence else '1',
+      # How long the producer retries a record before reporting it failed
+      'delivery.timeout.ms': delivery_timeout_ms
+    })
+    self.running = False
+    self._poller = None
+
+  def start(self):
+    self.running = True
+    self._poller = threading.Thread(target=self._poll, name='delivery-reports', daemon=True)
+    self._poller.start()
+
+  def _poll(self):
+    queued = bound(PRODUCER_QUEUE)
+    while self.running:
+      self.producer.poll(0.1)
+      queued.set(len(self.producer))
+
+  def publish(self, value: bytes, key: str = None, headers: list = None, on_delivery=None, topic: str = None):
+    """
+    Produces a record to the result topic, or `topic` if given (e.g. to forward a
+    prompt). Raises BufferError while the producer's local queue is full.
+    `on_delivery(error)` runs on the poller thread once the record is acknowledged
+    (error None) or failed after the producer's retries.
+    """
+    produced_at = time.perf_counter()
+    topic = topic or self.topic
+
+    def delivered(error, message):
+      if error is None:
+        # Forwarded prompts and status records are not results, keep them out of the result latency
+        if topic == self.topic:
+          samples(RESULT_DELIVERY_LATENCY).observe(time.perf_counter() - produced_at)
+      else:
+        bound(RESULT_DELIVERY_FAILURES, reason=error.name()).inc()
+        logger.error(f"Delivery of record {key} to {topic} failed: {error}")
+      if on_delivery is not None:
+        on_delivery(error)
+
+    self.producer.produce(topic, key=key, value=value, headers=headers, on_delivery=delivered)
+
+  def flush(self, timeout: float = 30.0) -> int:
+    """Waits for outstanding deliveries, returns the number of records still not delivered"""
+    return self.producer.flush(timeout)
+
+  def close(self, timeout: float = 30.0):
+    self.running = False
+    if self._poller:
+      self._poller.join(timeout=2)
+    remaining = self.flush(timeout)
+    if remaining:
+      logger.warning(f"{remaining} results were not delivered before shutdown")
@@ -0,0 +1,71 @@
+import hashlib
+import json
+import threading
+import time
+
+from collections import OrderedDict
+from concurrent.futures import Future
+
+class ResponseCache:
+  """
+  Bounded LRU/TTL cache of generation results with in-flight coalescing.
+
+  The first request for a key runs the generation; identical requests that
+  arrive while it is running wait on its future instead of generating again.
+  """
+
+  HIT = 'hit'
+  MISS = 'miss'
+  COALESCED = 'coalesced'
+
+  def __init__(self, max_entries: int = 1024, ttl_seconds: float = 300.0):
+    self.max_entries = max_entries
+    self.ttl_seconds = ttl_seconds
+    self._entries = OrderedDict()  # key -> (expires_at, value)
+    self._inflight = {}            # key -> Future
+    self._lock = threading.Lock()
+
+  @staticmethod
+  def key(model: str, prompt: str, params: dict) -> str:
+    """Hash of everything that determines a response"""
+    payload = json.dumps({'model': model, 'prompt': prompt, 'params': params}, sort_keys=True)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+  def get_or_generate(self, key: str, generate):
+    """Returns (value, source) where source is one of HIT, MISS or COALESCED"""
+    with self._lock:
+      entry = self._entries.get(key)
+      if entry is not None:
+        if entry[0] > time.monotonic():
+          self._entries.move_to_end(key)
+          return entry[1], self.HIT
+        del self._entries[key]
+
+      future = self._inflight.get(key)
+      leader = future is None
+      if leader:
+        future = Future()
+        self._inflight[key] = future
+
+    if not leader:
+      return future.result(), self.COALESCED
+
+    try:
+      value = generate()
+    except BaseException as e:
+      with self._lock:
+        self._inflight.pop(key, None)
+      future.set_exception(e)
+      raise
+
+    with self._lock:
+      self._inflight.pop(key, None)
+      self._entries[key] = (time.monotonic() + self.ttl_seconds, value)
+      self._entries.move_to_end(key)
+      while len(self._entries) > self.max_entries:
+        self._entries.popitem(last=False)
+    future.set_result(value)
+    return value, self.MISS
+
+  def __len__(self):
+    return len(self._entries)
@@ -0,0 +1,83 @@
+import heapq
+import itertools
+import threading
+import time
+
+from dataclasses import dataclass, field
+from enum import Enum
+from typing import Optional
+
+from metrics import SCHEDULER_QUEUE_WAIT, samples
+
+class Policy(Enum):
+  FIFO = "fifo"    # arrival order
+  SJF = "sjf"      # fewest predicted total tokens first
+  AGING = "aging"  # SJF, but waiting earns priority so long prompts cannot starve
+
+# Same boundaries the prompt producer uses to categorize prompts
+SHORT_PROMPT_TOKENS = 50
+MEDIUM_PROMPT_TOKENS = 200
+
+def length_category(token_count: int) -> str:
+  if token_count <= SHORT_PROMPT_TOKENS:
+    return 'short'
+  if token_count <= MEDIUM_PROMPT_TOKENS:
+    return 'medium'
+  return 'long'
+
+@dataclass(order=True)
+class ScheduledItem:
+  key: tuple
+  data: dict = field(compare=False)
+  message: tuple = field(compare=False)
+  category: str = field(compare=False)
+  predicted_tokens: int = field(compare=False)
+  enqueued_at: float = field(compare=False)
+  context: dict = field(compare=False, default_factory=dict)
+
+class Scheduler:
+  """
+  Local queue between the Kafka consumer and the inference workers, ordered by a policy.
+
+  With aging, an item's priority is its predicted size minus `aging_rate` tokens
+  per second waited. All items age at the same rate, so the ordering never
+  changes while they wait and a plain heap keyed by size plus arrival time works.
+  """
+
+  def __init__(self, policy: Policy = Policy.FIFO, aging_rate: float = 100.0):
+    self.policy = policy
+    self.aging_rate = aging_rate
+    self._heap = []
+    self._sequence = itertools.count()
+    self._condition = threading.Condition()
+
+  def _key(self, predicted_tokens: int, enqueued_at: float) -> tuple:
+    sequence = next(self._sequence)
+    if self.policy == Policy.SJF:
+      return (predicted_tokens, sequence)
+    if self.policy == Policy.AGING:
+      return (predicted_tokens + self.aging_rate * enqueued_at, sequence)
+    return (sequence,)
+
+  def put(self, data: dict, message: tuple, predicted_tokens: int, category: str, context: dict = None):
+    enqueued_at = time.perf_counter()
+    item = ScheduledItem(
+      self._key(predicted_tokens, enqueued_at), data, message, category, predicted_tokens, enqueued_at, context or {}
+    )
+    with self._condition:
+      heapq.heappush(self._heap, item)
+      self._condition.notify()
+
+  def get(self, timeout: float = None) -> Optional[ScheduledItem]:
+    """Removes the next item by policy, None if there was none within `timeout`"""
+    with self._condition:
+      if not self._heap and not self._condition.wait_for(lambda: self._heap, timeout=timeout):
+        return None
+      item = heapq.heappop(self._heap)
+    samples(SCHEDULER_QUEUE_WAIT, policy=self.policy.value, length_category=item.category).observe(
+      time.perf_counter() - item.enqueued_at
+    )
+    return item
+
+  def __len__(self):
+    return len(self._heap)
@@ -1,29 +1,72 @@
-import json
+import asyncio
+import gc
 import logging
+import os
+import queue
 import threading
 import time
 import psutil
+import signal
 import sys
+import torch
 
+from codec import CONTENT_TYPE_HEADER, codec_for, get_codec
+from contextlib import contextmanager
 from datetime import datetime, timezone
-from confluent_kafka import Consumer, Producer
+from confluent_kafka import Consumer, KafkaException, TIMESTAMP_NOT_AVAILABLE
 from concurrent.futures import ThreadPoolExecutor
-from prometheus_client import start_http_server
 
+from direct import STOPPED, DirectRequests
+from http_server import ServiceHTTPServer
 from model import Model
+from model_pool import ModelPool, model_bytes
+from load import LoadTracker, request_load
+from offload import OFFLOADED_AT_HEADER, OFFLOADED_BY_HEADER, OffloadController
+from offsets import OffsetTracker
+from pipeline import StageQueue, put_threadsafe
+from publisher import ResultPublisher
+from response_cache import ResponseCache
+from scheduler import Policy, Scheduler, length_category
+from streaming import ChunkCoalescer, replay_text
+from topology import ThreadTopology
+from workers import WorkerProcesses
 from metrics import (
     ACTIVE_PROCESSING,
     CPU_USAGE,
     MEMORY_USAGE,
     DEVICE_MEMORY,
+    PROCESS_PSS,
     MESSAGES_PROCESSED,
     TOKENS_GENERATED,
     PROCESSING_TIME,
+    CACHED_PROCESSING_TIME,
+    RESPONSE_CACHE_REQUESTS,
+    STREAM_CHUNKS,
+    DIRECT_REQUESTS,
+    DIRECT_REQUEST_TIME,
+    SERVICE_READY,
+    MODEL_SWAPS,
     REQUESTS_SUCCESS,
     REQUESTS_FAILED,
     QUEUE_DEPTH,
+    CONSUMER_PAUSED,
+    CONSUMER_PAUSES,
     TOKENS_PER_SECOND,
-    get_labels
+    SHED_REQUESTS,
+    REQUESTS_OFFLOADED,
+    OFFLOADED_SERVED,
+    QUEUE_AGE,
+    REQUESTS_LATE,
+    GOODPUT_TOKENS,
+    GOODPUT_PER_SECOND,
+    STAGE_LATENCY,
+    PIPELINE_QUEUE_DEPTH,
+    PIPELINE_QUEUE_CAPACITY,
+    RateWindow,
+    bound,
+    flush_samples,
+    get_labels,
+    samples
 )
 
 logger = logging.getLogger(__name__)
@@ -31,14 +74,176 @@ logger = logging.getLogger(__name__)
 class LLMService:
   def __init__(self, config):
     self.config = config
-    self.model = Model(config.model_path)
+    if config.processes > 1 and torch.cuda.is_available():
+      raise ValueError("Worker processes are forked after loading the model, which CUDA does not support")
+    # Thread and memory placement has to be settled before torch starts any work.
+    # With worker processes, the topology spans the worker threads of all processes
+    self.topology = ThreadTopology.resolve(
+      config.workers * config.processes,
+      config.intra_op_threads,
+      config.inter_op_threads,
+      config.cpu_affinity,
+      config.numa_node
+    )
+    self.topology.apply_process()
+    self.model = self.create_model(config.model_path, config.draft_model_path, config.snapshot_path)
+    # Requests using each model, a swapped out model is closed once it has none
+    self._model_users = {}
+    self._models = threading.Condition()
+    self.swap_state = {'state': 'idle'}
+    self.model_name = config.model_name or os.path.basename(os.path.normpath(config.model_path))
+    self.pool = None
+    if config.models:
+      if config.processes > 1 and not config.model_snapshot_dir:
+        logger.warning("Every worker process loads the hosted models itself, set MODEL_SNAPSHOT_DIR to share their weights")
+      self.pool = ModelPool(
+        lambda path, snapshot_path: self.create_model(path, config.draft_model_path, snapshot_path),
+        {name: path for name, path in config.models.items() if name != self.model_name},
+        config.model_memory_budget,
+        config.model_snapshot_dir,
+        pinned_bytes=lambda: model_bytes(self.model) if self.model.model is not None else 0,
+        prepare=self.prepare_model
+      )
+    self.draining = False
+    self.result_codec = get_codec(config.result_codec)
     self.consumer = None
-    self.producer = None
+    self.publisher = None
+    self.workers = None
+    self.offsets = OffsetTracker()
+    # Messages consumed but not finished; beyond this the consumer pauses and load stays in Kafka
+    self.max_in_flight = config.max_in_flight or 2 * config.max_batch_size * config.workers * config.processes
+    self._paused = False
+    # Prompts posted to /generate, scheduled with the consumed ones
+    self.direct = DirectRequests(config.direct_max_in_flight or self.max_in_flight)
+    self.scheduler = Scheduler(Policy(config.scheduler_policy), config.scheduler_aging_rate)
+    # One slot per handler thread of all workers, the scheduler only releases a message into a free slot
+    self.inference_slots = config.max_batch_size * config.workers * config.processes
+    self.load = LoadTracker()
+    # When messages entered an inference slot, for the service time in the load tracker
+    self._dispatched = {}
+    self.offload = None
+    if config.offload_topic:
+      if config.offload_topic == config.input_topic:
+        raise ValueError("The offload topic must not be the input topic")
+      self.offload = OffloadController(
+        self.load,
+        config.offload_queue_depth,
+        config.offload_max_wait,
+        config.offload_ttft_p95,
+        config.offload_resume_ratio,
+        config.offload_min_seconds
+      )
+      if not self.offload.enabled:
+        logger.warning(f"Offload topic {config.offload_topic} is set, but no offload threshold")
+        self.offload = None
     self.running = False
-    self.metrics_thread = None
-    self.executor = ThreadPoolExecutor(max_workers=2)
-    self._token_count_window = []
-    self._token_window_size = 10
+    # Pipeline state, created on the event loop by run_pipeline
+    self.loop = None
+    self.decode_queue = None
+    self.serialize_queue = None
+    self.produce_queue = None
+    self._scheduled = None
+    self._slots = None
+    self._inferring = 0
+    self._inference_tasks = set()
+    # Blocking consumer calls get their own thread, off the event loop and the inference threads
+    self.consume_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='kafka-consume')
+    self.state = 'starting'
+    self._heartbeat = time.monotonic()
+
+    self.http = ServiceHTTPServer(config.metrics_port)
+    self.http.route('GET', '/live', self.live)
+    self.http.route('GET', '/ready', self.ready)
+    self.http.route('GET', '/status', self.status)
+    self.http.route('GET', '/model', self.model_info)
+    self.http.route('POST', '/model', self.swap)
+    self.http.route('POST', '/drain', self.drain_request)
+    self.http.route('POST', '/generate', self.generate)
+    self.response_cache = None
+    if config.response_cache_size > 0:
+      self.response_cache = ResponseCache(config.response_cache_size, config.response_cache_ttl)
+    # Workers only wait on the batching engines, so allow enough of them to fill every batch
+    self.executor = ThreadPoolExecutor(max_workers=config.max_batch_size * config.workers)
+    self.token_rates = RateWindow(seconds=10)
+
+  def create_model(self, model_path: str, draft_model_path: str = None, snapshot_path: str = None) -> Model:
+    config = self.config
+    return Model(
+      model_path,
+      max_batch_size=config.max_batch_size,
+      prefix_cache_bytes=config.prefix_cache_bytes,
+      prefix_cache_block_size=config.prefix_cache_block_size,
+      draft_model_path=draft_model_path,
+      speculative_tokens=config.speculative_tokens,
+      speculative_min_acceptance=config.speculative_min_acceptance,
+      speculative_cooldown=config.speculative_cooldown,
+      precision=config.precision,
+      precision_check=config.precision_check,
+      snapshot_path=snapshot_path,
+      token_budget=config.token_budget,
+      topology=self.topology
+    )
+
+  def hosts(self, name: str) -> bool:
+    return name == self.model_name or (self.pool is not None and name in self.pool)
+
+  @contextmanager
+  def using_model(self, name: str = None):
+    """
+    The model requested by name, the serving one by default. A hot swap does not
+    close the serving model and the pool does not evict a hosted one while it is in use
+    """
+    if name is not None and name != self.model_name:
+      if self.pool is None:
+        raise ValueError(f"Model '{name}' is not hosted here")
+      with self.pool.acquire(name) as model:
+        yield model
+      return
+
+    with self._models:
+      model = self.model
+      self._model_users[model] = self._model_users.get(model, 0) + 1
+    try:
+      yield model
+    finally:
+      with self._models:
+        self._model_users[model] -= 1
+        if not self._model_users[model]:
+          del self._model_users[model]
+          self._models.notify_all()
+
+  def swap_model(self, model_path: str, draft_model_path: str = None, snapshot_path: str = None):
+    """
+    Loads and warms up another model next to the serving one, then switches new
+    requests to it. Requests already generating finish on the old model, which is
+    closed and freed after the last of them. Both models are in memory meanwhile
+    """
+    logger.info(f"Swapping model {self.model.model_path} for {model_path}")
+    self.swap_state = {'state': 'loading', 'model_path': model_path}
+    model = self.create_model(model_path, draft_model_path, snapshot_path)
+    try:
+      model.load()
+      self.prepare_model(model)
+    except Exception as e:
+      logger.error(f"Could not load {model_path}, keeping {self.model.model_path}: {e}", exc_info=True)
+      model.close()
+      self.swap_state = {'state': 'failed', 'model_path': model_path, 'error': str(e)}
+      bound(MODEL_SWAPS, result='failed').inc()
+      return
+
+    with self._models:
+      old, self.model = self.model, model
+      self.swap_state = {'state': 'finishing', 'model_path': model_path}
+      logger.info(f"Serving {model_path}, waiting for the requests on {old.model_path}")
+      self._models.wait_for(lambda: old not in self._model_users)
+    old.close()
+    del old
+    gc.collect()
+    if torch.cuda.is_available():
+      torch.cuda.empty_cache()
+    self.swap_state = {'state': 'idle'}
+    bound(MODEL_SWAPS, result='success').inc()
+    logger.info(f"Model swap to {model_path} complete")
 
   def setup_kafka(self):
     """Setup basic kafka consumer and producer"""
@@ -47,12 +252,22 @@ class LLMService:
             'bootstrap.servers': self.config.kafka_bootstrap_servers,
             'group.id': self.config.consumer_group,
             'auto.offset.reset': 'latest',
+            # Offsets are stored once a message is processed, auto commit only commits stored ones
+            'enable.auto.offset.store': False,
         })
-        self.consumer.subscribe([self.config.input_topic])
         
-        self.producer = Producer({
-            'bootstrap.servers': self.config.kafka_bootstrap_servers
-        })
+        self.publisher = ResultPublisher(
+            self.config.kafka_bootstrap_servers,
+            self.config.output_topic,
+            linger_ms=self.config.producer_linger_ms,
+            batch_size=self.config.producer_batch_size,
+            compression=self.config.producer_compression,
+            idempotence=self.config.producer_idempotence,
+            delivery_timeout_ms=self.config.producer_delivery_timeout_ms
+        )
+        self.publisher.start()
+        # Fetch cluster metadata now so the broker connection is up before warmup ends
+        self.consumer.list_topics(timeout=30)
         logger.info("Kafka setup complete")
     except Exception as e:
         logger.error(f"Failed to setup kafka: {e}")
@@ -68,44 +283,111 @@ class LLMService:
         DEVICE_MEMORY.labels(**labels).set(float(meminfo.rss))
         MEMORY_USAGE.labels(**labels).set(float(psutil.virtual_memory().used))
         CPU_USAGE.labels(**labels).set(float(psutil.cpu_percent()))
+
+        # Unlike RSS, PSS splits the weight pages shared with forked workers between them
+        if psutil.LINUX:
+          pss = 0
+          for member in [process] + process.children():
+            pss += member.memory_full_info().pss
+          PROCESS_PSS.labels(**labels).set(float(pss))
+
+        self.update_throughput_metrics()
         
-        # Calculate tokens per second
-        current_time = time.time()
-        self._token_count_window = [
-            (t, count) for t, count in self._token_count_window 
-            if current_time - t < self._token_window_size
-        ]
-        
-        if self._token_count_window:
-            total_tokens = sum(count for _, count in self._token_count_window)
-            time_span = current_time - self._token_count_window[0][0]
-            if time_span > 0:
-                tps = total_tokens / time_span
-                TOKENS_PER_SECOND.labels(**labels).set(tps)
+    except Exception as e:
+        logger.warning(f"Failed to update metrics: {e}")
+
+  def update_throughput_metrics(self):
+    """Tokens per second over the recent window, per process in multiprocess mode"""
+    try:
+        rates = self.token_rates.rates()
+        if rates is not None:
+            tps, goodput = rates
+            bound(TOKENS_PER_SECOND).set(tps)
+            bound(GOODPUT_PER_SECOND).set(goodput)
         
     except Exception as e:
         logger.warning(f"Failed to update metrics: {e}")
   
   def metrics_worker(self):
-    """Background worker to update metrics"""
+    """Background worker to update the throughput metrics of a worker process"""
     while self.running:
-      self.update_system_metrics()
+      self.update_throughput_metrics()
       time.sleep(10)
 
-  def process_prompt(self, prompt: str, message_id: str):
-    """Process a prompt and track metrics"""
-    labels = get_labels()
+  def generation_params(self, model: Model, requested: dict = None) -> dict:
+    """
+    Generation parameters for one message: values given in the message's
+    'parameters' object, clamped by the config, which also supplies the defaults
+    """
+    requested = requested or {}
+    if not isinstance(requested, dict):
+      raise ValueError("'parameters' must be an object")
+    defaults = model.sampling_params()
+
+    max_new_tokens = int(requested.get('max_new_tokens', self.config.max_new_tokens))
+    temperature = float(requested.get('temperature', self.config.temperature))
+    top_k = int(requested.get('top_k', defaults['top_k']))
+    top_p = float(requested.get('top_p', defaults['top_p']))
+    return {
+      'max_new_tokens': min(max(max_new_tokens, 1), self.config.max_new_tokens),
+      'do_sample': bool(requested.get('do_sample', self.config.do_sample)),
+      'temperature': min(max(temperature, 0.0), self.config.max_temperature),
+      'top_k': max(top_k, 0),
+      'top_p': min(max(top_p, 0.0), 1.0)
+    }
+
+  def _generate(self, model: Model, prompt: str, params: dict, stream=None, stages: dict = None):
+    """Runs inference, served from the response cache where allowed"""
+    sampling = {k: v for k, v in params.items() if k != 'max_new_tokens'}
+
+    def generate():
+      return model.generate(prompt, params['max_new_tokens'], stream, sampling, stages)
+
+    sampled = sampling['do_sample'] and sampling['temperature'] > 0
+    if self.response_cache is None or (sampled and not self.config.response_cache_sampled):
+      return generate(), None
+
+    # Sampling parameters do not change greedy output, keep them out of the key
+    key_params = params if sampled else {'max_new_tokens': params['max_new_tokens'], 'do_sample': False}
+    key = ResponseCache.key(model.model_path, prompt, key_params)
+    value, cache_result = self.response_cache.get_or_generate(key, generate)
+    if stream is not None and cache_result != ResponseCache.MISS:
+      # Nothing was generated for this request, replay the text so streamed results have chunks either way
+      replay_text(stream, model.tokenizer, value[0])
+    return value, cache_result
+
+  def process_prompt(self, model: Model, prompt: str, message_id: str, stream=None, parameters: dict = None,
+                     deadline: float = None, stages: dict = None):
+    """Process a prompt on `model` and track metrics, `stages` collects the latency breakdown"""
     start = time.time()
+    stages = {} if stages is None else stages
     
     try:
-       response, inference_time, num_tokens, input_length = self.model.generate(prompt)
+       params = self.generation_params(model, parameters)
+       (response, inference_time, num_tokens, input_length), cache_result = self._generate(
+         model, prompt, params, stream, stages
+       )
        processing_time = time.time() - start
-       
-       PROCESSING_TIME.labels(**labels).observe(processing_time)
-       TOKENS_GENERATED.labels(**labels).inc(num_tokens)
-       REQUESTS_SUCCESS.labels(**labels).inc()
-       
-       self._token_count_window.append((time.time(), num_tokens))
+       cache_hit = cache_result in (ResponseCache.HIT, ResponseCache.COALESCED)
+
+       if cache_result is not None:
+         bound(RESPONSE_CACHE_REQUESTS, result=cache_result).inc()
+
+       if cache_hit:
+         # No inference ran for this request, keep it out of the inference metrics
+         samples(CACHED_PROCESSING_TIME, result=cache_result).observe(processing_time)
+         inference_time = 0.0
+
+       within_slo = deadline is None or time.time() <= deadline
+       if not within_slo:
+         bound(REQUESTS_LATE).inc()
+       if not cache_hit:
+         samples(PROCESSING_TIME).observe(processing_time)
+         bound(TOKENS_GENERATED).inc(num_tokens)
+         if within_slo:
+           bound(GOODPUT_TOKENS).inc(num_tokens)
+         self.token_rates.record(num_tokens, num_tokens if within_slo else 0)
+       bound(REQUESTS_SUCCESS).inc()
        
        return {
           'message_id': message_id,
@@ -115,16 +397,23 @@ class LLMService:
           'inference_time': inference_time,
           'tokens_generated': num_tokens,
           'input_tokens': input_length,
-          'model_type': self.model.model_type.value if self.model.model_type else 'unknown',
+          'parameters': params,
+          'model': model.model_path,
+          'model_type': model.model_type.value if model.model_type else 'unknown',
           'node_id': self.config.node_id,
           'timestamp': datetime.now(timezone.utc).isoformat(),
+          'cache_hit': cache_hit,
+          'cache_result': cache_result,
+          'deadline': deadline,
+          'within_slo': within_slo,
+          'stages': stages,
           'status': 'success'
        }
        
     except Exception as e:
         logger.error(f"Error processing message {message_id}: {e}", exc_info=True)
         error_reason = type(e).__name__
-        REQUESTS_FAILED.labels(**labels, reason=error_reason).inc()
+        bound(REQUESTS_FAILED, reason=error_reason).inc()
         
         return {
             'message_id': message_id,
@@ -136,77 +425,778 @@ class LLMService:
             'status': 'failed'
         }
   
-  def handle_message(self, data):
-    """Handle incoming Kafka message"""
-    labels = get_labels()
+  def infer_encoded(self, data, context: dict = None):
+    """
+    Inference in a worker process: returns the encoded (key, value, finished_at) of the
+    result, which the parent publishes and commits once it is acknowledged, and its
+    `request_load` for the parent's load tracker, or None
+    """
+    output = self.infer(data, context)
+    if output is None:
+      return None
+    key, record = output
+    load = request_load(record)
+    return key, self.encode(record), time.perf_counter(), load
+
+  def infer(self, data, context: dict = None):
+    """Runs inference for a message, returns the (key, record) to publish or None"""
+    context = context or {}
     message_id = data.get('message_id', 'unknown')
     prompt = data.get('prompt')
     
     if not prompt:
        logger.warning(f"Message {message_id} has no prompt")
-       REQUESTS_FAILED.labels(**labels, reason='no_prompt').inc()
-       return
+       bound(REQUESTS_FAILED, reason='no_prompt').inc()
+       return None
+
+    model_name = context.get('model')
+    if model_name is not None and not self.hosts(model_name):
+       logger.warning(f"Message {message_id} requests model {model_name}, which is not hosted here")
+       bound(REQUESTS_FAILED, reason='unknown_model').inc()
+       return None
+
+    deadline = context.get('deadline')
+    if deadline is not None and time.time() > deadline:
+       return self.shed(data, context, 'expired_in_queue')
+    now = time.time()
+    if 'sent_at' in context:
+       samples(QUEUE_AGE, result='served').observe(max(0.0, now - context['sent_at']))
+    stages = {'transit': context['transit']} if 'transit' in context else {}
+    if 'received_at' in context:
+       stages['queue'] = now - context['received_at']
+       samples(STAGE_LATENCY, stage='queue').observe(stages['queue'])
+    if 'offload_hop' in context:
+       stages['offload'] = context['offload_hop']
     
-    ACTIVE_PROCESSING.labels(**labels).inc()
+    bound(ACTIVE_PROCESSING).inc()
     
     try:
-      result = self.process_prompt(prompt, message_id)
-      
-      self.producer.produce(
-         self.config.output_topic,
-         value=json.dumps(result).encode('utf-8')
-      )
-      self.producer.poll(0)
+      stream = None
+      # Chunks of a direct request are keyed by its message, which routes them to its handler
+      key = context.get('reply_to', message_id)
+      if context.get('stream', self.config.stream_responses):
+        stream = ChunkCoalescer(
+          lambda text, tokens, sequence: self.publish_chunk(message_id, text, tokens, sequence, key),
+          max_tokens=self.config.stream_chunk_tokens,
+          max_interval=self.config.stream_chunk_interval
+        )
+
+      with self.using_model(model_name) as model:
+        result = self.process_prompt(model, prompt, message_id, stream, data.get('parameters'), deadline, stages)
+      result['trace_id'] = context.get('trace_id', message_id)
+      result['offloaded_from'] = context.get('offloaded_from')
+      result['offload_hop'] = context.get('offload_hop')
+      if stream is not None:
+        # Completion record, carries the full response after the last chunk
+        result['type'] = 'final'
+        result['sequence'] = stream.sequence
       
       status = result.get('status', 'success')
-      MESSAGES_PROCESSED.labels(**labels, status=status).inc()
+      bound(MESSAGES_PROCESSED, status=status).inc()
+      return (key if stream is not None else None), result
       
     except Exception as e:
       logger.error(f"Failed to handle message {message_id}: {e}")
-      REQUESTS_FAILED.labels(**labels, reason='handling_error').inc()
+      bound(REQUESTS_FAILED, reason='handling_error').inc()
+      return None
       
     finally:
-      ACTIVE_PROCESSING.labels(**labels).dec()
+      bound(ACTIVE_PROCESSING).dec()
+
+  def shed(self, data: dict, context: dict, reason: str):
+    """The (key, record) of a 'shed' result, for a request that is dropped without inference"""
+    message_id = data.get('message_id', 'unknown')
+    queue_age = time.time() - context['sent_at'] if 'sent_at' in context else None
+    bound(SHED_REQUESTS, reason=reason).inc()
+    bound(MESSAGES_PROCESSED, status='shed').inc()
+    if queue_age is not None:
+      samples(QUEUE_AGE, result='shed').observe(max(0.0, queue_age))
+
+    result = {
+      'message_id': message_id,
+      'trace_id': context.get('trace_id', message_id),
+      'prompt': data.get('prompt'),
+      'reason': reason,
+      'queue_age': queue_age,
+      'deadline': context.get('deadline'),
+      'offloaded_from': context.get('offloaded_from'),
+      'node_id': self.config.node_id,
+      'timestamp': datetime.now(timezone.utc).isoformat(),
+      'status': 'shed'
+    }
+    if self.config.stream_responses:
+      result['type'] = 'final'
+      result['sequence'] = 0
+    return (message_id if self.config.stream_responses else None), result
+
+  def publish_chunk(self, message_id: str, text: str, tokens: int, sequence: int, key=None):
+    """Publish a partial response, keyed by message id (or `key`) so chunks stay ordered"""
+    chunk = {
+      'message_id': message_id,
+      'type': 'chunk',
+      'sequence': sequence,
+      'text': text,
+      'tokens': tokens,
+      'node_id': self.config.node_id,
+      'timestamp': datetime.now(timezone.utc).isoformat()
+    }
+    self.emit(chunk, key or message_id)
+    bound(STREAM_CHUNKS).inc()
+
+  def emit(self, record: dict, key: str = None):
+    """
+    Publishes a record from an inference thread: through the serialize and produce
+    stages while the pipeline runs in this process, directly otherwise
+    """
+    if self.loop is not None:
+      put_threadsafe(self.serialize_queue, (key, record, None, None), self.loop)
+    else:
+      self.publish(self.encode(record), key)
+
+  def encode(self, record: dict) -> bytes:
+    """Serializes a result record with the result codec"""
+    if not self.config.echo_prompt:
+      record.pop('prompt', None)
+    return self.result_codec.encode(record)
+
+  def publish(self, value: bytes, key: str = None, on_delivery=None):
+    """Produce a record to the output topic, `on_delivery(error)` runs once it is acknowledged"""
+    self.publisher.publish(value, key, [(CONTENT_TYPE_HEADER, self.result_codec.content_type)], on_delivery)
+
+  def _on_assign(self, consumer, partitions):
+    consumer.assign(partitions)
+    if self._paused:
+      # Newly assigned partitions must not bypass the full in-flight window
+      consumer.pause(partitions)
+
+  def _on_revoke(self, consumer, partitions):
+    self._store_offsets()
+    self.offsets.revoke(partitions)
+
+  def _inference_done(self, message):
+    """Frees an inference slot, on the event loop"""
+    dispatched_at = self._dispatched.pop(message, None)
+    if dispatched_at is not None:
+      self.load.record_service_time(time.perf_counter() - dispatched_at)
+    self._slots.release()
+    self._inferring -= 1
+    bound(PIPELINE_QUEUE_DEPTH, stage='infer').set(self._inferring)
+
+  def _worker_publish(self, value: bytes, key: str = None):
+    put_threadsafe(self.produce_queue, (key, value, None, None), self.loop)
+
+  def _worker_done(self, message, output):
+    """A worker process finished a message: its slot is free, and its result goes to the produce stage"""
+    self.loop.call_soon_threadsafe(self._inference_done, message)
+    key, value, finished_at, load = output if output is not None else (None, None, None, None)
+    if load is not None:
+      self.load.record_request(load)
+    put_threadsafe(self.produce_queue, (key, value, message, finished_at), self.loop)
 
-  def update_queue_depth(self):
-    """Update queue depth metric"""
+  def _store_offsets(self):
+    """Stores the offsets of finished messages, the consumer commits them periodically"""
+    offsets = self.offsets.committable()
+    if offsets:
+      try:
+        self.consumer.store_offsets(offsets=offsets)
+      except KafkaException as e:
+        logger.debug(f"Could not store offsets: {e}")
+
+  def _apply_backpressure(self, in_flight: int):
+    """Pauses the assigned partitions while the in-flight window is full, resumes at half"""
+    if not self._paused and in_flight >= self.max_in_flight:
+      self.consumer.pause(self.consumer.assignment())
+      self._paused = True
+      bound(CONSUMER_PAUSES).inc()
+      bound(CONSUMER_PAUSED).set(1)
+      logger.debug(f"In-flight window full ({in_flight}), pausing consumption")
+    elif self._paused and in_flight <= self.max_in_flight // 2:
+      self.consumer.resume(self.consumer.assignment())
+      self._paused = False
+      bound(CONSUMER_PAUSED).set(0)
+
+  def _prompt_tokens(self, data: dict) -> int:
+    """Prompt tokens as counted by the producer, estimated the same way if missing"""
+    token_count = data.get('token_count')
+    return token_count if isinstance(token_count, int) else len(data.get('prompt') or '') // 4
+
+  def _max_new_tokens(self, data: dict) -> int:
+    """Tokens the message may generate, without failing on parameters that process_prompt rejects"""
+    try:
+      max_new_tokens = int((data.get('parameters') or {}).get('max_new_tokens', self.config.max_new_tokens))
+    except (AttributeError, TypeError, ValueError):
+      max_new_tokens = self.config.max_new_tokens
+    return min(max(max_new_tokens, 1), self.config.max_new_tokens)
+
+  def _message_context(self, data: dict, msg) -> dict:
+    """
+    Trace id, when the producer sent the message and until when its answer is useful.
+    The producer's 'trace_id' and 'sent_at' headers take precedence over the message body.
+    A message may carry an absolute 'deadline' or its own 'slo_seconds' (both relative
+    to the producer's clock), otherwise the SLO of its topic or the default SLO applies
+    """
+    received_at = time.time()
+    headers = {key: value.decode('utf-8') for key, value in (msg.headers() or []) if value is not None}
+    try:
+      sent_at = float(headers['sent_at'])
+    except (KeyError, ValueError):
+      sent_at = data.get('timestamp')
+    if not isinstance(sent_at, (int, float)):
+      timestamp_type, timestamp = msg.timestamp()
+      sent_at = timestamp / 1000.0 if timestamp_type != TIMESTAMP_NOT_AVAILABLE else received_at
+    context = {
+      'model': headers.get('model') or data.get('model'),
+      'trace_id': headers.get('trace_id') or data.get('trace_id') or data.get('message_id', 'unknown'),
+      'sent_at': sent_at,
+      'received_at': received_at,
+      # Includes the clock offset between producer and service hosts
+      'transit': received_at - sent_at
+    }
+    if OFFLOADED_BY_HEADER in headers:
+      # Offloaded by another node, the hop from it to here is part of the transit
+      context['offloaded_from'] = headers[OFFLOADED_BY_HEADER]
+      try:
+        context['offload_hop'] = received_at - float(headers[OFFLOADED_AT_HEADER])
+      except (KeyError, ValueError):
+        pass
+
+    deadline = data.get('deadline')
+    if isinstance(deadline, (int, float)):
+      context['deadline'] = deadline
+      return context
+    slo = data.get('slo_seconds')
+    if not isinstance(slo, (int, float)):
+      slo = self.config.topic_slos.get(msg.topic(), self.config.slo_seconds)
+    if slo > 0:
+      context['deadline'] = sent_at + slo
+    return context
+
+  def _schedule(self, msg):
+    """
+    Decodes a consumed message and queues it for the scheduler. Returns the
+    serialize stage item of its 'shed' result if it expired on the way here
+    """
+    message = (msg.topic(), msg.partition(), msg.offset())
+    try:
+      codec = codec_for(msg.headers())
+    except ValueError as e:
+      logger.error(f"Failed to decode message: {e}")
+      bound(REQUESTS_FAILED, reason='unknown_content_type').inc()
+      self.offsets.done(*message)
+      return None
     try:
-      labels = get_labels()
-      queue_size = self.executor._work_queue.qsize()
-      QUEUE_DEPTH.labels(**labels).set(queue_size)
+      data = codec.decode(msg.value())
     except Exception as e:
-      logger.debug(f"Could not update queue depth: {e}")
+      logger.error(f"Failed to decode {codec.name} message: {e!r}")
+      bound(REQUESTS_FAILED, reason=f'{codec.name}_decode_error').inc()
+      self.offsets.done(*message)
+      return None
+    if not isinstance(data, dict):
+      logger.error(f"Message at {message} is not a JSON object")
+      bound(REQUESTS_FAILED, reason='invalid_message').inc()
+      self.offsets.done(*message)
+      return None
 
-  def run(self):
-    """Main service loop"""
-    logger.info(f"Starting LLM Service on node {self.config.node_id}")
-    start_http_server(self.config.metrics_port)
+    context = self._message_context(data, msg)
+    samples(STAGE_LATENCY, stage='transit').observe(max(0.0, context['transit']))
+    if context.get('deadline') is not None and time.time() > context['deadline']:
+      return (*self.shed(data, context, 'expired_on_arrival'), message, None)
+    if 'offloaded_from' in context:
+      bound(OFFLOADED_SERVED, origin=context['offloaded_from']).inc()
+      if 'offload_hop' in context:
+        samples(STAGE_LATENCY, stage='offload').observe(max(0.0, context['offload_hop']))
+    elif self.offload is not None and self.offload.update(len(self.scheduler), self.inference_slots):
+      if self.forward(msg, data, context, message):
+        return None
 
-    self.model.load()
-    self.setup_kafka()
+    self._enqueue(data, message, context)
+    return None
 
-    self.running = True
-    self.metrics_thread = threading.Thread(target=self.metrics_worker, daemon=True)
-    self.metrics_thread.start()
+  def _enqueue(self, data: dict, message: tuple, context: dict):
+    """Queues a decoded message for the scheduler"""
+    prompt_tokens = self._prompt_tokens(data)
+    self.scheduler.put(data, message, prompt_tokens + self._max_new_tokens(data), length_category(prompt_tokens), context)
 
-    logger.info("LLM Service ready")
-    
+  def _requeue(self, data: dict, message: tuple, context: dict):
+    """Queues a message from another thread, on the event loop: a direct request, or one that could not be offloaded"""
+    self._enqueue(data, message, context)
+    self._scheduled.set()
+    bound(PIPELINE_QUEUE_DEPTH, stage='schedule').set(len(self.scheduler))
+
+  def forward(self, msg, data: dict, context: dict, message: tuple) -> bool:
+    """
+    Offloads a message: forwards it unchanged to the offload topic, tagged with this
+    node and the time. The message is finished once the forward is acknowledged.
+    Returns False if the producer's queue is full, the message is then served here
+    """
+    headers = [(key, value) for key, value in (msg.headers() or []) if key not in (OFFLOADED_BY_HEADER, OFFLOADED_AT_HEADER)]
+    headers += [(OFFLOADED_BY_HEADER, self.config.node_id.encode('utf-8')), (OFFLOADED_AT_HEADER, repr(time.time()).encode('utf-8'))]
+
+    def on_delivery(error):
+      if error is None:
+        self.offsets.done(*message)
+      elif self.loop is not None:
+        logger.warning(f"Could not offload message {data.get('message_id', 'unknown')}, serving it locally")
+        self.loop.call_soon_threadsafe(self._requeue, data, message, context)
+      # Otherwise the service is stopping, the message stays uncommitted and is redelivered
+
+    try:
+      self.publisher.publish(msg.value(), msg.key(), headers, on_delivery, topic=self.config.offload_topic)
+    except BufferError:
+      return False
+    bound(REQUESTS_OFFLOADED, reason=self.offload.reason).inc()
+    bound(MESSAGES_PROCESSED, status='offloaded').inc()
+    return True
+
+  def consume(self) -> list:
+    """
+    Consumes the next batch of messages that fits into the in-flight window,
+    on the consumer's thread, and tracks them until they are finished
+    """
+    in_flight = self.offsets.in_flight()
+    self._apply_backpressure(in_flight)
+    batch_size = max(1, min(self.config.consume_batch_size, self.max_in_flight - in_flight))
+    messages = []
+    for msg in self.consumer.consume(num_messages=batch_size, timeout=0.1):
+      if not msg.error():
+        self.offsets.add(msg.topic(), msg.partition(), msg.offset())
+        messages.append(msg)
+    self._store_offsets()
+    bound(QUEUE_DEPTH).set(self.offsets.in_flight())
+    return messages
+
+  async def ingest(self):
+    """Ingest stage: consumes until the service stops"""
+    loop = asyncio.get_running_loop()
+    while self.running:
+      for msg in await loop.run_in_executor(self.consume_executor, self.consume):
+        await self.decode_queue.put(msg)
+      self._heartbeat = time.monotonic()
+
+  async def decode(self):
+    """Decode stage: parses and validates messages, sheds the expired ones and schedules the rest"""
+    while True:
+      msg = await self.decode_queue.get()
+      try:
+        shed = self._schedule(msg)
+        if shed is not None:
+          await self.serialize_queue.put(shed)
+        else:
+          self._scheduled.set()
+        bound(PIPELINE_QUEUE_DEPTH, stage='schedule').set(len(self.scheduler))
+      except Exception as e:
+        logger.error(f"Failed to decode message: {e}", exc_info=True)
+        bound(REQUESTS_FAILED, reason='decode_error').inc()
+        self.offsets.done(msg.topic(), msg.partition(), msg.offset())
+      finally:
+        self.decode_queue.task_done()
+
+  async def dispatch(self):
+    """Schedule stage: releases the next message by scheduling policy whenever an inference slot frees up"""
+    while True:
+      await self._slots.acquire()
+      item = self.scheduler.get(timeout=0)
+      while item is None:
+        self._scheduled.clear()
+        await self._scheduled.wait()
+        item = self.scheduler.get(timeout=0)
+      bound(PIPELINE_QUEUE_DEPTH, stage='schedule').set(len(self.scheduler))
+
+      deadline = item.context.get('deadline')
+      if deadline is not None and time.time() > deadline:
+        # Expired while waiting for a slot, shed without bothering a worker
+        self._slots.release()
+        await self.serialize_queue.put((*self.shed(item.data, item.context, 'expired_in_queue'), item.message, None))
+        continue
+
+      self._inferring += 1
+      self._dispatched[item.message] = time.perf_counter()
+      bound(PIPELINE_QUEUE_DEPTH, stage='infer').set(self._inferring)
+      if self.workers:
+        self.workers.submit(item.data, item.message, item.context)
+      else:
+        task = asyncio.create_task(self.run_inference(item))
+        self._inference_tasks.add(task)
+        task.add_done_callback(self._inference_tasks.discard)
+
+  async def run_inference(self, item):
+    """Infer stage: runs one message on the inference executor"""
     try:
-       while self.running:
-          msg = self.consumer.poll(timeout=0.1)
-          
-          if msg is None or msg.error():
-             continue
-          
+      output = await asyncio.get_running_loop().run_in_executor(self.executor, self.infer, item.data, item.context)
+    finally:
+      self._inference_done(item.message)
+    key, record = output if output is not None else (None, None)
+    load = request_load(record) if record is not None else None
+    if load is not None:
+      self.load.record_request(load)
+    await self.serialize_queue.put((key, record, item.message, time.perf_counter()))
+
+  async def serialize(self):
+    """Serialize stage: encodes records for the produce stage"""
+    while True:
+      key, record, message, finished_at = await self.serialize_queue.get()
+      try:
+        value = self.encode(record) if record is not None else None
+        await self.produce_queue.put((key, value, message, finished_at))
+      except Exception as e:
+        logger.error(f"Failed to serialize a result: {e}", exc_info=True)
+        bound(REQUESTS_FAILED, reason='serialize_error').inc()
+        if self.direct.owns(message):
+          self.direct.deliver(message, None)
+        elif message is not None:
+          self.offsets.done(*message)
+      finally:
+        self.serialize_queue.task_done()
+
+  def _delivered(self, message, finished_at):
+    """Delivery callback of a message's result: only now the consumer may commit past the message"""
+    def on_delivery(error):
+      if error is not None:
+        # The result is lost, the message is consumed again after a restart or rebalance
+        self.offsets.failed(*message)
+        return
+      if finished_at is not None:
+        samples(STAGE_LATENCY, stage='produce').observe(time.perf_counter() - finished_at)
+      self.offsets.done(*message)
+    return on_delivery
+
+  async def produce(self):
+    """
+    Produce stage: hands records to the result publisher. A message is finished
+    once its result is acknowledged, or right away if it has none. Records of
+    direct requests go to their HTTP handlers instead
+    """
+    while True:
+      key, value, message, finished_at = await self.produce_queue.get()
+      reply_to = message if message is not None else key
+      if self.direct.owns(reply_to):
+        self.direct.deliver(reply_to, value)
+        self.produce_queue.task_done()
+        continue
+      on_delivery = self._delivered(message, finished_at) if message is not None else None
+      try:
+        while value is not None:
           try:
-            data = json.loads(msg.value().decode('utf-8'))
-            self.executor.submit(self.handle_message, data)
-            self.update_queue_depth()
-            
-          except json.JSONDecodeError as e:
-            logger.error(f"Failed to decode message: {e}")
-            labels = get_labels()
-            REQUESTS_FAILED.labels(**labels, reason='json_decode_error').inc()
+            self.publish(value, key, on_delivery)
+            break
+          except BufferError:
+            # The producer's local queue is full, the poller frees it as deliveries complete
+            await asyncio.sleep(0.05)
+        if value is None and message is not None:
+          self.offsets.done(*message)
+      except Exception as e:
+        logger.error(f"Failed to produce a result: {e}")
+        bound(REQUESTS_FAILED, reason='produce_error').inc()
+        if message is not None:
+          self.offsets.done(*message)
+      finally:
+        self.produce_queue.task_done()
+
+  async def report_metrics(self):
+    """Updates the system metrics every 10 seconds, off the event loop"""
+    loop = asyncio.get_running_loop()
+    while True:
+      await loop.run_in_executor(None, self.update_system_metrics)
+      if self.offload is not None:
+        # Lets an idle node leave offloading without waiting for the next message
+        self.offload.update(len(self.scheduler), self.inference_slots)
+      await asyncio.sleep(10)
+
+  def load_status(self) -> dict:
+    """Load status of this node, what the router predicts completion times from"""
+    queue_depth = len(self.scheduler)
+    return {
+      'node_id': self.config.node_id,
+      'input_topic': self.config.input_topic,
+      'state': self.state,
+      'queue_depth': queue_depth,
+      'inferring': self._inferring,
+      'slots': self.inference_slots,
+      'predicted_wait': self.load.predicted_wait(queue_depth, self.inference_slots),
+      'service_time': self.load.service_time,
+      'ttft_p95': self.load.ttft_p95(),
+      'prefill_per_token': self.load.prefill_per_token,
+      'decode_per_token': self.load.decode_per_token,
+      'tokens_per_second': self.load.tokens_per_second(),
+      'offloading': self.offload is not None and self.offload.active,
+      'models': [self.model_name] + (self.pool.resident() if self.pool is not None else []),
+      'timestamp': time.time()
+    }
+
+  def publish_status(self):
+    """Publishes the status keyed by node id, so the status topic can be compacted"""
+    try:
+      self.publisher.publish(
+        self.result_codec.encode(self.load_status()),
+        self.config.node_id,
+        [(CONTENT_TYPE_HEADER, self.result_codec.content_type)],
+        topic=self.config.status_topic
+      )
+    except BufferError:
+      # The next status follows shortly, results go first
+      logger.debug("Producer queue full, skipping a status record")
+
+  async def report_status(self):
+    """Publishes the status every `status_interval` seconds"""
+    while True:
+      self.publish_status()
+      await asyncio.sleep(self.config.status_interval)
+
+  def stop(self):
+    """Stops ingesting, the pipeline then drains"""
+    logger.info("Draining before exit" if self.draining else "Received shutdown signal")
+    self.draining = self.draining or self.config.drain_on_stop
+    self.running = False
+
+  def live(self, request):
+    """Liveness: the process serves HTTP and, once ready, the consumer loop keeps turning"""
+    stalled = self.state == 'ready' and time.monotonic() - self._heartbeat > 60
+    workers_alive = self.workers is None or self.workers.alive()
+    return (
+      (503 if stalled or not workers_alive else 200),
+      'application/json',
+      {'state': self.state, 'stalled': stalled, 'workers_alive': workers_alive}
+    )
+
+  def status(self, request):
+    """The load status the router receives on the status topic"""
+    return 200, 'application/json', self.load_status()
+
+  def model_info(self, request):
+    """The serving model and the state of the last hot swap"""
+    return 200, 'application/json', {
+      'model': self.model_name,
+      'model_path': self.model.model_path,
+      'swap': self.swap_state,
+      'hosted': self.pool.status() if self.pool is not None else {}
+    }
+
+  def swap(self, request):
+    """
+    Hot swap: {"model_path": ..., "draft_model_path": ..., "snapshot_path": ...} loads
+    the model in the background and switches to it, see `swap_model`
+    """
+    try:
+      body = request.json_body()
+    except ValueError as e:
+      return 400, 'application/json', {'error': f"Invalid JSON: {e}"}
+    if not isinstance(body, dict) or not body.get('model_path'):
+      return 400, 'application/json', {'error': "'model_path' is required"}
+    if self.workers:
+      # Worker processes are forked with the weights of the first model
+      return 409, 'application/json', {'error': 'Hot swap is not supported with worker processes'}
+    if self.state != 'ready' or self.swap_state['state'] in ('loading', 'finishing'):
+      return 409, 'application/json', {'error': 'Cannot swap now', 'state': self.state, 'swap': self.swap_state}
+
+    self.swap_state = {'state': 'loading', 'model_path': body['model_path']}
+    threading.Thread(
+      target=self.swap_model,
+      args=(body['model_path'], body.get('draft_model_path', self.config.draft_model_path), body.get('snapshot_path')),
+      name='model-swap',
+      daemon=True
+    ).start()
+    return 202, 'application/json', {'swap': self.swap_state}
+
+  def drain_request(self, request):
+    """
+    Drain mode: stops consuming, finishes every consumed message including the ones
+    still waiting in the scheduler, commits their offsets and exits
+    """
+    if self.loop is None or not self.running:
+      return 409, 'application/json', {'state': self.state}
+    self.draining = True
+    self.loop.call_soon_threadsafe(self.stop)
+    return 202, 'application/json', {'state': 'draining'}
+
+  def generate(self, request):
+    """
+    Direct inference: {"prompt": ..., "parameters": {...}, "model": ..., "stream": false} and
+    optionally 'message_id', 'trace_id', 'deadline' or 'slo_seconds' as in a prompt message.
+    Scheduled with the consumed messages but never offloaded. Answers with the result record,
+    with "stream": true as server-sent events: 'chunk' events, then one 'final' event.
+    Without a result by its deadline (or DIRECT_TIMEOUT) the request is answered with 504
+    """
+    start = time.perf_counter()
+    try:
+      data = request.json_body()
+    except ValueError as e:
+      return 400, 'application/json', {'error': f"Invalid JSON: {e}"}
+    if not isinstance(data, dict) or not data.get('prompt'):
+      return 400, 'application/json', {'error': "'prompt' is required"}
+    if data.get('model') is not None and not self.hosts(data['model']):
+      return 404, 'application/json', {'error': f"Model '{data['model']}' is not hosted here"}
+
+    stream = bool(data.get('stream'))
+    mode = 'stream' if stream else 'unary'
+    opened = self.direct.open(stream) if self.state == 'ready' and self.running else None
+    if opened is None:
+      bound(DIRECT_REQUESTS, mode=mode, result='rejected').inc()
+      return 503, 'application/json', {'error': 'Not accepting requests', 'state': self.state, 'open': len(self.direct)}
+    message, exchange = opened
+    data.setdefault('message_id', f"{self.config.node_id}-direct-{message[2]}")
+    context = self._direct_context(data, message, stream)
+    # Never wait longer than the request is useful, or at most DIRECT_TIMEOUT
+    expires_at = context.get('deadline') or context['received_at'] + self.config.direct_timeout
+    try:
+      try:
+        self.loop.call_soon_threadsafe(self._requeue, data, message, context)
+      except (AttributeError, RuntimeError):
+        # The pipeline stopped in the meantime
+        exchange.put(STOPPED)
+      if stream:
+        result, response = self._stream_result(request, exchange, expires_at)
+      else:
+        result, response = self._unary_result(exchange, expires_at)
+    finally:
+      self.direct.close(message)
+    bound(DIRECT_REQUESTS, mode=mode, result=result).inc()
+    samples(DIRECT_REQUEST_TIME, mode=mode).observe(time.perf_counter() - start)
+    return response
+
+  def _direct_context(self, data: dict, message: tuple, stream: bool) -> dict:
+    """The context of a direct request, as `_message_context` builds it without a producer in between"""
+    received_at = time.time()
+    context = {
+      'model': data.get('model'),
+      'trace_id': data.get('trace_id') or data['message_id'],
+      'sent_at': received_at,
+      'received_at': received_at,
+      'reply_to': message,
+      'stream': stream
+    }
+    deadline = data.get('deadline')
+    if isinstance(deadline, (int, float)):
+      context['deadline'] = deadline
+      return context
+    slo = data.get('slo_seconds')
+    if not isinstance(slo, (int, float)):
+      slo = self.config.slo_seconds
+    if slo > 0:
+      context['deadline'] = received_at + slo
+    return context
+
+  def _unary_result(self, exchange, expires_at: float):
+    """(result, response) of a direct request answered with its result record"""
+    try:
+      value = exchange.get(expires_at - time.time())
+    except queue.Empty:
+      return 'timeout', (504, 'application/json', {'error': 'No result before the deadline'})
+    if value is STOPPED:
+      return 'stopped', (503, 'application/json', {'error': 'The service stopped before serving the request'})
+    if value is None:
+      return 'failed', (500, 'application/json', {'error': 'The request failed, see the service log'})
+    record = self.result_codec.decode(value)
+    status = record.get('status', 'failed')
+    return status, ({'success': 200, 'shed': 503}.get(status, 500), 'application/json', record)
+
+  def _stream_result(self, request, exchange, expires_at: float):
+    """(result, None) of a direct request streamed as server-sent events"""
+    request.start_events()
+    try:
+      while True:
+        try:
+          value = exchange.get(expires_at - time.time())
+        except queue.Empty:
+          request.send_event('error', {'status': 'timeout'})
+          return 'timeout', None
+        if value is STOPPED or value is None:
+          result = 'stopped' if value is STOPPED else 'failed'
+          request.send_event('error', {'status': result})
+          return result, None
+        record = self.result_codec.decode(value)
+        if record.get('type') == 'chunk':
+          request.send_event('chunk', record)
+        else:
+          request.send_event('final', record)
+          return record.get('status', 'failed'), None
+    except (BrokenPipeError, ConnectionResetError):
+      # The request keeps its inference slot until it finishes, its records are dropped
+      return 'disconnected', None
+
+  def ready(self, request):
+    """Readiness: model loaded, warmed up and subscribed to the input topic"""
+    return (200 if self.state == 'ready' else 503), 'application/json', {'state': self.state}
+
+  def startup(self):
+    """Loads the model and connects to Kafka concurrently, warms up, then subscribes"""
+    self.state = 'loading'
+    self.topology.report()
+    if self.config.processes > 1:
+      # Load alone, so no other thread holds a lock while the workers are forked
+      self.model.load(start_workers=False)
+      self.workers = WorkerProcesses(self.config.processes, self.run_worker, self._worker_publish, self._worker_done)
+      self.workers.start()
+      self.setup_kafka()
+      self.state = 'warming_up'
+      self.workers.wait_ready()
+    else:
+      with ThreadPoolExecutor(max_workers=2, thread_name_prefix='startup') as startup:
+        loading = [startup.submit(self.model.load), startup.submit(self.setup_kafka)]
+        for future in loading:
+          future.result()
+      self.state = 'warming_up'
+      self.prepare_model()
+    self.running = True
+
+  def prepare_model(self, model: Model = None):
+    """Compiles and warms up a model of this process, the serving one by default"""
+    model = model or self.model
+    if self.config.torch_compile:
+      model.compile()
+    if self.config.warmup_lengths:
+      model.warmup(self.config.warmup_lengths, self.config.warmup_new_tokens)
+
+  def run_worker(self, index: int, tasks, results):
+    """
+    Entry point of a forked inference worker: starts its engines on its share of
+    the topology, then handles prompts from the parent until it sends None
+    """
+    # Ctrl-C reaches the whole process group, the parent decides when workers stop
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    self.publish = lambda value, key=None: results.put(('publish', key, value))
+    try:
+      self.topology = self.topology.for_process(index, self.config.processes)
+      self.topology.pin()
+      self.model.topology = self.topology
+      self.model.start_workers()
+      self.prepare_model()
+    except Exception as e:
+      logger.error(f"Inference worker {index} failed to start: {e}", exc_info=True)
+      results.put(('failed', index, str(e)))
+      return
+
+    self.running = True
+    threading.Thread(target=self.metrics_worker, daemon=True).start()
+    results.put(('ready', index, None))
+    logger.info(f"Inference worker {index} ready")
+
+    while True:
+      task = tasks.get()
+      if task is None:
+        break
+      message, data, context = task
+      future = self.executor.submit(self.infer_encoded, data, context)
+      future.add_done_callback(
+        lambda future, message=message: results.put(
+          ('done', message, None if future.exception() else future.result())
+        )
+      )
+    self.running = False
+    self.executor.shutdown(wait=True)
+    self.model.close()
+    if self.pool is not None:
+      self.pool.close()
+    # The parent exposes what this process wrote, so nothing may stay buffered
+    flush_samples()
+
+  def run(self):
+    """Main service loop"""
+    logger.info(f"Starting LLM Service on node {self.config.node_id}")
+    self.http.start()
+
+    try:
+       self.startup()
+       asyncio.run(self.run_pipeline())
             
     except KeyboardInterrupt:
        logger.info("Received shutdown signal")
@@ -215,15 +1205,97 @@ class LLMService:
     finally:
        self.shutdown()
 
+  async def run_pipeline(self):
+    """Runs the pipeline stages until the service stops, then drains them"""
+    self.loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+      self.loop.add_signal_handler(sig, self.stop)
+
+    labels = get_labels()
+    queue_size = self.config.stage_queue_size or self.max_in_flight
+    self.decode_queue = StageQueue('decode', queue_size)
+    self.serialize_queue = StageQueue('serialize', queue_size)
+    self.produce_queue = StageQueue('produce', queue_size)
+    PIPELINE_QUEUE_CAPACITY.labels(**labels, stage='schedule').set(self.max_in_flight)
+    PIPELINE_QUEUE_CAPACITY.labels(**labels, stage='infer').set(self.inference_slots)
+    self._scheduled = asyncio.Event()
+    self._slots = asyncio.Semaphore(self.inference_slots)
+    dispatch = asyncio.create_task(self.dispatch(), name='dispatch')
+    stages = [
+      dispatch,
+      asyncio.create_task(self.decode(), name='decode'),
+      asyncio.create_task(self.serialize(), name='serialize'),
+      asyncio.create_task(self.produce(), name='produce'),
+      asyncio.create_task(self.report_metrics(), name='metrics')
+    ]
+    if self.config.status_topic:
+      stages.append(asyncio.create_task(self.report_status(), name='status'))
+
+    self.consumer.subscribe([self.config.input_topic], on_assign=self._on_assign, on_revoke=self._on_revoke)
+    self._heartbeat = time.monotonic()
+    self.state = 'ready'
+    SERVICE_READY.labels(**labels).set(1)
+    logger.info("LLM Service ready")
+    try:
+      await self.ingest()
+    finally:
+      await self.drain(dispatch, stages)
+
+  async def drain(self, dispatch, stages):
+    """
+    Finishes everything released by the scheduler and produces its results.
+    Messages still waiting in the scheduler stay uncommitted and are redelivered,
+    unless in drain mode, which finishes them as well
+    """
+    logger.info('Draining the pipeline...')
+    self.state = 'draining' if self.draining else 'stopping'
+    self.running = False
+    if self.config.status_topic:
+      # Tells the router right away to stop sending prompts here
+      self.publish_status()
+    await self.decode_queue.join()
+    if self.draining:
+      while len(self.scheduler) or self._inferring:
+        await asyncio.sleep(0.05)
+      logger.info('Backlog finished')
+    dispatch.cancel()
+    await asyncio.gather(*self._inference_tasks, return_exceptions=True)
+    if self.workers:
+      # Workers finish their queued prompts, their results still flow through the produce stage
+      await self.loop.run_in_executor(None, self.workers.stop)
+    await self.serialize_queue.join()
+    await self.produce_queue.join()
+    # Direct requests still waiting in the scheduler are not served anymore
+    self.direct.close_all()
+    for stage in stages:
+      stage.cancel()
+    await asyncio.gather(*stages, return_exceptions=True)
+    self.loop = None
+
   def shutdown(self):
      """Clean shutdown"""
      logger.info('Shutting down...')
+     self.state = 'stopping'
+     SERVICE_READY.labels(**get_labels()).set(0)
      self.running = False
-     if self.metrics_thread:
-        self.metrics_thread.join(timeout=2)
+     # Finish the in-flight messages first, so their offsets are committed on close
+     if self.workers:
+        self.workers.stop()
+     self.executor.shutdown(wait=True)
+     self.consume_executor.shutdown(wait=True)
+     # Results are acknowledged before the offsets of their messages are stored and committed
+     if self.publisher:
+        self.publisher.close()
      if self.consumer:
+        self._store_offsets()
+        try:
+          # Commit right away instead of relying on the periodic auto commit in close
+          self.consumer.commit(asynchronous=False)
+        except KafkaException as e:
+          logger.debug(f"No offsets committed: {e}")
         self.consumer.close()
-     if self.producer:
-        self.producer.flush()
-     self.executor.shutdown(wait=True)
+     self.model.close()
+     if self.pool is not None:
+        self.pool.close()
+     self.http.stop()
      logger.info("Shutdown complete!")
\ No newline at end of file
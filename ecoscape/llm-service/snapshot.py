@@ -0,0 +1,202 @@
+'''
+Memory-mapped model snapshots
+-----------------------------
+A snapshot is a directory holding the model weights already converted to the
+load dtype as a single safetensors file, the model/generation config, the
+tokenizer and a sidecar manifest ('snapshot.json') with the detected model type
+and the model it was converted from: its path and a fingerprint of its config and
+weight files. A snapshot of another model, or of a model changed since, is not used.
+
+Loading a snapshot maps the weight file read-only (copy-on-write) into memory
+and assigns tensors that view the mapping directly into a model skeleton whose
+parameters were never allocated, so no weight byte is copied or converted at
+startup and pages are only read from disk when first touched.
+
+Offline usage: python snapshot.py <model_path> <snapshot_dir> [precision]
+'''
+
+import hashlib
+import json
+import logging
+import mmap
+import os
+import shutil
+import struct
+import sys
+import tempfile
+import torch
+
+from accelerate import init_empty_weights
+from safetensors.torch import save_file
+from transformers import AutoConfig
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_FILE = 'snapshot.json'
+WEIGHTS_FILE = 'model.safetensors'
+FORMAT_VERSION = 2
+WEIGHT_SUFFIXES = ('.safetensors', '.bin', '.pt', '.pth')
+
+_DTYPES = {
+  'F64': torch.float64,
+  'F32': torch.float32,
+  'F16': torch.float16,
+  'BF16': torch.bfloat16,
+  'I64': torch.int64,
+  'I32': torch.int32,
+  'I16': torch.int16,
+  'I8': torch.int8,
+  'U8': torch.uint8,
+  'BOOL': torch.bool,
+}
+
+def read_manifest(snapshot_dir: str):
+  """Returns the manifest of a snapshot directory, None if there is no complete snapshot"""
+  path = os.path.join(snapshot_dir, MANIFEST_FILE)
+  if not os.path.exists(path):
+    return None
+  with open(path, 'r', encoding='utf-8') as f:
+    manifest = json.load(f)
+  return manifest if manifest.get('format') == FORMAT_VERSION else None
+
+def source_path(model_path: str) -> str:
+  """A local model directory as absolute path, hub model ids as they are"""
+  return os.path.abspath(model_path) if os.path.isdir(model_path) else model_path
+
+def source_fingerprint(model_path: str):
+  """
+  Hash of a local model directory's config and the names, sizes and modification times
+  of its weight files, so a changed model is noticed without reading its weights.
+  None for hub model ids
+  """
+  if not os.path.isdir(model_path):
+    return None
+  digest = hashlib.sha256()
+  config_path = os.path.join(model_path, 'config.json')
+  if os.path.exists(config_path):
+    with open(config_path, 'rb') as f:
+      digest.update(f.read())
+  for name in sorted(os.listdir(model_path)):
+    if name.endswith(WEIGHT_SUFFIXES):
+      stat = os.stat(os.path.join(model_path, name))
+      digest.update(f"{name}:{stat.st_size}:{stat.st_mtime_ns}".encode('utf-8'))
+  return digest.hexdigest()
+
+def snapshot_mismatch(manifest: dict, model_path: str):
+  """Why a snapshot was not converted from the model at `model_path` as it is now, None if it was"""
+  source = manifest.get('source') or {}
+  if source.get('path') != source_path(model_path):
+    return f"it was converted from {source.get('path')}, not {source_path(model_path)}"
+  if source.get('fingerprint') != source_fingerprint(model_path):
+    return f"{model_path} changed since it was converted"
+  return None
+
+def write_snapshot(model, tokenizer, model_type: str, precision: str, snapshot_dir: str, model_path: str):
+  """
+  Writes a snapshot of an already loaded (not quantized) model. The snapshot is
+  assembled in a temporary directory and moved into place atomically, so replicas
+  starting concurrently never see a partial snapshot.
+  """
+  parent = os.path.dirname(os.path.abspath(snapshot_dir))
+  os.makedirs(parent, exist_ok=True)
+  tmp_dir = tempfile.mkdtemp(prefix='.snapshot-', dir=parent)
+
+  try:
+    # Tied weights share storage; store them once and record the aliases
+    tensors, aliases, seen = {}, {}, {}
+    for name, tensor in model.state_dict().items():
+      key = (tensor.data_ptr(), tensor.dtype, tuple(tensor.shape))
+      if key in seen:
+        aliases[name] = seen[key]
+        continue
+      seen[key] = name
+      tensors[name] = tensor.detach().to('cpu').contiguous()
+    save_file(tensors, os.path.join(tmp_dir, WEIGHTS_FILE))
+
+    model.config.save_pretrained(tmp_dir)
+    if getattr(model, 'generation_config', None) is not None:
+      model.generation_config.save_pretrained(tmp_dir)
+    tokenizer.save_pretrained(tmp_dir)
+
+    manifest = {
+      'format': FORMAT_VERSION,
+      'model_type': model_type,
+      'architecture': type(model).__name__,
+      'dtype': str(model.dtype).replace('torch.', ''),
+      'precision': precision,
+      'source': {'path': source_path(model_path), 'fingerprint': source_fingerprint(model_path)},
+      'aliases': aliases,
+    }
+    with open(os.path.join(tmp_dir, MANIFEST_FILE), 'w', encoding='utf-8') as f:
+      json.dump(manifest, f, indent=2)
+
+    if os.path.exists(snapshot_dir):
+      shutil.rmtree(snapshot_dir)
+    os.rename(tmp_dir, snapshot_dir)
+    logger.info(f"Wrote model snapshot to {snapshot_dir}")
+  except Exception:
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    raise
+
+def map_weights(path: str) -> dict:
+  """Maps a safetensors file and returns tensors viewing the mapping, without copying"""
+  with open(path, 'rb') as f:
+    # ACCESS_COPY keeps the mapping writable for torch (private copy-on-write pages)
+    # while all processes mapping the file share the page cache as long as nothing writes
+    mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+
+  header_size = struct.unpack('<Q', mapped[:8])[0]
+  header = json.loads(mapped[8:8 + header_size])
+  data_start = 8 + header_size
+
+  tensors = {}
+  for name, info in header.items():
+    if name == '__metadata__':
+      continue
+    dtype = _DTYPES[info['dtype']]
+    start, end = info['data_offsets']
+    if end == start:
+      tensors[name] = torch.empty(info['shape'], dtype=dtype)
+      continue
+    count = (end - start) // torch.tensor([], dtype=dtype).element_size()
+    tensors[name] = torch.frombuffer(mapped, dtype=dtype, count=count, offset=data_start + start).view(info['shape'])
+  return tensors
+
+def load_snapshot(snapshot_dir: str, model_cls, manifest: dict):
+  """Builds the model from a snapshot, with all weights viewing the memory-mapped file"""
+  config = AutoConfig.from_pretrained(snapshot_dir)
+  dtype = getattr(torch, manifest['dtype'])
+
+  # Parameters stay on the meta device (never allocated), buffers are created normally
+  with init_empty_weights():
+    model = model_cls.from_config(config, torch_dtype=dtype)
+
+  state = map_weights(os.path.join(snapshot_dir, WEIGHTS_FILE))
+  for alias, name in manifest.get('aliases', {}).items():
+    state[alias] = state[name]
+  model.load_state_dict(state, strict=False, assign=True)
+
+  missing = [name for name, p in list(model.named_parameters()) + list(model.named_buffers()) if p.is_meta]
+  if missing:
+    raise RuntimeError(f"Snapshot {snapshot_dir} is missing weights: {missing[:5]}")
+
+  try:
+    from transformers import GenerationConfig
+    model.generation_config = GenerationConfig.from_pretrained(snapshot_dir)
+  except OSError:
+    pass
+  return model.eval()
+
+if __name__ == '__main__':
+  from transformers import AutoModelForCausalLM, AutoModelForSeq2SeqLM, AutoTokenizer
+  from precision import Precision, load_dtype
+
+  logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+  model_path, snapshot_dir = sys.argv[1], sys.argv[2]
+  precision = Precision(sys.argv[3] if len(sys.argv) > 3 else 'auto')
+
+  seq2seq = AutoConfig.from_pretrained(model_path).is_encoder_decoder
+  model_cls = AutoModelForSeq2SeqLM if seq2seq else AutoModelForCausalLM
+  model = model_cls.from_pretrained(model_path, torch_dtype=load_dtype(precision), low_cpu_mem_usage=True)
+  tokenizer = AutoTokenizer.from_pretrained(model_path)
+  write_snapshot(model, tokenizer, 'seq2seq' if seq2seq else 'causal', precision.value, snapshot_dir, model_path)
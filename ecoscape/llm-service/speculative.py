@@ -0,0 +1,168 @@
+import logging
+import time
+import torch
+
+from typing import List, Optional, Tuple
+from transformers import DynamicCache
+
+from engine import GenerationRequest, cache_layers, token_probs
+from metrics import (
+    SPEC_DRAFT_TOKENS,
+    SPEC_FALLBACKS,
+    SPEC_ENABLED,
+    bound,
+    get_labels
+)
+
+logger = logging.getLogger(__name__)
+
+def _crop(layers: list, length: int) -> list:
+  return [(k[:, :, :length], v[:, :, :length]) for k, v in layers]
+
+class SpeculativeDecoder:
+  """
+  Draft-and-verify decoding of a single sequence with a small draft model.
+
+  The draft proposes `num_tokens` tokens autoregressively, the target scores
+  all of them in one forward pass and keeps the longest accepted run plus one
+  corrected (or bonus) token. Greedy requests accept on argmax agreement,
+  sampled requests use speculative rejection sampling, so the output
+  distribution matches plain decoding in both cases.
+
+  Speculation falls back to plain decoding for a request whose acceptance
+  rate drops below `min_acceptance`, and for all requests for `cooldown`
+  seconds when the moving average over recent rounds does.
+  """
+
+  MIN_ROUNDS = 4
+
+  def __init__(self, draft_model, vocab_size: int, num_tokens: int = 4,
+               min_acceptance: float = 0.3, cooldown: float = 30.0):
+    self.draft = draft_model
+    self.vocab_size = vocab_size
+    self.num_tokens = num_tokens
+    self.min_acceptance = min_acceptance
+    self.cooldown = cooldown
+
+    self._owner = None    # request whose tokens are in the draft cache
+    self._layers = None
+    self._length = 0
+    self._acceptance = None
+    self._rounds = 0
+    self._disabled_until = 0.0
+    self._enabled = True
+
+  def active_for(self, request: GenerationRequest) -> bool:
+    enabled = time.monotonic() >= self._disabled_until
+    if enabled != self._enabled:
+      self._enabled = enabled
+      SPEC_ENABLED.labels(**get_labels()).set(int(enabled))
+    return enabled and request.speculate
+
+  def _forward(self, model, token_ids: List[int], layers: Optional[list]):
+    input_ids = torch.tensor([token_ids], dtype=torch.long, device=model.device)
+    return model(
+      input_ids=input_ids,
+      past_key_values=DynamicCache(layers) if layers else None,
+      use_cache=True
+    )
+
+  def _sync(self, sequence: List[int], request: GenerationRequest):
+    """Brings the draft cache to cover all but the last token of the sequence"""
+    target = len(sequence) - 1
+    if self._owner is not request:
+      self._owner, self._layers, self._length = request, None, 0
+    if self._length > target:
+      self._layers, self._length = _crop(self._layers, target), target
+    if self._length < target:
+      out = self._forward(self.draft, sequence[self._length:target], self._layers)
+      self._layers, self._length = cache_layers(out.past_key_values), target
+
+  @torch.inference_mode()
+  def step(self, target_model, target_layers: list, sequence: List[int],
+           request: GenerationRequest) -> Optional[Tuple[List[int], list]]:
+    """
+    Runs one draft/verify round for a sequence whose last token is not in the caches yet.
+    Returns the new tokens and the target cache covering all but the last of them,
+    or None if there is no room left for speculation.
+    """
+    remaining = request.max_new_tokens - len(request.tokens)
+    num_tokens = min(self.num_tokens, remaining - 1)
+    if num_tokens < 1:
+      return None
+    sampled = request.do_sample and request.temperature > 0
+
+    # Draft proposal
+    self._sync(sequence, request)
+    proposal, draft_probs = [], []
+    next_token = sequence[-1]
+    for _ in range(num_tokens):
+      out = self._forward(self.draft, [next_token], self._layers)
+      self._layers = cache_layers(out.past_key_values)
+      self._length += 1
+      logits = out.logits[0, -1, :self.vocab_size]
+      if sampled:
+        probs = token_probs(logits, request)
+        next_token = int(torch.multinomial(probs, num_samples=1)[0])
+        draft_probs.append(probs)
+      else:
+        next_token = int(logits.argmax())
+      proposal.append(next_token)
+
+    # Verification of all proposed tokens in one target forward pass
+    out = self._forward(target_model, [sequence[-1]] + proposal, target_layers)
+    logits = out.logits[0, :, :self.vocab_size]
+    accepted, final = 0, None
+    for i, token in enumerate(proposal):
+      if sampled:
+        probs = token_probs(logits[i], request)
+        if torch.rand(1).item() < min(1.0, (probs[token] / draft_probs[i][token]).item()):
+          accepted += 1
+          continue
+        residual = torch.clamp(probs - draft_probs[i], min=0)
+        residual = residual if residual.sum() > 0 else probs
+        final = int(torch.multinomial(residual / residual.sum(), num_samples=1)[0])
+      else:
+        final = int(logits[i].argmax())
+        if final == token:
+          accepted += 1
+          final = None
+          continue
+      break
+    if final is None:
+      # Every draft token was accepted, the target's last position yields a bonus token
+      final = (int(torch.multinomial(token_probs(logits[-1], request), num_samples=1)[0])
+               if sampled else int(logits[-1].argmax()))
+
+    self._track(request, num_tokens, accepted)
+    cache_length = len(sequence) + accepted
+    if self._length > cache_length:
+      self._layers, self._length = _crop(self._layers, cache_length), cache_length
+    return proposal[:accepted] + [final], _crop(cache_layers(out.past_key_values), cache_length)
+
+  def _track(self, request: GenerationRequest, proposed: int, accepted: int):
+    bound(SPEC_DRAFT_TOKENS, result='accepted').inc(accepted)
+    bound(SPEC_DRAFT_TOKENS, result='rejected').inc(proposed - accepted)
+
+    request.draft_proposed += proposed
+    request.draft_accepted += accepted
+    request.draft_rounds += 1
+    if (request.draft_rounds >= self.MIN_ROUNDS
+        and request.draft_accepted / request.draft_proposed < self.min_acceptance):
+      request.speculate = False
+      bound(SPEC_FALLBACKS, scope='request').inc()
+
+    rate = accepted / proposed
+    self._acceptance = rate if self._acceptance is None else 0.9 * self._acceptance + 0.1 * rate
+    self._rounds += 1
+    if self._rounds >= self.MIN_ROUNDS and self._acceptance < self.min_acceptance:
+      logger.info(f"Draft acceptance rate {self._acceptance:.2f} below {self.min_acceptance}, "
+                  f"falling back to plain decoding for {self.cooldown:.0f}s")
+      self._disabled_until = time.monotonic() + self.cooldown
+      self._acceptance, self._rounds = None, 0
+      bound(SPEC_FALLBACKS, scope='global').inc()
+
+  def release(self):
+    """Drops the draft cache once its sequence stops being speculated"""
+    if self._owner is not None:
+      self._owner, self._layers, self._length = None, None, 0
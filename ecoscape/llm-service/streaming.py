@@ -0,0 +1,129 @@
+import time
+
+from array import array
+from transformers.generation.streamers import BaseStreamer
+
+class ChunkCoalescer:
+  """
+  Groups streamed text into chunks by token count or elapsed time.
+
+  The first token is emitted right away so consumers observe the real TTFT;
+  after that a chunk is emitted once `max_tokens` tokens are pending or
+  `max_interval` seconds passed since the last chunk.
+  """
+
+  def __init__(self, emit, max_tokens: int = 16, max_interval: float = 0.25):
+    self.emit = emit
+    self.max_tokens = max_tokens
+    self.max_interval = max_interval
+    self.sequence = 0
+    self._parts = []
+    self._tokens = 0
+    self._last_emit = time.time()
+
+  def add(self, text: str, tokens: int = 1):
+    self._parts.append(text)
+    self._tokens += tokens
+    if (self.sequence == 0
+        or self._tokens >= self.max_tokens
+        or time.time() - self._last_emit >= self.max_interval):
+      self.flush()
+
+  def tick(self):
+    """Emits pending text if the interval elapsed without new tokens"""
+    if self._tokens and time.time() - self._last_emit >= self.max_interval:
+      self.flush()
+
+  def flush(self):
+    """Emits all pending text as one chunk"""
+    if not self._tokens:
+      return
+    self.emit(''.join(self._parts), self._tokens, self.sequence)
+    self.sequence += 1
+    self._parts = []
+    self._tokens = 0
+    self._last_emit = time.time()
+
+class IncrementalDecoder:
+  """Turns a growing list of token ids into text deltas"""
+
+  def __init__(self, tokenizer):
+    self.tokenizer = tokenizer
+    self._text = ''
+
+  def delta(self, token_ids) -> str:
+    text = self.tokenizer.decode(token_ids, skip_special_tokens=True)
+    # Hold back incomplete multi-byte characters until the next token completes them
+    if text.endswith('�'):
+      return ''
+    delta = text[len(self._text):]
+    self._text = text
+    return delta
+
+def replay_text(stream: ChunkCoalescer, tokenizer, text: str):
+  """
+  Streams text that was not generated for this request (a cached response) in the
+  chunks a live generation would have: the first token, then `max_tokens` at a time
+  """
+  ids = tokenizer.encode(text, add_special_tokens=False)
+  if not ids:
+    return
+  decoder = IncrementalDecoder(tokenizer)
+  emitted = 0
+  for count in [1] + list(range(1 + stream.max_tokens, len(ids), stream.max_tokens)) + [len(ids)]:
+    if count > emitted:
+      stream.add(decoder.delta(ids[:count]), count - emitted)
+      emitted = count
+  stream.flush()
+
+class TokenRecorder:
+  """Generated token ids and their monotonic arrival times in preallocated arrays"""
+
+  def __init__(self, capacity: int):
+    self._ids = array('q', bytes(8 * capacity))
+    self._times = array('d', bytes(8 * capacity))
+    self.count = 0
+
+  def record(self, token: int, timestamp: float):
+    self._ids[self.count] = token
+    self._times[self.count] = timestamp
+    self.count += 1
+
+  def __len__(self):
+    return self.count
+
+  def ids(self, count: int = None) -> list:
+    return self._ids[:self.count if count is None else count].tolist()
+
+  def times(self) -> list:
+    return self._times[:self.count].tolist()
+
+class TokenIdStreamer(BaseStreamer):
+  """
+  Streamer for model.generate that records token ids into a GenerationRequest
+  instead of detokenizing every token and pushing text through a queue.
+  """
+
+  def __init__(self, request, skip_ids=()):
+    self.request = request
+    self.skip_ids = set(skip_ids)
+    self._prompt_skipped = False
+
+  def put(self, value):
+    # The first put carries the prompt (or the decoder start token for seq2seq)
+    if not self._prompt_skipped:
+      self._prompt_skipped = True
+      return
+    now = time.perf_counter()
+    request = self.request
+    for token in value.reshape(-1).tolist():
+      if token not in self.skip_ids and len(request.tokens) < request.max_new_tokens:
+        request.tokens.record(token, now)
+    if request.progress is not None:
+      request.progress.set()
+
+  def end(self):
+    self.request.finished_at = time.perf_counter()
+    self.request.done.set()
+    if self.request.progress is not None:
+      self.request.progress.set()
@@ -0,0 +1,44 @@
+import time
+from types import SimpleNamespace
+
+from codec import get_codec
+from direct import STOPPED, DirectRequests
+from service import LLMService
+
+def direct_service():
+  return SimpleNamespace(result_codec=get_codec('json'))
+
+class EventRecorder:
+  """The server-sent event side of an HTTP request handler"""
+
+  def __init__(self):
+    self.events = []
+
+  def start_events(self):
+    pass
+
+  def send_event(self, event, data):
+    self.events.append((event, data))
+
+def test_unary_request_without_result_times_out():
+  _, exchange = DirectRequests(1).open(False)
+  start = time.time()
+  result, (status, _, _) = LLMService._unary_result(direct_service(), exchange, time.time() + 0.1)
+  assert (result, status) == ('timeout', 504)
+  assert time.time() - start < 1
+
+def test_streamed_request_without_final_record_times_out():
+  service, request = direct_service(), EventRecorder()
+  _, exchange = DirectRequests(1).open(True)
+  exchange.put(service.result_codec.encode({'type': 'chunk', 'sequence': 0, 'text': 'a'}))
+  result, _ = LLMService._stream_result(service, request, exchange, time.time() + 0.1)
+  assert result == 'timeout'
+  assert [event for event, _ in request.events] == ['chunk', 'error']
+
+def test_requests_waiting_when_the_service_stops_are_released():
+  requests = DirectRequests(2)
+  _, exchange = requests.open(False)
+  requests.close_all()
+  result, (status, _, _) = LLMService._unary_result(direct_service(), exchange, time.time() + 5)
+  assert (result, status) == ('stopped', 503)
+  assert requests.open(False) is None
@@ -0,0 +1,37 @@
+import random
+
+import pytest
+from prometheus_client import CollectorRegistry, Histogram
+
+from metrics import observe_many
+
+def histogram_samples(histogram):
+  return {
+    (sample.name, sample.labels.get('le')): sample.value
+    for metric in histogram.collect() for sample in metric.samples if not sample.name.endswith('_created')
+  }
+
+def test_observe_many_matches_observe_per_value():
+  values = [random.uniform(0, 20) for _ in range(500)] + [0.005, 0.1, 10.0, float('inf')]
+  buckets = (0.005, 0.01, 0.1, 1.0, 10.0)
+  batched, single = (
+    Histogram('latency_seconds', 'Latency', ['stage'], buckets=buckets, registry=CollectorRegistry())
+    for _ in range(2)
+  )
+  observe_many(batched.labels(stage='decode'), values)
+  for value in values:
+    single.labels(stage='decode').observe(value)
+  # Bucket counts match exactly, the sum up to the order its values were added in
+  assert histogram_samples(batched) == pytest.approx(histogram_samples(single))
+
+class Unbucketed:
+  def __init__(self):
+    self.observed = []
+
+  def observe(self, value):
+    self.observed.append(value)
+
+def test_observe_many_falls_back_to_observe_without_private_buckets():
+  histogram = Unbucketed()
+  observe_many(histogram, [0.1, 0.2])
+  assert histogram.observed == [0.1, 0.2]
@@ -0,0 +1,31 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+import pytest
+import torch
+
+from engine import GenerationRequest
+from model import Model
+
+class Inputs(dict):
+  def to(self, device):
+    return self
+
+def test_close_fails_requests_still_queued_for_a_generate_worker():
+  release = threading.Event()
+  model = Model('/models/seq2seq')
+  model.tokenizer = SimpleNamespace(all_special_ids=[], eos_token_id=0)
+  model.model = SimpleNamespace(device='cpu', generate=lambda streamer, **kwargs: (release.wait(), streamer.end()))
+  model.generate_pool = ThreadPoolExecutor(max_workers=1)
+
+  running, queued = (GenerationRequest(input_ids=torch.tensor([[1]]), max_new_tokens=4) for _ in range(2))
+  for request in (running, queued):
+    model._start_generate_thread(request, Inputs(input_ids=request.input_ids))
+  model.close()
+
+  assert queued.done.is_set()
+  with pytest.raises(RuntimeError):
+    queued.wait()
+  release.set()
+  assert running.wait() is running
@@ -0,0 +1,44 @@
+from types import SimpleNamespace
+
+import torch
+
+from model_pool import ModelPool, model_bytes
+
+def loaded(module):
+  return SimpleNamespace(model=module, draft_model=None)
+
+def test_model_bytes_counts_dynamically_quantized_weights():
+  module = torch.nn.Sequential(torch.nn.Linear(64, 64), torch.nn.ReLU(), torch.nn.Linear(64, 8))
+  quantized = torch.ao.quantization.quantize_dynamic(module, {torch.nn.Linear}, dtype=torch.qint8)
+  # int8 weights (one byte each) plus float biases, none of them in parameters()
+  assert model_bytes(loaded(quantized)) >= 64 * 64 + 64 * 8 + (64 + 8) * 4
+  assert model_bytes(loaded(quantized)) < model_bytes(loaded(module))
+
+class FakeModel:
+  def __init__(self, path):
+    self.model_path = path
+    self.model = None
+    self.draft_model = None
+    self.closed = False
+
+  def load(self):
+    self.model = torch.nn.Linear(16, 16)
+
+  def close(self):
+    self.closed = True
+
+def test_loaded_models_are_prepared_before_use():
+  prepared = []
+  pool = ModelPool(lambda path, snapshot_path: FakeModel(path), {'a': '/models/a'}, prepare=prepared.append)
+  with pool.acquire('a') as model:
+    assert prepared == [model]
+  with pool.acquire('a'):
+    assert len(prepared) == 1
+
+def test_idle_models_are_evicted_least_recently_used_first():
+  size = model_bytes(loaded(torch.nn.Linear(16, 16)))
+  pool = ModelPool(lambda path, snapshot_path: FakeModel(path), {'a': '/a', 'b': '/b', 'c': '/c'}, budget=2 * size)
+  for name in ('a', 'b', 'a', 'c'):
+    with pool.acquire(name):
+      pass
+  assert pool.resident() == ['a', 'c']
@@ -0,0 +1,24 @@
+from offsets import OffsetTracker
+
+def committed(tracker):
+  return [(tp.partition, tp.offset) for tp in tracker.committable()]
+
+def test_offsets_advance_over_finished_messages_in_order():
+  tracker = OffsetTracker()
+  for offset in range(3):
+    tracker.add('in', 0, offset)
+  tracker.done('in', 0, 1)
+  assert committed(tracker) == []
+  tracker.done('in', 0, 0)
+  assert committed(tracker) == [(0, 2)]
+  assert tracker.in_flight() == 1
+
+def test_failed_message_leaves_the_window_but_is_never_committed():
+  tracker = OffsetTracker()
+  for offset in range(3):
+    tracker.add('in', 0, offset)
+  tracker.done('in', 0, 0)
+  tracker.failed('in', 0, 1)
+  tracker.done('in', 0, 2)
+  assert committed(tracker) == [(0, 1)]
+  assert tracker.in_flight() == 0
@@ -0,0 +1,17 @@
+import torch
+
+from prefix_cache import PrefixCache
+
+def layers(tokens: int, fill: float):
+  return [(torch.full((1, 2, tokens, 4), fill), torch.full((1, 2, tokens, 4), -fill))]
+
+def test_lookup_matches_only_cached_blocks_of_the_same_prefix():
+  cache = PrefixCache(max_bytes=1 << 20, block_size=4)
+  cache.insert(list(range(9)), layers(9, 1.0))
+
+  tokens, cached = cache.lookup(list(range(8)) + [100, 101])
+  assert tokens == 8
+  assert torch.equal(cached[0][0], torch.full((1, 2, 8, 4), 1.0))
+
+  # Same second block after a different first one is a different prefix
+  assert cache.lookup([9, 9, 9, 9, 4, 5, 6, 7, 8]) == (0, None)
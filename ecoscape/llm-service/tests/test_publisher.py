@@ -0,0 +1,80 @@
+import threading
+import time
+
+from confluent_kafka import KafkaError
+
+from publisher import ResultPublisher
+
+class FakeProducer:
+  """Queues delivery reports until poll(), like the real producer"""
+
+  def __init__(self, error=None):
+    self.error = error
+    self.produced = []
+    self._reports = []
+
+  def produce(self, topic, key=None, value=None, headers=None, on_delivery=None):
+    self.produced.append(topic)
+    self._reports.append(on_delivery)
+
+  def poll(self, timeout=None):
+    reports, self._reports = self._reports, []
+    for report in reports:
+      report(self.error, None)
+    if not reports:
+      time.sleep(timeout or 0)
+    return len(reports)
+
+  def flush(self, timeout=None):
+    self.poll(0)
+    return 0
+
+  def __len__(self):
+    return len(self._reports)
+
+def publisher(error=None):
+  publisher = ResultPublisher('localhost:9092', 'results')
+  publisher.producer = FakeProducer(error)
+  return publisher
+
+def delivered_on_poller(publisher, topic):
+  """Publishes through the poller thread, returns the delivery errors and whether the poller survived"""
+  errors = []
+  done = threading.Event()
+  publisher.start()
+  try:
+    publisher.publish(b'{}', 'key', on_delivery=lambda error: (errors.append(error), done.set()), topic=topic)
+    assert done.wait(2), 'no delivery report'
+    # A second record is only reported if the first report did not kill the poller
+    done.clear()
+    publisher.publish(b'{}', 'key', on_delivery=lambda error: (errors.append(error), done.set()), topic=topic)
+    assert done.wait(2), 'the poller stopped serving delivery reports'
+    return errors, publisher._poller.is_alive()
+  finally:
+    publisher.close(timeout=1)
+
+def test_delivery_to_the_result_topic():
+  errors, alive = delivered_on_poller(publisher(), None)
+  assert errors == [None, None]
+  assert alive
+
+def test_delivery_to_another_topic_is_not_a_failure():
+  # Forwarded prompts (offload topic)
+  errors, alive = delivered_on_poller(publisher(), 'llm-input-cloud')
+  assert errors == [None, None]
+  assert alive
+
+def test_failed_delivery_reaches_the_callback():
+  error = KafkaError(KafkaError.MSG_SIZE_TOO_LARGE)
+  errors, alive = delivered_on_poller(publisher(error), 'llm-input-cloud')
+  assert [e.code() for e in errors] == [KafkaError.MSG_SIZE_TOO_LARGE] * 2
+  assert alive
+
+def test_retriable_failure_is_reported_and_not_produced_again():
+  # The producer already retried it until the delivery timeout, producing it again could duplicate it
+  error = KafkaError(KafkaError._MSG_TIMED_OUT, retriable=True)
+  publisher_ = publisher(error)
+  errors, alive = delivered_on_poller(publisher_, None)
+  assert [e.code() for e in errors] == [KafkaError._MSG_TIMED_OUT] * 2
+  assert publisher_.producer.produced == ['results', 'results']
+  assert alive
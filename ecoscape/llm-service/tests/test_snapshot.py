@@ -0,0 +1,31 @@
+import os
+
+from snapshot import snapshot_mismatch, source_fingerprint, source_path
+
+def model_dir(tmp_path, name):
+  path = tmp_path / name
+  path.mkdir()
+  (path / 'config.json').write_text('{"model_type": "gpt2"}')
+  (path / 'model.safetensors').write_bytes(b'weights')
+  return str(path)
+
+def manifest_for(model_path):
+  return {'source': {'path': source_path(model_path), 'fingerprint': source_fingerprint(model_path)}}
+
+def test_snapshot_of_the_same_model_matches(tmp_path):
+  path = model_dir(tmp_path, 'model')
+  assert snapshot_mismatch(manifest_for(path), path) is None
+
+def test_snapshot_of_another_model_does_not_match(tmp_path):
+  manifest = manifest_for(model_dir(tmp_path, 'model'))
+  assert snapshot_mismatch(manifest, model_dir(tmp_path, 'other'))
+  assert snapshot_mismatch(manifest, str(tmp_path / 'missing'))
+
+def test_snapshot_of_a_changed_model_does_not_match(tmp_path):
+  path = model_dir(tmp_path, 'model')
+  manifest = manifest_for(path)
+  os.utime(os.path.join(path, 'model.safetensors'), ns=(1, 1))
+  assert snapshot_mismatch(manifest, path)
+
+def test_snapshot_without_source_does_not_match(tmp_path):
+  assert snapshot_mismatch({}, model_dir(tmp_path, 'model'))
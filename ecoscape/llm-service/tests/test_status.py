@@ -0,0 +1,30 @@
+import threading
+from types import SimpleNamespace
+
+from codec import get_codec
+from service import LLMService
+from test_publisher import publisher
+
+def status_service():
+  """The parts of an LLMService that publish_status uses, with the real publisher"""
+  return SimpleNamespace(
+    config=SimpleNamespace(node_id='edge-1', status_topic='llm-status'),
+    publisher=publisher(),
+    result_codec=get_codec('json'),
+    load_status=lambda: {'node_id': 'edge-1', 'state': 'ready', 'queue_depth': 0}
+  )
+
+def test_status_records_do_not_stop_result_deliveries():
+  service = status_service()
+  service.publisher.start()
+  try:
+    for _ in range(3):
+      LLMService.publish_status(service)
+    # Results published after delivered status records are still acknowledged
+    delivered = threading.Event()
+    service.publisher.publish(b'{}', on_delivery=lambda error: error is None and delivered.set())
+    assert delivered.wait(2), 'result delivery was not reported after status records'
+    assert service.publisher._poller.is_alive()
+    assert service.publisher.producer.produced == ['llm-status'] * 3 + ['results']
+  finally:
+    service.publisher.close(timeout=1)
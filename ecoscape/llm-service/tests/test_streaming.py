@@ -0,0 +1,55 @@
+from types import SimpleNamespace
+
+from response_cache import ResponseCache
+from service import LLMService
+from streaming import ChunkCoalescer
+
+class CharTokenizer:
+  """One token per character"""
+
+  def encode(self, text, add_special_tokens=False):
+    return [ord(char) for char in text]
+
+  def decode(self, ids, skip_special_tokens=True):
+    return ''.join(chr(i) for i in ids)
+
+class FakeModel:
+  model_path = '/models/fake'
+  tokenizer = CharTokenizer()
+
+  def __init__(self, response):
+    self.response = response
+    self.generations = 0
+
+  def generate(self, prompt, max_new_tokens, stream, sampling, stages):
+    self.generations += 1
+    if stream is not None:
+      for char in self.response:
+        stream.add(char, 1)
+      stream.flush()
+    return self.response, 0.1, len(self.response), len(prompt)
+
+def cached_service():
+  return SimpleNamespace(
+    response_cache=ResponseCache(16, 60),
+    config=SimpleNamespace(response_cache_sampled=False)
+  )
+
+def streamed(service, model, max_tokens=4):
+  chunks = []
+  stream = ChunkCoalescer(lambda text, tokens, sequence: chunks.append((text, tokens, sequence)), max_tokens, 60)
+  params = {'max_new_tokens': 32, 'do_sample': False, 'temperature': 0.0, 'top_k': 0, 'top_p': 1.0}
+  value, cache_result = LLMService._generate(service, model, 'prompt', params, stream)
+  return value, cache_result, chunks
+
+def test_streamed_cache_hit_replays_the_response_as_chunks():
+  service, model = cached_service(), FakeModel('the cached answer')
+  _, first, generated = streamed(service, model)
+  _, second, replayed = streamed(service, model)
+
+  assert (first, second) == (ResponseCache.MISS, ResponseCache.HIT)
+  assert model.generations == 1
+  assert ''.join(text for text, _, _ in replayed) == 'the cached answer'
+  assert [sequence for _, _, sequence in replayed] == list(range(len(replayed)))
+  # Same chunking as the live generation: the first token alone, then max_tokens at a time
+  assert replayed == generated
@@ -0,0 +1,182 @@
+'''
+Thread topology
+---------------
+Decides how many compute workers the service runs, how many torch intra-op
+and inter-op threads each of them uses, which CPUs each worker is pinned to
+and on which NUMA node memory is allocated.
+
+Without explicit settings the available CPUs are divided evenly between the
+intra-op pools of the workers, so workers do not oversubscribe cores. With a
+NUMA node, workers are pinned to the node's CPUs and memory is preferably
+allocated on that node.
+'''
+
+import ctypes
+import ctypes.util
+import itertools
+import logging
+import os
+import threading
+import torch
+
+from dataclasses import dataclass, field
+from typing import List, Optional
+
+from metrics import (
+    TOPOLOGY_WORKERS,
+    TOPOLOGY_THREADS,
+    TOPOLOGY_CPUS,
+    TOPOLOGY_NUMA_NODE,
+    get_labels
+)
+
+logger = logging.getLogger(__name__)
+
+def parse_cpu_list(text: str) -> List[int]:
+  """Parses a Linux cpu list like '0-3,8,10-11'"""
+  cpus = []
+  for part in text.strip().split(','):
+    if not part:
+      continue
+    if '-' in part:
+      first, last = part.split('-')
+      cpus.extend(range(int(first), int(last) + 1))
+    else:
+      cpus.append(int(part))
+  return cpus
+
+def available_cpus() -> List[int]:
+  if hasattr(os, 'sched_getaffinity'):
+    return sorted(os.sched_getaffinity(0))
+  return list(range(os.cpu_count() or 1))
+
+def numa_node_cpus(node: int) -> List[int]:
+  with open(f'/sys/devices/system/node/node{node}/cpulist', 'r') as f:
+    return parse_cpu_list(f.read())
+
+def _split(cpus: List[int], parts: int) -> List[List[int]]:
+  """Splits cpus into `parts` contiguous, evenly sized sets"""
+  size, extra = divmod(len(cpus), parts)
+  sets, start = [], 0
+  for i in range(parts):
+    end = start + size + (1 if i < extra else 0)
+    sets.append(cpus[start:end])
+    start = end
+  return sets
+
+@dataclass
+class ThreadTopology:
+  workers: int = 1
+  intra_op_threads: int = 1
+  inter_op_threads: int = 0  # 0 keeps the torch default
+  cpu_sets: List[List[int]] = field(default_factory=list)  # per worker, empty = not pinned
+  numa_node: Optional[int] = None
+
+  def __post_init__(self):
+    self._next_worker = itertools.count()
+    self._lock = threading.Lock()
+
+  @classmethod
+  def resolve(cls, workers: int = 1, intra_op_threads: int = 0, inter_op_threads: int = 0,
+              cpu_affinity: str = None, numa_node: int = None) -> 'ThreadTopology':
+    """
+    Builds the effective topology from the config. `cpu_affinity` holds one cpu
+    list per worker separated by ';' (e.g. '0-3;4-7'), sets are reused round-robin
+    if there are fewer sets than workers.
+    """
+    workers = max(1, workers)
+    cpus = available_cpus()
+
+    if numa_node is not None:
+      try:
+        node_cpus = [cpu for cpu in numa_node_cpus(numa_node) if cpu in cpus]
+      except OSError as e:
+        logger.warning(f"NUMA node {numa_node} not found ({e}), ignoring NUMA_NODE")
+        numa_node, node_cpus = None, []
+      if node_cpus:
+        cpus = node_cpus
+
+    if cpu_affinity:
+      sets = [parse_cpu_list(part) for part in cpu_affinity.split(';') if part.strip()]
+      unavailable = sorted(set().union(*sets) - set(cpus))
+      if unavailable:
+        raise ValueError(f"CPU_AFFINITY uses CPUs {unavailable} outside the available CPUs {cpus}")
+      cpu_sets = [sets[i % len(sets)] for i in range(workers)]
+    elif numa_node is not None:
+      cpu_sets = _split(cpus, min(workers, len(cpus)))
+      cpu_sets = [cpu_sets[i % len(cpu_sets)] for i in range(workers)]
+    else:
+      cpu_sets = []
+
+    if intra_op_threads <= 0:
+      intra_op_threads = min(len(s) for s in cpu_sets) if cpu_sets else max(1, len(cpus) // workers)
+
+    return cls(workers, intra_op_threads, inter_op_threads, cpu_sets, numa_node)
+
+  def apply_process(self):
+    """
+    Process-wide settings, must run before torch does any parallel work and before
+    threads that should inherit the memory policy are started
+    """
+    if self.inter_op_threads > 0:
+      try:
+        torch.set_num_interop_threads(self.inter_op_threads)
+      except RuntimeError as e:
+        logger.warning(f"Could not set inter-op threads: {e}")
+    torch.set_num_threads(self.intra_op_threads)
+
+    if self.numa_node is not None:
+      self._prefer_numa_memory()
+    self.pin()
+
+  def pin(self):
+    """Restricts the calling thread, and threads it starts later, to the CPUs of all workers"""
+    if self.cpu_sets and hasattr(os, 'sched_setaffinity'):
+      os.sched_setaffinity(0, sorted(set().union(*self.cpu_sets)))
+
+  def for_process(self, index: int, processes: int) -> 'ThreadTopology':
+    """Topology of one of `processes` worker processes, owning consecutive worker slots"""
+    workers = self.workers // processes
+    cpu_sets = self.cpu_sets[index * workers:(index + 1) * workers]
+    return ThreadTopology(workers, self.intra_op_threads, self.inter_op_threads, cpu_sets, self.numa_node)
+
+  def _prefer_numa_memory(self):
+    """Sets the preferred NUMA node for allocations of this and all threads started later"""
+    path = ctypes.util.find_library('numa')
+    if path is None:
+      logger.warning("libnuma not found, memory is not bound to a NUMA node")
+      return
+    libnuma = ctypes.CDLL(path)
+    if libnuma.numa_available() < 0:
+      logger.warning("NUMA is not available on this host, memory is not bound to a NUMA node")
+      return
+    libnuma.numa_set_preferred(self.numa_node)
+
+  def bind_worker(self, index: int):
+    """Applies the per-worker settings to the calling thread"""
+    cpus = self.cpu_sets[index % len(self.cpu_sets)] if self.cpu_sets else None
+    if cpus and hasattr(os, 'sched_setaffinity'):
+      # pid 0 is the calling thread; intra-op threads created later inherit the mask
+      os.sched_setaffinity(0, cpus)
+    torch.set_num_threads(self.intra_op_threads)
+
+  def bind_next(self):
+    """Thread pool initializer, binds each new pool thread to the next worker slot"""
+    with self._lock:
+      index = next(self._next_worker) % self.workers
+    self.bind_worker(index)
+
+  def report(self):
+    """Logs the effective topology and exports it as metrics"""
+    labels = get_labels()
+    inter_op_threads = self.inter_op_threads or torch.get_num_interop_threads()
+    TOPOLOGY_WORKERS.labels(**labels).set(self.workers)
+    TOPOLOGY_NUMA_NODE.labels(**labels).set(-1 if self.numa_node is None else self.numa_node)
+    for index in range(self.workers):
+      cpus = self.cpu_sets[index] if self.cpu_sets else []
+      TOPOLOGY_THREADS.labels(**labels, worker=str(index), pool='intra_op').set(self.intra_op_threads)
+      TOPOLOGY_THREADS.labels(**labels, worker=str(index), pool='inter_op').set(inter_op_threads)
+      TOPOLOGY_CPUS.labels(**labels, worker=str(index)).set(len(cpus))
+      logger.info(f"Worker {index}: {self.intra_op_threads} intra-op / {inter_op_threads} inter-op threads, "
+                  f"cpus {cpus or 'unpinned'}")
+    logger.info(f"Thread topology: {self.workers} worker(s), NUMA node {self.numa_node}")
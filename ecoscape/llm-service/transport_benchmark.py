@@ -0,0 +1,195 @@
+'''
+Transport benchmark
+-------------------
+End-to-end latency of the same kind of prompts sent to running services over
+Kafka (input topic to result topic) and directly over HTTP (POST /generate),
+alternating between the two so both meet the same model state. Every result
+carries the service's processing time; what remains of the end-to-end latency
+is transport: broker hops, batching and polling for Kafka, the HTTP exchange for
+the endpoint. Nodes are measured one after another, one request at a time, so
+no queueing ends up in the numbers.
+
+  python transport_benchmark.py BOOTSTRAP_SERVERS NODE [NODE ...] [--requests N] [--stream]
+
+with every NODE given as name=input_topic,result_topic,url, for example
+edge=llm-input-edge,llm-results-edge,http://localhost:8000
+'''
+
+import argparse
+import json
+import random
+import time
+import uuid
+
+import requests
+
+from confluent_kafka import OFFSET_END, Consumer, Producer
+
+from benchmark_data import PROMPT_TOKENS, random_text
+from codec import CONTENT_TYPE_HEADER, codec_for, get_codec
+
+RESULT_TIMEOUT = 120.0
+
+def percentile(values: list, q: float):
+  if not values:
+    return None
+  values = sorted(values)
+  return values[min(len(values) - 1, int(q * len(values)))]
+
+class KafkaTransport:
+  """Sends prompts to a node's input topic and waits for their final result on its result topic"""
+
+  def __init__(self, bootstrap_servers: str, input_topic: str, result_topic: str):
+    self.input_topic = input_topic
+    self.codec = get_codec('json')
+    self.producer = Producer({'bootstrap.servers': bootstrap_servers, 'linger.ms': 0})
+    self.consumer = Consumer({
+      'bootstrap.servers': bootstrap_servers,
+      'group.id': f"transport-benchmark-{uuid.uuid4().hex[:8]}",
+      'enable.auto.commit': False
+    })
+
+    def on_assign(consumer, partitions):
+      # Only results of prompts sent from now on
+      for partition in partitions:
+        partition.offset = OFFSET_END
+      consumer.assign(partitions)
+
+    self.consumer.subscribe([result_topic], on_assign=on_assign)
+    deadline = time.time() + 30
+    while not self.consumer.assignment():
+      if time.time() > deadline:
+        raise RuntimeError(f"No partitions of {result_topic} assigned")
+      self.consumer.poll(0.1)
+
+  def request(self, message: dict):
+    """(end-to-end seconds, seconds to the first record, final record), None on timeout"""
+    start = time.time()
+    self.producer.produce(
+      self.input_topic,
+      value=self.codec.encode(message),
+      key=message['message_id'],
+      headers=[(CONTENT_TYPE_HEADER, self.codec.content_type), ('sent_at', repr(start).encode('utf-8'))]
+    )
+    self.producer.poll(0)
+    first = None
+    while time.time() - start < RESULT_TIMEOUT:
+      msg = self.consumer.poll(0.01)
+      if msg is None or msg.error():
+        continue
+      record = codec_for(msg.headers()).decode(msg.value())
+      if record.get('message_id') != message['message_id']:
+        continue
+      first = first or time.time() - start
+      if record.get('type') != 'chunk':
+        return time.time() - start, first, record
+    return None
+
+  def close(self):
+    self.producer.flush(10)
+    self.consumer.close()
+
+class HTTPTransport:
+  """Posts prompts to a node's /generate endpoint, streamed as server-sent events or not"""
+
+  def __init__(self, url: str, stream: bool):
+    self.url = url.rstrip('/') + '/generate'
+    self.stream = stream
+    self.session = requests.Session()
+
+  def request(self, message: dict):
+    """(end-to-end seconds, seconds to the first record, final record), None on failure"""
+    start = time.time()
+    response = self.session.post(self.url, json={**message, 'stream': self.stream}, stream=self.stream, timeout=RESULT_TIMEOUT)
+    if not self.stream:
+      if response.status_code != 200:
+        return None
+      record = response.json()
+      elapsed = time.time() - start
+      return elapsed, elapsed, record
+
+    first = None
+    event = None
+    for line in response.iter_lines(decode_unicode=True):
+      if line.startswith('event: '):
+        event = line[len('event: '):]
+      elif line.startswith('data: '):
+        first = first or time.time() - start
+        if event == 'final':
+          return time.time() - start, first, json.loads(line[len('data: '):])
+        if event == 'error':
+          return None
+    return None
+
+  def close(self):
+    self.session.close()
+
+def run_node(name: str, transports: dict, requests_per_transport: int, prompt_tokens: int, max_new_tokens: int) -> dict:
+  """Latency samples of one node by transport"""
+  results = {transport: {'e2e': [], 'first': [], 'processing': [], 'overhead': [], 'failed': 0} for transport in transports}
+  for i in range(requests_per_transport):
+    # Alternate which transport goes first, so neither always meets a warmer service
+    order = list(transports.items()) if i % 2 == 0 else list(reversed(transports.items()))
+    for transport, client in order:
+      message = {
+        # Unique prompts, so the response cache never answers
+        'message_id': f"bench-{name}-{transport}-{i}-{uuid.uuid4().hex[:6]}",
+        'prompt': random_text(prompt_tokens),
+        'token_count': prompt_tokens,
+        'parameters': {'max_new_tokens': max_new_tokens, 'do_sample': False}
+      }
+      outcome = client.request(message)
+      samples = results[transport]
+      if outcome is None or outcome[2].get('status') != 'success':
+        samples['failed'] += 1
+        continue
+      e2e, first, record = outcome
+      samples['e2e'].append(e2e)
+      samples['first'].append(first)
+      samples['processing'].append(record['processing_time'])
+      samples['overhead'].append(e2e - record['processing_time'])
+  return results
+
+def main():
+  parser = argparse.ArgumentParser(description='Kafka vs. direct HTTP latency of running services')
+  parser.add_argument('bootstrap_servers')
+  parser.add_argument('nodes', nargs='+', help='name=input_topic,result_topic,url')
+  parser.add_argument('--requests', type=int, default=50, help='requests per node and transport')
+  parser.add_argument('--warmup', type=int, default=3, help='unmeasured requests per node and transport')
+  parser.add_argument('--prompt-tokens', type=int, default=PROMPT_TOKENS['short'])
+  parser.add_argument('--max-new-tokens', type=int, default=32)
+  parser.add_argument('--stream', action='store_true', help='stream HTTP responses as server-sent events')
+  args = parser.parse_args()
+  random.seed(0)
+
+  print(f"{'node':<12}{'transport':<11}{'n':>5}{'failed':>8}{'e2e p50':>10}{'e2e p95':>10}"
+        f"{'first p50':>11}{'service p50':>13}{'transport p50':>15}{'transport p95':>15}")
+  for node in args.nodes:
+    name, spec = node.split('=', 1)
+    input_topic, result_topic, url = spec.split(',', 2)
+    transports = {
+      'kafka': KafkaTransport(args.bootstrap_servers, input_topic, result_topic),
+      'http': HTTPTransport(url, args.stream)
+    }
+    try:
+      run_node(name, transports, args.warmup, args.prompt_tokens, args.max_new_tokens)
+      results = run_node(name, transports, args.requests, args.prompt_tokens, args.max_new_tokens)
+    finally:
+      for client in transports.values():
+        client.close()
+
+    for transport, samples in results.items():
+      row = [
+        percentile(samples['e2e'], 0.5), percentile(samples['e2e'], 0.95), percentile(samples['first'], 0.5),
+        percentile(samples['processing'], 0.5), percentile(samples['overhead'], 0.5), percentile(samples['overhead'], 0.95)
+      ]
+      print(f"{name:<12}{transport:<11}{len(samples['e2e']):>5}{samples['failed']:>8}" + ''.join(
+        f"{value * 1000:>{width}.1f}" if value is not None else f"{'-':>{width}}"
+        for value, width in zip(row, (10, 10, 11, 13, 15, 15))
+      ))
+    kafka, http = (percentile(results[transport]['overhead'], 0.5) for transport in ('kafka', 'http'))
+    if kafka is not None and http is not None:
+      print(f"{name:<12}Kafka adds {(kafka - http) * 1000:.1f} ms per request over direct HTTP (median, ms above)")
+
+if __name__ == '__main__':
+  main()
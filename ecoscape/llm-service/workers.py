@@ -0,0 +1,113 @@
+'''
+Worker processes
+----------------
+The parent process loads the model once and forks the inference workers, so
+all workers share the read-only weight pages copy-on-write (and the page
+cache of a memory-mapped snapshot). The parent keeps the Kafka consumer and
+producer: it hands prompts to the workers over a shared task queue, which the
+workers pull from whenever they have room, and publishes what the workers
+send back over the result queue.
+'''
+
+import logging
+import multiprocessing
+import threading
+
+from metrics import mark_process_dead
+
+logger = logging.getLogger(__name__)
+
+class WorkerProcesses:
+  """
+  Forked inference worker processes. `target(index, tasks, results)` runs in
+  every worker and gets (message, data, context) tasks; it reports ('ready', index, None)
+  or ('failed', index, error) once set up, ('publish', key, value) for every
+  chunk to produce and ('done', message, result) once a task is processed.
+  """
+
+  def __init__(self, count: int, target, publish, done):
+    self.count = count
+    self.target = target
+    self.publish = publish
+    self.done = done
+
+    context = multiprocessing.get_context('fork')
+    self._context = context
+    self.tasks = context.Queue()
+    self.results = context.Queue()
+    self.processes = []
+    self._ready = set()
+    self._failed = {}
+    self._settled = threading.Condition()
+    self._reader = None
+    self._stopped = False
+
+  def start(self):
+    for index in range(self.count):
+      process = self._context.Process(
+        target=self.target,
+        args=(index, self.tasks, self.results),
+        name=f'inference-worker-{index}',
+        daemon=True
+      )
+      process.start()
+      self.processes.append(process)
+    self._reader = threading.Thread(target=self._read_results, name='worker-results', daemon=True)
+    self._reader.start()
+    logger.info(f"Started {self.count} inference worker processes: {[p.pid for p in self.processes]}")
+
+  def _read_results(self):
+    while True:
+      message = self.results.get()
+      if message is None:
+        return
+      kind, key, value = message
+      if kind == 'publish':
+        try:
+          self.publish(value, key)
+        except Exception as e:
+          logger.error(f"Failed to publish worker result: {e}")
+        continue
+      if kind == 'done':
+        self.done(key, value)
+        continue
+      with self._settled:
+        if kind == 'ready':
+          self._ready.add(key)
+        else:
+          self._failed[key] = value
+        self._settled.notify_all()
+
+  def wait_ready(self):
+    """Blocks until every worker finished its setup, raises if one of them failed or died"""
+    with self._settled:
+      while len(self._ready) + len(self._failed) < self.count:
+        if not self.alive():
+          raise RuntimeError('Inference worker process exited during startup')
+        self._settled.wait(timeout=1)
+    if self._failed:
+      raise RuntimeError(f"Inference workers failed to start: {self._failed}")
+
+  def submit(self, data: dict, message=None, context: dict = None):
+    self.tasks.put((message, data, context))
+
+  def alive(self) -> bool:
+    return all(process.is_alive() for process in self.processes)
+
+  def stop(self, timeout: float = 30.0):
+    """Lets the workers finish their queued prompts, then waits for their last results"""
+    if self._stopped:
+      return
+    self._stopped = True
+    for _ in self.processes:
+      self.tasks.put(None)
+    for process in self.processes:
+      process.join(timeout=timeout)
+      if process.is_alive():
+        logger.warning(f"Worker {process.pid} did not stop in time, terminating it")
+        process.terminate()
+        process.join()
+      mark_process_dead(process.pid)
+    if self._reader:
+      self.results.put(None)
+      self._reader.join(timeout=timeout)